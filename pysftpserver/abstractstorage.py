@@ -1,5 +1,66 @@
 """Abstract SFTP storage. Subclass it the way you want!"""
 
+import os
+
+
+def _defined_at(obj, name):
+    """Return the position in the MRO of obj of the class defining name,
+    -1 for the attributes of the instance itself and None if undefined."""
+    if name in getattr(obj, '__dict__', ()):
+        return -1
+    for i, cls in enumerate(type(obj).__mro__):
+        if name in vars(cls):
+            return i
+    return None
+
+
+def get_shortcut(storage, name, method):
+    """Return an optional attribute of the storage (e.g. read_into) that
+    the server uses in place of one of its methods (e.g. read).
+
+    The attribute is ignored when method is overridden by a subclass of
+    the class defining it: a storage overriding read only is never
+    bypassed by the read_into it inherited.
+
+    Args:
+        storage: The storage (or any object wrapping it and forwarding
+            method, e.g. SFTPStatCache).
+        name (str): The name of the attribute.
+        method (str): The name of the method it stands in for.
+
+    Returns:
+        The attribute, or None if it's not defined or can't be used.
+    """
+    bound = getattr(storage, method, None)
+    owner = getattr(bound, '__self__', storage)  # who actually defines it
+    value = getattr(owner, name, None)
+    position = _defined_at(owner, name)
+    if value is None or position is None:
+        return None
+    method_position = _defined_at(owner, method)
+    if method_position is not None and method_position < position:
+        return None
+    return value
+
+
+def absolute_path(storage, filename):
+    """Return the normalized absolute path of a filename received from a
+    client, so that its different spellings (e.g. 'foo', './foo' and
+    '/home/user/foo' in the home '/home/user') compare equal.
+    Symbolic links are not resolved.
+
+    Args:
+        storage: The storage, whose home relative paths start from.
+        filename (bytes): The path.
+
+    Returns:
+        (bytes): The normalized path.
+    """
+    home = getattr(storage, 'home', None) or b''
+    if not isinstance(home, bytes):
+        home = home.encode()
+    return os.path.normpath(os.path.join(home, filename))
+
 
 class SFTPAbstractServerStorage:
     """Abstract storage class. Subclass it and override the methods."""
@@ -20,7 +81,9 @@ class SFTPAbstractServerStorage:
     def stat(self, filename, parent=None, lstat=False, fstat=False):
         """stat, lstat and fstat requests.
 
-        Return a dictionary of stats.
+        Return the attributes of the file, as a SFTPAttributes
+        (a dictionary keyed by b'size', b'uid', b'gid', b'perm', b'atime',
+        b'mtime' and b'longname' will do too).
         Filename is an handle in the fstat variant.
         """
         return {}
@@ -35,7 +98,12 @@ class SFTPAbstractServerStorage:
         return
 
     def opendir(self, filename):
-        """Return an iterator over the files in filename."""
+        """Return an iterator over the files in filename.
+
+        Each item is either a filename or an object with a name attribute
+        (e.g. os.DirEntry): in the latter case, the item is passed as it is
+        to stat, which can then reuse the data it carries.
+        """
         return iter([b'.', b'..'])
 
     def open(self, filename, flags, mode):
@@ -74,6 +142,51 @@ class SFTPAbstractServerStorage:
         """Read from the handle size, starting from offset off."""
         return None
 
+    # Set it to True if write accepts memoryviews of the received
+    # requests, valid only until it returns, instead of bytes.
+    # Ignored by the subclasses overriding write only (see get_shortcut).
+    write_memoryview = False
+
+    # Define read_into(handle, off, buffer), reading from the handle into
+    # buffer (a writable memoryview) starting from offset off and returning
+    # the number of bytes read, to let the server read straight into the
+    # messages it sends, instead of calling read. It can return None to
+    # have the server call read instead (e.g. for memory-mapped files,
+    # whose slices are sent without copying them at all).
+    # Ignored by the subclasses overriding read only (see get_shortcut).
+    read_into = None
+
+    # Define copy_data(read_handle, read_off, length, write_handle,
+    # write_off), copying length bytes (up to the end of file if 0) from
+    # read_handle at offset read_off to write_handle at offset write_off,
+    # to serve the copy-data extension without moving the data through
+    # the client.
+    copy_data = None
+
+    # Define set_checksum(handle, algorithm, digest, size), storing the
+    # digest of the whole file (size bytes long) computed while it was
+    # written, and get_checksum(handle, algorithm), returning the
+    # (digest, size) stored, or None if unknown or stale, to let
+    # check-file requests skip reading the file again.
+    set_checksum = None
+    get_checksum = None
+
+    def writev(self, handle, off, chunks):
+        """Write chunks one after the other, starting at offset off of
+        handle. Override it to write them at once.
+        """
+        for chunk in chunks:
+            if not self.write(handle, off, chunk):
+                return False
+            off += len(chunk)
+        return True
+
+    def readv(self, handle, ranges):
+        """Read from the handle each (offset, size) of ranges, returning a
+        list of chunks. Override it to read them at once.
+        """
+        return [self.read(handle, off, size) for off, size in ranges]
+
     def close(self, handle):
         """Close the file handle."""
         return
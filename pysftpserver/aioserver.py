@@ -0,0 +1,495 @@
+"""An asyncio engine for the SFTP server.
+
+Storage and hook methods can be coroutine functions (i.e. async def):
+the requests relying on them are executed as asyncio tasks, so that many
+of them can be awaited at the same time.
+
+Requires Python 3.5+.
+"""
+
+import asyncio
+import errno
+import functools
+import inspect
+import struct
+import time
+
+from pysftpserver.pysftpexceptions import SFTPForbidden
+from pysftpserver.server import (SSH2_FX_EOF, SSH2_FX_FAILURE, SSH2_FX_OK,
+                                 SSH2_FXP_CLOSE, SSH2_FXP_FSETSTAT,
+                                 SSH2_FXP_FSTAT, SSH2_FXP_LSTAT,
+                                 SSH2_FXP_MKDIR, SSH2_FXP_NAME, SSH2_FXP_OPEN,
+                                 SSH2_FXP_OPENDIR, SSH2_FXP_READ,
+                                 SSH2_FXP_READDIR, SSH2_FXP_READLINK,
+                                 SSH2_FXP_REALPATH, SSH2_FXP_REMOVE,
+                                 SSH2_FXP_RENAME, SSH2_FXP_RMDIR,
+                                 SSH2_FXP_SETSTAT, SSH2_FXP_STAT,
+                                 SSH2_FXP_SYMLINK, SSH2_FXP_WRITE, SFTPServer)
+
+
+async def maybe_await(value):
+    """Await value if it's awaitable, return it otherwise."""
+    if inspect.isawaitable(value):
+        value = await value
+    return value
+
+
+class SFTPAsyncServer(SFTPServer):
+    """The SFTP server, driven by an asyncio event loop.
+
+    stdin and stdout (fd_in and fd_out) are connected as asyncio streams.
+    The requests whose storage and hook methods are plain functions are
+    executed as soon as they are received, as SFTPServer does.
+    The others run in their own task and are answered when they complete:
+    requests on the same lane (see SFTPServer.request_lane) are still
+    executed in order, by the awaiting twins of the SFTPServer handlers
+    (see async_handlers). The background requests (i.e. check-file) run
+    in the default executor of the loop.
+    """
+
+    def __init__(self, storage, hook=None, **kwargs):
+        kwargs['workers'] = 0  # tasks take their place
+        kwargs['coalesce_reads'] = 0  # READs may wait for their lane
+        kwargs['sendfile'] = False  # the output goes through the writer
+        super(SFTPAsyncServer, self).__init__(storage, hook, **kwargs)
+        self.writer = None
+        self.lanes = dict()  # lane -> last task scheduled on it
+        self.tasks = set()
+        self.error = None
+        # both call the storage from plain functions
+        if self.is_async('storage.read'):
+            self.readahead = None
+        if self.is_async('storage.write'):
+            self.writebehind = None
+        # extensions are served by plain functions only
+        self.extended_table = {
+            request: handler
+            for request, handler in self.extended_table.items()
+            if not any(self.is_async(method)
+                       for method in self.extended_methods.get(request, ()))
+        }
+        self.async_table = {
+            msg_type: handler
+            for msg_type, (handler, methods) in self.async_handlers.items()
+            if any(self.is_async(method) for method in methods)
+        }
+
+    extended_methods = {
+        b'limits@openssh.com': (),
+        b'copy-data': ('storage.copy_data',),
+        b'check-file-handle': ('storage.read',),
+        b'check-file-name': ('storage.verify', 'storage.open', 'storage.read',
+                             'storage.close'),
+    }
+
+    def is_async(self, method):
+        """Check if a storage or hook method is a coroutine function.
+
+        Args:
+            method (str): e.g. 'storage.stat' or 'hook.stat'.
+
+        Returns:
+            (bool): True if the method has to be awaited.
+        """
+        owner, name = method.split('.')
+        return inspect.iscoroutinefunction(
+            getattr(getattr(self, owner), name, None))
+
+    async def run(self):
+        """Serve the requests until fd_in is closed."""
+        loop = asyncio.get_event_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader),
+            open(self.fd_in, 'rb', buffering=0, closefd=False)
+        )
+        transport, protocol = await loop.connect_write_pipe(
+            asyncio.streams.FlowControlMixin,
+            open(self.fd_out, 'wb', buffering=0, closefd=False)
+        )
+        self.writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        try:
+            while True:
+                buf = await reader.read(self.buffer_size)
+                if not buf:
+                    break
+                self._input += buf
+                self.process()
+                self.flush_output()
+                if self.error:
+                    raise self.error
+                await self.writer.drain()
+            await self.join()
+            await self.close_handles_async()
+            self.flush_output()
+            await self.writer.drain()
+        finally:
+            transport.close()
+            self.writer = None
+
+    async def join(self):
+        """Wait for all the pending requests to be answered."""
+        while self.tasks:
+            await asyncio.wait(set(self.tasks))
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    def flush_output(self):
+        """Hand the output queue to the stdout stream, if connected."""
+        if self.writer is not None and self._output:
+            self.writer.writelines(self._output)
+            self._output.clear()
+
+    def schedule(self, msg_type, msg_id):
+        """Execute the current request or schedule a task for it."""
+        lane = self.request_lane(msg_type)
+        if lane is None:
+            lanes = ()
+        elif isinstance(lane, tuple):
+            lanes = lane
+        else:
+            lanes = (lane,)
+        previous = [self.lanes[lane] for lane in lanes if lane in self.lanes]
+        if (msg_type not in self.async_table and not previous and
+                not self.is_background_request(msg_type)):
+            self.dispatch(msg_type, msg_id)
+            return
+        server = self.fork(self.payload[self.payload_offset:].tobytes())
+        task = asyncio.ensure_future(
+            self.execute_async(server, msg_type, msg_id, previous))
+        self.tasks.add(task)
+        task.add_done_callback(functools.partial(self._task_done, lanes))
+        for lane in lanes:
+            self.lanes[lane] = task
+
+    def lane_busy(self, lane):
+        """Check if some task of a lane is still pending."""
+        return lane in self.lanes
+
+    def _task_done(self, lanes, task):
+        self.tasks.discard(task)
+        for lane in lanes:
+            if self.lanes.get(lane) is task:
+                del self.lanes[lane]
+        if not task.cancelled() and task.exception() is not None:
+            self.error = self.error or task.exception()
+
+    async def execute_async(self, server, msg_type, msg_id, previous=None):
+        """Execute a request in its own task.
+
+        Args:
+            server (SFTPAsyncServer): The copy of the server handling the
+                request, see SFTPServer.fork.
+            msg_type (int): The SSH2_FXP_* type of the message.
+            msg_id (int): The request id, used to send the response.
+
+        Optional Args:
+            previous (list): The tasks to wait for before starting.
+        """
+        if previous:
+            await asyncio.wait(previous)
+        try:
+            if msg_type in self.async_table:
+                await server.dispatch_async(msg_type, msg_id)
+            elif server.is_background_request(msg_type):
+                # e.g. check-file: don't hash whole files in the loop
+                await asyncio.get_event_loop().run_in_executor(
+                    None, server.dispatch, msg_type, msg_id)
+            else:
+                server.dispatch(msg_type, msg_id)
+        finally:
+            self._output.extend(server._output)
+            self.flush_output()
+
+    async def dispatch_async(self, msg_type, msg_id):
+        """Await the command of the current payload, see dispatch."""
+        try:
+            await self.async_table[msg_type](self, msg_id)
+        except Exception as e:
+            self.send_error(msg_id, e)
+
+    async def call_hook(self, name, *args):
+        if self.hook:
+            await maybe_await(getattr(self.hook, name)(self, *args))
+
+    async def consume_filename_async(self, default=None):
+        """Extract a filename from the payload, see consume_filename."""
+        filename = self.consume_path(default)
+        if await maybe_await(self.storage.verify(filename)):
+            return filename
+        raise SFTPForbidden()
+
+    async def new_handle_async(self, filename, flags=0, attrs=dict(),
+                               is_opendir=False):
+        """Create a new handle for a file or a directory, see new_handle."""
+        self.check_open_handles()
+        if is_opendir:
+            handle = await maybe_await(self.storage.opendir(filename))
+        else:
+            mode = attrs.get(b'perm', 0o666)
+            handle = await maybe_await(self.storage.open(
+                filename, self.get_os_flags(flags), mode))
+        return self.add_handle(handle, filename, is_dir=is_opendir)
+
+    async def encode_item_async(self, item, parent_dir=None):
+        """Pack an entry of a SSH2_FXP_NAME message, see encode_item."""
+        if parent_dir:  # in case of readdir response
+            attrs = await maybe_await(
+                self.storage.stat(item, parent=parent_dir))
+            item = getattr(item, 'name', item)
+        else:
+            attrs = await maybe_await(self.storage.stat(item))
+        return self.pack_item(item, attrs)
+
+    async def close_handle_async(self, record):
+        """Write the pending data of a handle, close it and forget it, see
+        close_handle.
+        """
+        self.readahead and self.readahead.discard(record)
+        try:
+            self.writebehind and self.writebehind.flush(record)
+            if record.checksum is not None and \
+                    getattr(self.storage, 'set_checksum', None):
+                await maybe_await(self.storage.set_checksum(
+                    record.handle, self.checksum, record.checksum.digest(),
+                    record.checksum_size))
+        finally:
+            await maybe_await(self.storage.close(record.handle))
+            del(self.handles[record.id])
+
+    async def close_handles_async(self):
+        """Close all the handles left open, see close_handles."""
+        for handle_id in self.handles:
+            try:
+                await self.close_handle_async(self.handles[handle_id])
+            except Exception as e:
+                self.log("failed to close a handle: %r" % e)
+
+    async def _realpath(self, sid):
+        filename = await self.consume_filename_async(default=b'.')
+        await self.call_hook('realpath', filename)
+        self.send_msg(
+            struct.pack('>BII', SSH2_FXP_NAME, sid, 1),
+            await self.encode_item_async(filename)
+        )
+
+    async def _stat(self, sid):
+        filename = await self.consume_filename_async()
+        await self.call_hook('stat', filename)
+        attrs = await maybe_await(self.storage.stat(filename))
+        self.send_attrs(sid, attrs)
+
+    async def _lstat(self, sid):
+        filename = await self.consume_filename_async()
+        await self.call_hook('lstat', filename)
+        attrs = await maybe_await(self.storage.stat(filename, lstat=True))
+        self.send_attrs(sid, attrs)
+
+    async def _fstat(self, sid):
+        handle_id = self.consume_string()
+        await self.call_hook('fstat', handle_id)
+        record = self.handles[handle_id]
+        self.writebehind and self.writebehind.flush(record)
+        attrs = await maybe_await(
+            self.storage.stat(record.handle, fstat=True))
+        self.send_attrs(sid, attrs)
+
+    async def _setstat(self, sid):
+        filename = await self.consume_filename_async()
+        attrs = self.consume_attrs()
+        await self.call_hook('setstat', filename, attrs)
+        if self.checksum and b'size' in attrs:
+            for record in self.handles_on(filename):
+                record.checksum = None
+        await maybe_await(self.storage.setstat(filename, attrs))
+        self.send_status(sid, SSH2_FX_OK)
+
+    async def _fsetstat(self, sid):
+        handle_id = self.consume_string()
+        record = self.handles[handle_id]
+        attrs = self.consume_attrs()
+        await self.call_hook('fsetstat', handle_id, attrs)
+        self.readahead and self.readahead.discard(record)
+        self.writebehind and self.writebehind.flush(record)
+        if b'size' in attrs:
+            record.checksum = None
+        await maybe_await(
+            self.storage.setstat(record.handle, attrs, fsetstat=True))
+        self.send_status(sid, SSH2_FX_OK)
+
+    async def _opendir(self, sid):
+        filename = await self.consume_filename_async()
+        await self.call_hook('opendir', filename)
+        handle_id = await self.new_handle_async(filename, is_opendir=True)
+        self.send_handle(sid, handle_id)
+
+    async def _readdir(self, sid):
+        record = self.consume_handle()
+        if not record.readdir_hooked:
+            record.readdir_hooked = True
+            await self.call_hook('readdir', record.id)
+        handle = record.handle
+        parent_dir = record.filename
+        entries = []
+        size = 0
+        while size < self.readdir_size:
+            try:
+                if hasattr(handle, '__anext__'):  # an async iterator
+                    item = await handle.__anext__()
+                else:
+                    item = next(handle)
+            except (StopIteration, StopAsyncIteration):
+                break
+            try:
+                entry = await self.encode_item_async(
+                    item, parent_dir=parent_dir)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue  # removed while we were listing
+                raise
+            entries.append(entry)
+            size += len(entry)
+        if entries:
+            self.send_msg(
+                struct.pack('>BII', SSH2_FXP_NAME, sid, len(entries)),
+                *entries
+            )
+        else:
+            self.send_status(sid, SSH2_FX_EOF)
+
+    async def _close(self, sid):
+        handle_id = self.consume_string()
+        await self.call_hook('close', handle_id)
+        await self.close_handle_async(self.handles[handle_id])
+        self.send_status(sid, SSH2_FX_OK)
+
+    async def _open(self, sid):
+        filename = await self.consume_filename_async()
+        flags = self.consume_int()
+        attrs = self.consume_attrs()
+        await self.call_hook(
+            'open', filename, self.get_explicit_flags(flags), attrs)
+        handle_id = await self.new_handle_async(filename, flags, attrs)
+        self.track_writes(self.handles[handle_id], flags)
+        self.send_handle(sid, handle_id)
+
+    async def _read(self, sid):
+        record = self.consume_handle()
+        off = self.consume_int64()
+        size = min(self.consume_int(), self.max_read_length)
+        if not record.read_hooked:
+            record.read_hooked = True
+            await self.call_hook('read', record.id, off, size)
+        self.writebehind and self.writebehind.flush(record)
+        if self.readahead:
+            chunk = self.readahead.read(record, off, size)
+        else:
+            chunk = await maybe_await(
+                self.storage.read(record.handle, off, size))
+        record.bytes_read += len(chunk)
+        record.accessed_at = time.time()
+        if len(chunk) == 0:
+            self.send_status(sid, SSH2_FX_EOF)
+        else:
+            self.send_data(sid, chunk, len(chunk))
+
+    async def _write(self, sid):
+        record = self.consume_handle()
+        off = self.consume_int64()
+        chunk = self.consume_string()
+        self.readahead and self.readahead.discard(record)
+        self.update_checksum(record, off, chunk)
+        if self.writebehind:
+            written = self.writebehind.write(record, off, chunk)
+        else:
+            written = await maybe_await(
+                self.storage.write(record.handle, off, chunk))
+        if written:
+            record.bytes_written += len(chunk)
+            record.accessed_at = time.time()
+            self.send_status(sid, SSH2_FX_OK)
+        else:
+            record.checksum = None
+            self.send_status(sid, SSH2_FX_FAILURE)
+        if not record.write_hooked:
+            record.write_hooked = True
+            await self.call_hook('write', record.id, off)
+
+    async def _mkdir(self, sid):
+        filename = await self.consume_filename_async()
+        attrs = self.consume_attrs()
+        await self.call_hook('mkdir', filename, attrs)
+        await maybe_await(
+            self.storage.mkdir(filename, attrs.get(b'perm', 0o777)))
+        self.send_status(sid, SSH2_FX_OK)
+
+    async def _rmdir(self, sid):
+        filename = await self.consume_filename_async()
+        await self.call_hook('rmdir', filename)
+        await maybe_await(self.storage.rmdir(filename))
+        self.send_status(sid, SSH2_FX_OK)
+
+    async def _rm(self, sid):
+        filename = await self.consume_filename_async()
+        await self.call_hook('rm', filename)
+        await maybe_await(self.storage.rm(filename))
+        self.send_status(sid, SSH2_FX_OK)
+
+    async def _rename(self, sid):
+        oldpath = await self.consume_filename_async()
+        newpath = await self.consume_filename_async()
+        await self.call_hook('rename', oldpath, newpath)
+        await maybe_await(self.storage.rename(oldpath, newpath))
+        self.send_status(sid, SSH2_FX_OK)
+
+    async def _symlink(self, sid):
+        linkpath = await self.consume_filename_async()
+        targetpath = await self.consume_filename_async()
+        await self.call_hook('symlink', linkpath, targetpath)
+        await maybe_await(self.storage.symlink(linkpath, targetpath))
+        self.send_status(sid, SSH2_FX_OK)
+
+    async def _readlink(self, sid):
+        filename = await self.consume_filename_async()
+        await self.call_hook('readlink', filename)
+        link = await maybe_await(self.storage.readlink(filename))
+        attrs = await maybe_await(self.storage.stat(filename, lstat=True))
+        self.send_link(sid, link, attrs)
+
+    # message type -> (handler, methods that make it asynchronous)
+    async_handlers = {
+        SSH2_FXP_REALPATH: (
+            _realpath, ('storage.verify', 'storage.stat', 'hook.realpath')),
+        SSH2_FXP_STAT: (
+            _stat, ('storage.verify', 'storage.stat', 'hook.stat')),
+        SSH2_FXP_LSTAT: (
+            _lstat, ('storage.verify', 'storage.stat', 'hook.lstat')),
+        SSH2_FXP_FSTAT: (_fstat, ('storage.stat', 'hook.fstat')),
+        SSH2_FXP_SETSTAT: (
+            _setstat, ('storage.verify', 'storage.setstat', 'hook.setstat')),
+        SSH2_FXP_FSETSTAT: (_fsetstat, ('storage.setstat', 'hook.fsetstat')),
+        SSH2_FXP_OPENDIR: (
+            _opendir, ('storage.verify', 'storage.opendir', 'hook.opendir')),
+        SSH2_FXP_READDIR: (
+            _readdir, ('storage.opendir', 'storage.stat', 'hook.readdir')),
+        SSH2_FXP_CLOSE: (
+            _close, ('storage.close', 'storage.set_checksum', 'hook.close')),
+        SSH2_FXP_OPEN: (
+            _open, ('storage.verify', 'storage.open', 'hook.open')),
+        SSH2_FXP_READ: (_read, ('storage.read', 'hook.read')),
+        SSH2_FXP_WRITE: (_write, ('storage.write', 'hook.write')),
+        SSH2_FXP_MKDIR: (
+            _mkdir, ('storage.verify', 'storage.mkdir', 'hook.mkdir')),
+        SSH2_FXP_RMDIR: (
+            _rmdir, ('storage.verify', 'storage.rmdir', 'hook.rmdir')),
+        SSH2_FXP_REMOVE: (_rm, ('storage.verify', 'storage.rm', 'hook.rm')),
+        SSH2_FXP_RENAME: (
+            _rename, ('storage.verify', 'storage.rename', 'hook.rename')),
+        SSH2_FXP_SYMLINK: (
+            _symlink, ('storage.verify', 'storage.symlink', 'hook.symlink')),
+        SSH2_FXP_READLINK: (
+            _readlink,
+            ('storage.verify', 'storage.readlink', 'storage.stat',
+             'hook.readlink')),
+    }
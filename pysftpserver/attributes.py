@@ -0,0 +1,174 @@
+"""The attributes of a file, as exchanged by the server and the storages."""
+
+import collections.abc
+import struct
+
+from pysftpserver.stat_helpers import stat_to_longname
+
+SSH2_FILEXFER_ATTR_SIZE = 0x00000001
+SSH2_FILEXFER_ATTR_UIDGID = 0x00000002
+SSH2_FILEXFER_ATTR_PERMISSIONS = 0x00000004
+SSH2_FILEXFER_ATTR_ACMODTIME = 0x00000008
+SSH2_FILEXFER_ATTR_EXTENDED = 0x80000000
+
+_ALL_FLAGS = (SSH2_FILEXFER_ATTR_SIZE | SSH2_FILEXFER_ATTR_UIDGID |
+              SSH2_FILEXFER_ATTR_PERMISSIONS | SSH2_FILEXFER_ATTR_ACMODTIME)
+
+_all_attrs = struct.Struct('>IQIIIII')  # flags and every attribute
+_uint32 = struct.Struct('>I')
+_uint64 = struct.Struct('>Q')
+_pair = struct.Struct('>II')
+
+
+class SFTPAttributes(collections.abc.MutableMapping):
+    """The attributes of a file: returned by the stat method of the
+    storages, decoded from the requests and passed to the hooks.
+
+    Each attribute is a slot, None when it's not set. The attributes can
+    also be accessed as the items of a dict keyed by b'size', b'uid',
+    b'gid', b'perm', b'atime', b'mtime', b'longname' and b'extended', as
+    custom storages and hooks used to: unset attributes are missing keys.
+
+    The longname of a file built by from_stat is only formatted when it is
+    looked up, i.e. when a SSH2_FXP_NAME message is sent.
+    """
+
+    __slots__ = ('size', 'uid', 'gid', 'perm', 'atime', 'mtime', 'extended',
+                 '_longname', '_stat', '_filename')
+
+    _keys = {
+        b'size': 'size',
+        b'uid': 'uid',
+        b'gid': 'gid',
+        b'perm': 'perm',
+        b'atime': 'atime',
+        b'mtime': 'mtime',
+        b'longname': 'longname',
+        b'extended': 'extended'
+    }
+
+    def __init__(self, size=None, uid=None, gid=None, perm=None, atime=None,
+                 mtime=None, longname=None, extended=None):
+        self.size = size
+        self.uid = uid
+        self.gid = gid
+        self.perm = perm
+        self.atime = atime
+        self.mtime = mtime
+        self.extended = extended
+        self._longname = longname
+        self._stat = None
+        self._filename = None
+
+    @classmethod
+    def from_stat(cls, st, filename=None):
+        """Build the attributes of a file from its stat.
+
+        Args:
+            st (os.stat_result): The stat of the file, or any object with
+                the same st_* attributes (e.g. paramiko's SFTPAttributes).
+
+        Optional Args:
+            filename (bytes): The name shown in the longname, None for no
+                longname at all (e.g. fstat).
+
+        Returns:
+            (SFTPAttributes): The attributes.
+        """
+        attrs = cls(st.st_size, st.st_uid, st.st_gid, st.st_mode,
+                    st.st_atime, st.st_mtime)
+        if filename is not None:
+            attrs._stat = st
+            attrs._filename = filename
+        return attrs
+
+    @classmethod
+    def from_dict(cls, attrs):
+        """Build the attributes from a dict keyed by b'size', b'uid' and so
+        on (unknown keys are ignored).
+
+        Returns:
+            (SFTPAttributes): The attributes.
+        """
+        converted = cls()
+        for key, value in attrs.items():
+            if key in cls._keys:
+                converted[key] = value
+        return converted
+
+    @property
+    def longname(self):
+        """The ls -l style line of the file, if any."""
+        if self._longname is None and self._filename is not None:
+            self._longname = stat_to_longname(self._stat, self._filename)
+            self._stat = self._filename = None
+        return self._longname
+
+    @longname.setter
+    def longname(self, longname):
+        self._longname = longname
+        self._stat = self._filename = None
+
+    def encode(self):
+        """Pack the attributes, along with their flags.
+
+        Returns:
+            (bytes): The packed attributes.
+        """
+        if self.extended is None and None not in (
+                self.size, self.uid, self.gid, self.perm, self.atime,
+                self.mtime):
+            return _all_attrs.pack(
+                _ALL_FLAGS, self.size, self.uid, self.gid, self.perm,
+                int(self.atime), int(self.mtime))
+
+        flags = 0
+        fields = []
+        if self.size is not None:
+            flags |= SSH2_FILEXFER_ATTR_SIZE
+            fields.append(_uint64.pack(self.size))
+        if self.uid is not None and self.gid is not None:
+            flags |= SSH2_FILEXFER_ATTR_UIDGID
+            fields.append(_pair.pack(self.uid, self.gid))
+        if self.perm is not None:
+            flags |= SSH2_FILEXFER_ATTR_PERMISSIONS
+            fields.append(_uint32.pack(self.perm))
+        if self.atime is not None and self.mtime is not None:
+            flags |= SSH2_FILEXFER_ATTR_ACMODTIME
+            fields.append(_pair.pack(int(self.atime), int(self.mtime)))
+        if self.extended:
+            flags |= SSH2_FILEXFER_ATTR_EXTENDED
+            pairs = [pair for extension in self.extended
+                     for pair in extension.items()]
+            fields.append(_uint32.pack(len(pairs)))
+            for name, data in pairs:
+                fields.extend((_uint32.pack(len(name)), name,
+                               _uint32.pack(len(data)), data))
+        return _uint32.pack(flags) + b''.join(fields)
+
+    def __getitem__(self, key):
+        value = getattr(self, self._keys[key])
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        setattr(self, self._keys[key], value)
+
+    def __delitem__(self, key):
+        self[key]  # KeyError if it's not set
+        setattr(self, self._keys[key], None)
+
+    def __iter__(self):
+        for key, name in self._keys.items():
+            if getattr(self, name) is not None:
+                yield key
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __repr__(self):
+        return 'SFTPAttributes({})'.format(', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self._keys.values()
+            if getattr(self, name) is not None))
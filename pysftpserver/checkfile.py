@@ -0,0 +1,135 @@
+"""Hashing of file ranges, for the check-file extension."""
+
+import collections
+import hashlib
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from pysftpserver.pysftpexceptions import SFTPException
+
+
+class _CRC32(object):
+    """The crc32 algorithm, with the interface of hashlib."""
+
+    digest_size = 4
+
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def digest(self):
+        return struct.pack('>I', self.value & 0xffffffff)
+
+
+# the algorithms of the check-file extension, in order of preference
+ALGORITHMS = collections.OrderedDict([
+    (b'sha256', hashlib.sha256),
+    (b'sha512', hashlib.sha512),
+    (b'sha384', hashlib.sha384),
+    (b'sha224', hashlib.sha224),
+    (b'sha1', hashlib.sha1),
+    (b'md5', hashlib.md5),
+    (b'crc32', _CRC32),
+])
+
+
+def _digest(algorithm, data):
+    h = ALGORITHMS[algorithm]()
+    h.update(data)
+    return h.digest()
+
+
+class SFTPFileHasher(object):
+    """Hash ranges of a file, as requested by the check-file extension.
+
+    When a digest is requested for each block of the range, the blocks are
+    read in order and hashed in parallel by a pool of threads (hashlib
+    releases the GIL while hashing).
+    """
+
+    chunk_size = 1024 * 1024  # read at once when hashing the whole range
+
+    def __init__(self, threads=None):
+        if threads is None:
+            import multiprocessing
+            threads = multiprocessing.cpu_count()
+        self.threads = threads
+        self.executor = None
+
+    @staticmethod
+    def choose_algorithm(algorithms):
+        """Choose the first supported algorithm of a comma separated list.
+
+        Args:
+            algorithms (bytes): The algorithms accepted by the client.
+
+        Returns:
+            (bytes): The algorithm to use.
+
+        Raises:
+            SFTPException: If none of them is supported.
+        """
+        for algorithm in algorithms.split(b','):
+            if algorithm in ALGORITHMS:
+                return algorithm
+        raise SFTPException(b'unsupported hash algorithm')
+
+    def hash(self, read, algorithm, start, length, block_size,
+             max_size=None):
+        """Hash a range of a file.
+
+        Args:
+            read (callable): Called with an offset and a size, returns the
+                data read from the file (e.g. a partial of storage.read).
+            algorithm (bytes): One of ALGORITHMS.
+            start (int): Where the range starts.
+            length (int): The length of the range, 0 for up to the end of
+                file.
+            block_size (int): Hash each block_size bytes of the range, or
+                the whole range if 0.
+
+        Optional Args:
+            max_size (int): The maximum size of the result.
+
+        Returns:
+            (bytes): The digests of the blocks, concatenated.
+
+        Raises:
+            SFTPException: If the result would exceed max_size.
+        """
+        end = start + length if length else None
+        if not block_size:
+            h = ALGORITHMS[algorithm]()
+            for chunk in self._read(read, start, end, self.chunk_size):
+                h.update(chunk)
+            return h.digest()
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.threads)
+        digest_size = ALGORITHMS[algorithm]().digest_size
+        digests = []
+        pending = collections.deque()  # bounds the blocks kept in memory
+        for chunk in self._read(read, start, end, block_size):
+            if max_size and \
+                    (len(digests) + len(pending) + 1) * digest_size > max_size:
+                for future in pending:
+                    future.cancel()
+                raise SFTPException(b'too many blocks')
+            pending.append(self.executor.submit(_digest, algorithm, chunk))
+            if len(pending) > 2 * self.threads:
+                digests.append(pending.popleft().result())
+        digests.extend(future.result() for future in pending)
+        return b''.join(digests)
+
+    @staticmethod
+    def _read(read, start, end, size):
+        off = start
+        while end is None or off < end:
+            chunk = read(off, size if end is None else min(size, end - off))
+            if not len(chunk):
+                return
+            yield chunk
+            off += len(chunk)
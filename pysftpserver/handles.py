@@ -0,0 +1,133 @@
+"""Allocation and state of the handles returned to the clients."""
+
+import struct
+import threading
+import time
+
+_handle_id = struct.Struct('>II')
+
+_FREE = object()  # marks the released slots
+
+
+class SFTPHandle(object):
+    """The state of an open file or directory.
+
+    Attributes:
+        id (bytes): The handle id known to the client.
+        handle: The handle returned by the storage open or opendir.
+        filename (bytes): The path of the file or directory.
+        is_dir (bool): True if the handle has been created by opendir.
+        writable (bool): True if the file has been opened for writing.
+        read_hooked, write_hooked, readdir_hooked (bool): Whether the
+            corresponding hook method has already been called.
+        bytes_read, bytes_written (int): The transferred bytes.
+        opened_at, accessed_at (float): When the handle has been opened and
+            when it has been read or written last.
+        readahead: The state of the read-ahead, see SFTPReadAhead.
+        write_buffer (list): The chunks waiting to be written at
+            write_offset, write_size bytes in all, see SFTPWriteBehind.
+        checksum: The running hash of the data written so far, from the
+            start of the file and in order, checksum_size bytes in all.
+            None if unknown or not computed.
+    """
+
+    __slots__ = ('id', 'handle', 'filename', 'is_dir', 'writable',
+                 'read_hooked', 'write_hooked', 'readdir_hooked',
+                 'bytes_read', 'bytes_written', 'opened_at', 'accessed_at',
+                 'readahead', 'write_buffer', 'write_offset',
+                 'write_size', 'checksum', 'checksum_size')
+
+    def __init__(self, handle, filename, is_dir=False):
+        self.id = None
+        self.handle = handle
+        self.filename = filename
+        self.is_dir = is_dir
+        self.writable = False
+        self.read_hooked = False
+        self.write_hooked = False
+        self.readdir_hooked = False
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.opened_at = self.accessed_at = time.time()
+        self.readahead = None
+        self.write_buffer = None
+        self.write_offset = 0
+        self.write_size = 0
+        self.checksum = None
+        self.checksum_size = 0
+
+
+class SFTPHandleTable(object):
+    """Map compact, fixed width handle ids to the objects they refer to.
+
+    Each id packs the index of a slot and the generation of that slot.
+    Released slots are reused by the following allocations, while their
+    generation is increased: a stale id, whose slot has been reused in
+    the meantime, is thus unknown to the table.
+    Allocations and releases can be performed by concurrent threads.
+    """
+
+    def __init__(self):
+        self.values = []
+        self.generations = []
+        self.free_slots = []
+        self.lock = threading.Lock()
+
+    def add(self, value):
+        """Store value in a free slot.
+
+        Args:
+            value: The object the new handle refers to.
+
+        Returns:
+            (bytes): The id of the newly created handle.
+        """
+        with self.lock:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.values[slot] = value
+            else:
+                slot = len(self.values)
+                self.values.append(value)
+                self.generations.append(0)
+            return _handle_id.pack(slot, self.generations[slot])
+
+    def _slot(self, handle_id):
+        """Return the slot of a live handle id, raise KeyError otherwise."""
+        if len(handle_id) == _handle_id.size:
+            slot, generation = _handle_id.unpack(handle_id)
+            if (slot < len(self.values) and
+                    self.generations[slot] == generation and
+                    self.values[slot] is not _FREE):
+                return slot
+        raise KeyError(handle_id)
+
+    def __getitem__(self, handle_id):
+        return self.values[self._slot(handle_id)]
+
+    def __contains__(self, handle_id):
+        try:
+            self._slot(handle_id)
+        except KeyError:
+            return False
+        return True
+
+    def __delitem__(self, handle_id):
+        with self.lock:
+            slot = self._slot(handle_id)
+            self.values[slot] = _FREE
+            self.generations[slot] = (
+                self.generations[slot] + 1) & 0xffffffff
+            self.free_slots.append(slot)
+
+    def __len__(self):
+        return len(self.values) - len(self.free_slots)
+
+    def __iter__(self):
+        # a snapshot of the live ids: handles can be released meanwhile
+        with self.lock:
+            return iter([
+                _handle_id.pack(slot, self.generations[slot])
+                for slot, value in enumerate(self.values)
+                if value is not _FREE
+            ])
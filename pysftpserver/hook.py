@@ -6,7 +6,8 @@ class SFTPHook(object):
     """A collection of callbacks hooked to specific methods on the server.
 
     Each method is named according to the server method to which it is
-    hooked.
+    hooked. The attrs arguments are SFTPAttributes, which can be accessed as
+    dictionaries too.
     """
 
     def init(self, server):
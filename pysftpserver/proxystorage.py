@@ -3,7 +3,7 @@
 import paramiko
 
 from pysftpserver.abstractstorage import SFTPAbstractServerStorage
-from pysftpserver.stat_helpers import stat_to_longname
+from pysftpserver.attributes import SFTPAttributes
 
 import os
 import sys
@@ -229,7 +229,7 @@ class SFTPServerProxyStorage(SFTPAbstractServerStorage):
     def stat(self, filename, parent=None, lstat=False, fstat=False):
         """stat, lstat and fstat requests.
 
-        Return a dictionary of stats.
+        Return the attributes of the file (see SFTPAttributes).
         Filename is an handle in the fstat variant.
         """
         if not lstat and fstat:
@@ -252,22 +252,9 @@ class SFTPServerProxyStorage(SFTPAbstractServerStorage):
                     else os.path.join(parent, filename)
                 )
 
-        if fstat:
-            longname = None  # not needed in case of fstat
-        else:
-            longname = stat_to_longname(  # see stat_helpers.py
-                _stat, filename
-            )
-
-        return {
-            b'size': _stat.st_size,
-            b'uid': _stat.st_uid,
-            b'gid': _stat.st_gid,
-            b'perm': _stat.st_mode,
-            b'atime': _stat.st_atime,
-            b'mtime': _stat.st_mtime,
-            b'longname': longname
-        }
+        # the longname is not needed in case of fstat, and it's only
+        # formatted when needed otherwise: see attributes.py
+        return SFTPAttributes.from_stat(_stat, None if fstat else filename)
 
     @exception_wrapper
     def setstat(self, filename, attrs, fsetstat=False):
@@ -367,6 +354,12 @@ class SFTPServerProxyStorage(SFTPAbstractServerStorage):
         handle.seek(off)
         return handle.read(size)
 
+    @exception_wrapper
+    def readv(self, handle, ranges):
+        """Read from the handle each (offset, size) of ranges,
+        pipelining the requests to the remote server."""
+        return list(handle.readv(ranges))
+
     @exception_wrapper
     def close(self, handle):
         """Close the file handle."""
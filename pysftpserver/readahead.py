@@ -0,0 +1,126 @@
+"""Sequential read-ahead of the file handles."""
+
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class _Stream(object):
+    """The read-ahead state of a single handle."""
+
+    __slots__ = ('lock', 'next_offset', 'size', 'streak', 'end', 'eof',
+                 'chunks')
+
+    def __init__(self):
+        self.lock = threading.Lock()  # serializes the storage reads
+        self.next_offset = None  # where the next sequential read starts
+        self.size = 0  # the size of the sequential reads
+        self.streak = 0  # how many sequential reads we've seen
+        self.end = 0  # where the prefetched chunks end
+        self.eof = False  # a prefetched chunk hit the end of file
+        self.chunks = collections.OrderedDict()  # offset -> future
+
+
+class SFTPReadAhead(object):
+    """Detect the handles read sequentially and prefetch their next chunks
+    in background threads.
+
+    Once a handle has been read sequentially trigger times, up to chunks
+    reads of the same size are issued in advance, so that the following
+    requests are served from memory. The prefetched data of all the handles
+    never exceeds memory bytes.
+    Any storage is supported: its reads of the same handle are serialized.
+    """
+
+    trigger = 2
+
+    def __init__(self, storage, chunks=8, memory=8 * 1024 * 1024, threads=2):
+        self.storage = storage
+        self.chunks = chunks
+        self.memory = memory
+        self.buffered = 0  # bytes reserved by the prefetched chunks
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(threads)
+
+    def _reserve(self, size):
+        with self.lock:
+            if self.buffered + size > self.memory:
+                return False
+            self.buffered += size
+            return True
+
+    def _release(self, size):
+        with self.lock:
+            self.buffered -= size
+
+    def _fetch(self, stream, handle, off, size):
+        with stream.lock:
+            return self.storage.read(handle, off, size)
+
+    def read(self, record, off, size):
+        """Read from a handle, possibly from the prefetched chunks.
+
+        Args:
+            record (SFTPHandle): The state of the handle.
+            off (int): The offset to read from.
+            size (int): How many bytes to read.
+
+        Returns:
+            (bytes): The data read.
+        """
+        stream = record.readahead
+        if stream is None:
+            stream = record.readahead = _Stream()
+        if off != stream.next_offset or size != stream.size:
+            self.discard(record)  # not (or no more) sequential
+        stream.streak += 1
+        stream.next_offset = off + size
+        stream.size = size
+
+        chunk = None
+        future = stream.chunks.pop(off, None)
+        if future is not None:
+            self._release(size)
+            try:
+                chunk = future.result()
+            except Exception:
+                pass  # let's try again, see below
+        if chunk is None:
+            chunk = self._fetch(stream, record.handle, off, size)
+        if len(chunk) < size:
+            stream.eof = True
+
+        if stream.streak >= self.trigger and not stream.eof:
+            start = max(stream.end, off + size)
+            limit = off + size * (self.chunks + 1)
+            while start < limit and self._reserve(size):
+                stream.chunks[start] = self.executor.submit(
+                    self._fetch, stream, record.handle, start, size)
+                start += size
+            stream.end = start
+        return chunk
+
+    def discard(self, record):
+        """Drop the prefetched chunks of a handle.
+
+        Must be called before writing, truncating or closing the handle:
+        the running prefetches are waited for.
+
+        Args:
+            record (SFTPHandle): The state of the handle.
+        """
+        stream = record.readahead
+        if stream is None:
+            return
+        for future in stream.chunks.values():
+            if not future.cancel():
+                try:
+                    future.result()
+                except Exception:
+                    pass
+            self._release(stream.size)
+        stream.chunks.clear()
+        stream.next_offset = None
+        stream.streak = 0
+        stream.end = 0
+        stream.eof = False
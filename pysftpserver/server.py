@@ -8,14 +8,31 @@ Python 2/3 compatibility:
     are bytes too.
 """
 
+import collections
+import copy
 import errno
+import functools
+import itertools
 import os
 import select
 import struct
 import sys
-
+import time
+
+from pysftpserver.abstractstorage import absolute_path, get_shortcut
+from pysftpserver.attributes import (SSH2_FILEXFER_ATTR_ACMODTIME,
+                                     SSH2_FILEXFER_ATTR_EXTENDED,
+                                     SSH2_FILEXFER_ATTR_PERMISSIONS,
+                                     SSH2_FILEXFER_ATTR_SIZE,
+                                     SSH2_FILEXFER_ATTR_UIDGID,
+                                     SFTPAttributes)
+from pysftpserver.checkfile import ALGORITHMS, SFTPFileHasher
+from pysftpserver.handles import SFTPHandle, SFTPHandleTable
 from pysftpserver.pysftpexceptions import (SFTPException, SFTPForbidden,
                                            SFTPNotFound)
+from pysftpserver.readahead import SFTPReadAhead
+from pysftpserver.workers import SFTPWorkerPool
+from pysftpserver.writebehind import SFTPWriteBehind
 
 SSH2_FX_OK = 0
 SSH2_FX_EOF = 1
@@ -52,6 +69,7 @@ SSH2_FXP_NAME = 104
 SSH2_FXP_ATTRS = 105
 
 SSH2_FXP_EXTENDED = 200
+SSH2_FXP_EXTENDED_REPLY = 201
 
 SSH2_FILEXFER_VERSION = 3
 
@@ -62,33 +80,127 @@ SSH2_FXF_CREAT = 0x00000008
 SSH2_FXF_TRUNC = 0x00000010
 SSH2_FXF_EXCL = 0x00000020
 
-SSH2_FILEXFER_ATTR_SIZE = 0x00000001
-SSH2_FILEXFER_ATTR_UIDGID = 0x00000002
-SSH2_FILEXFER_ATTR_PERMISSIONS = 0x00000004
-SSH2_FILEXFER_ATTR_ACMODTIME = 0x00000008
-SSH2_FILEXFER_ATTR_EXTENDED = 0x80000000
+_uint32 = struct.Struct('>I')
+_uint64 = struct.Struct('>Q')
+_msg_header = struct.Struct('>IB')
+_data_header = struct.Struct('>IBII')
+_read_request = struct.Struct('>IBII')  # length, type, id, handle length
+_read_range = struct.Struct('>QI')  # offset, size
 
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = -1
+if _IOV_MAX <= 0:
+    _IOV_MAX = 1024
 
-class SFTPServer(object):
 
-    def __init__(self, storage, hook=None, logfile=None, fd_in=0, fd_out=1,
-                 raise_on_error=False):
-        self.input_queue = b''
-        self.output_queue = b''
-        self.payload = b''
-        self.fd_in = fd_in
-        self.fd_out = fd_out
-        self.buffer_size = 8192
+class _FileRegion(object):
+    """A slice of a file queued in the output, in place of its data."""
+
+    __slots__ = ('fd', 'offset', 'size')
+
+    def __init__(self, fd, offset, size):
+        self.fd = fd
+        self.offset = offset
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def read(self):
+        """Read the data of the region, padded with zeros if the file
+        has been truncated in the meantime."""
+        if hasattr(os, 'pread'):
+            data = os.pread(self.fd, self.size, self.offset)
+        else:
+            os.lseek(self.fd, self.offset, os.SEEK_SET)
+            data = os.read(self.fd, self.size)
+        return data + b'\0' * (self.size - len(data))
+
+
+class _OutputBuffer(bytearray):
+    """A DATA message allocated by the server, reused once written."""
+
+
+class SFTPProtocol(object):
+    """The transport independent core of the SFTP server.
+
+    Bytes received from the client are passed to feed, which returns the
+    buffers to send back: any event loop (or an in-process benchmark) can
+    drive it. See SFTPServer for the one reading stdin and writing stdout.
+    """
+
+    # requests on a handle, kept in order when they are run by workers
+    handle_requests = frozenset([
+        SSH2_FXP_CLOSE, SSH2_FXP_READ, SSH2_FXP_WRITE, SSH2_FXP_FSTAT,
+        SSH2_FXP_FSETSTAT, SSH2_FXP_READDIR
+    ])
+    # requests that workers can run in any order, unless they would
+    # overtake a change of the filesystem (see request_lane)
+    concurrent_requests = frozenset([
+        SSH2_FXP_REALPATH, SSH2_FXP_STAT, SSH2_FXP_LSTAT, SSH2_FXP_READLINK,
+        SSH2_FXP_OPENDIR
+    ])
+    # extended requests reading whole files, never run by the thread
+    # serving the others
+    background_requests = frozenset([b'check-file-handle', b'check-file-name'])
+    # queue the data read from the storage as file regions (see SFTPServer)
+    sendfile = False
+
+    def __init__(self, storage, hook=None, logfile=None, raise_on_error=False,
+                 readdir_size=32768, workers=0, readahead=0,
+                 readahead_memory=8 * 1024 * 1024, writebehind=0,
+                 coalesce_reads=256 * 1024, max_packet_length=256 * 1024,
+                 max_open_handles=0, checksum=None):
+        self._input = bytearray()  # received bytes, consumed in place
+        self._output = collections.deque()  # buffers waiting to be written
+        self._output_offset = 0  # bytes of the first buffer already written
+        self.payload = b''  # view over the packet being processed
+        self.payload_offset = 0  # read cursor inside the payload
+        self.readdir_size = readdir_size  # bytes of entries per NAME message
         self.storage = storage
         self.hook = hook
-        self.handles = dict()
-        self.dirs = dict()  # keep the path of opened dirs to rebuild it later
-        self.files = dict()
-        self.readdir_handles = set()
-        self.read_handles = set()
-        self.write_handles = set()
-        self.handle_cnt = 0
+        self.handles = SFTPHandleTable()  # handle id -> SFTPHandle
         self.raise_on_error = raise_on_error
+        # with workers, storage calls run in threads and are answered
+        # as soon as they complete
+        self.workers = SFTPWorkerPool(workers) if workers else None
+        # without workers, the requests that take long run in a background
+        # thread, along with the ones that must wait for them (see
+        # in_background): created when first needed
+        self.background = None
+        # prefetch up to readahead chunks of the handles read sequentially,
+        # keeping at most readahead_memory bytes in memory
+        self.readahead = SFTPReadAhead(
+            storage, readahead, readahead_memory) if readahead else None
+        # acknowledge contiguous writes, collecting up to writebehind bytes
+        # per handle before writing them
+        self.writebehind = SFTPWriteBehind(
+            storage, writebehind) if writebehind else None
+        # contiguous READs already received on the same handle are served
+        # by a single storage readv or read, of up to coalesce_reads bytes
+        self.coalesce_reads = coalesce_reads
+        # DATA messages already written, filled again by storage.read_into
+        self.spare_buffers = []
+        # used in place of storage.read and storage.write, unless the
+        # storage overrides them (see get_shortcut)
+        self.read_into = get_shortcut(storage, 'read_into', 'read')
+        self.readv = get_shortcut(storage, 'readv', 'read')
+        self.write_memoryview = bool(
+            get_shortcut(storage, 'write_memoryview', 'write'))
+        # advertised through limits@openssh.com: clients size their
+        # requests accordingly (0 open handles means no limit)
+        self.max_packet_length = max_packet_length
+        self.max_read_length = max_packet_length - 1024
+        self.max_write_length = max_packet_length - 1024
+        self.max_open_handles = max_open_handles
+        self.hasher = SFTPFileHasher()  # serves check-file
+        # hash the files written sequentially with this algorithm (e.g.
+        # b'sha256') and store the digest through storage.set_checksum
+        if checksum is not None and checksum not in ALGORITHMS:
+            raise ValueError('unsupported checksum algorithm')
+        self.checksum = checksum
         self.logfile = None
         if logfile:
             self.logfile = open(logfile, 'a')
@@ -102,43 +214,49 @@ class SFTPServer(object):
 
         Optional Args:
             flags (int): a series of binary flags combined in a single integer.
-            attrs (dict): valid only for files, used to indicate permissions.
+            attrs (SFTPAttributes): valid only for files, used to indicate
+                permissions.
             is_opendir (bool): specify if filename refers to a directory or a
                 file (default).
 
         Returns:
             (bytes): The id of the newly created handle.
         """
+        self.check_open_handles()
         if is_opendir:
             handle = self.storage.opendir(filename)
         else:
-            os_flags = 0x00000000
-            if flags & SSH2_FXF_READ and flags & SSH2_FXF_WRITE:
-                os_flags |= os.O_RDWR
-            elif flags & SSH2_FXF_READ:
-                os_flags |= os.O_RDONLY
-            elif flags & SSH2_FXF_WRITE:
-                os_flags |= os.O_WRONLY
-            if flags & SSH2_FXF_APPEND:
-                os_flags |= os.O_APPEND
-            if flags & SSH2_FXF_CREAT:
-                os_flags |= os.O_CREAT
-            if flags & SSH2_FXF_TRUNC and flags & SSH2_FXF_CREAT:
-                os_flags |= os.O_TRUNC
-            if flags & SSH2_FXF_EXCL and flags & SSH2_FXF_CREAT:
-                os_flags |= os.O_EXCL
             mode = attrs.get(b'perm', 0o666)
-            handle = self.storage.open(filename, os_flags, mode)
-        if self.handle_cnt == 0xffffffffffffffff:
-            raise OverflowError()
-        self.handle_cnt += 1
-        handle_id = bytes(self.handle_cnt)
-        self.handles[handle_id] = handle
-        if is_opendir:
-            self.dirs[handle_id] = filename
-        else:
-            self.files[handle_id] = filename
-        return handle_id
+            handle = self.storage.open(
+                filename, self.get_os_flags(flags), mode)
+        return self.add_handle(handle, filename, is_dir=is_opendir)
+
+    def check_open_handles(self):
+        """Make sure that another handle can be opened.
+
+        Raises:
+            SFTPException: If max_open_handles are already open.
+        """
+        if self.max_open_handles and \
+                len(self.handles) >= self.max_open_handles:
+            raise SFTPException(b'too many open handles')
+
+    def add_handle(self, handle, filename, is_dir=False):
+        """Keep track of a handle returned by the storage.
+
+        Args:
+            handle: The handle returned by the storage open or opendir.
+            filename (bytes): The path of the file or directory.
+
+        Optional Args:
+            is_dir (bool): True if handle refers to a directory.
+
+        Returns:
+            (bytes): The id of the handle.
+        """
+        record = SFTPHandle(handle, filename, is_dir=is_dir)
+        record.id = self.handles.add(record)
+        return record.id
 
     def get_filename_from_handle_id(self, handle_id):
         """Recover the name of a file or directory from its handle id.
@@ -153,11 +271,38 @@ class SFTPServer(object):
             (bool): True if the recovered filename is a directory. False if
                 it is a file. None if nothing is found.
         """
-        if handle_id in self.dirs:
-            return self.dirs[handle_id], True
-        if handle_id in self.files:
-            return self.files[handle_id], False
-        return None, None
+        try:
+            record = self.handles[handle_id]
+        except KeyError:
+            return None, None
+        return record.filename, record.is_dir
+
+    @staticmethod
+    def get_os_flags(flags):
+        """Convert the SSH2_FXF_* file opening flags to the os module ones.
+
+        Args:
+            flags (int): The flags integer value.
+
+        Returns:
+            (int): The os.O_* flags.
+        """
+        os_flags = 0x00000000
+        if flags & SSH2_FXF_READ and flags & SSH2_FXF_WRITE:
+            os_flags |= os.O_RDWR
+        elif flags & SSH2_FXF_READ:
+            os_flags |= os.O_RDONLY
+        elif flags & SSH2_FXF_WRITE:
+            os_flags |= os.O_WRONLY
+        if flags & SSH2_FXF_APPEND:
+            os_flags |= os.O_APPEND
+        if flags & SSH2_FXF_CREAT:
+            os_flags |= os.O_CREAT
+        if flags & SSH2_FXF_TRUNC and flags & SSH2_FXF_CREAT:
+            os_flags |= os.O_TRUNC
+        if flags & SSH2_FXF_EXCL and flags & SSH2_FXF_CREAT:
+            os_flags |= os.O_EXCL
+        return os_flags
 
     @staticmethod
     def get_explicit_flags(flags):
@@ -187,6 +332,28 @@ class SFTPServer(object):
             explicit_flags.add('EXCL')
         return explicit_flags
 
+    @property
+    def input_queue(self):
+        """The received bytes that have not been processed yet."""
+        return bytes(self._input)
+
+    @input_queue.setter
+    def input_queue(self, value):
+        self._input = bytearray(value)
+
+    @property
+    def output_queue(self):
+        """The bytes that have not been written yet."""
+        self.read_regions()
+        return b''.join(self._output)[self._output_offset:]
+
+    @output_queue.setter
+    def output_queue(self, value):
+        self._output.clear()
+        self._output_offset = 0
+        if value:
+            self._output.append(value)
+
     def log(self, txt):
         if not self.logfile:
             return
@@ -199,8 +366,8 @@ class SFTPServer(object):
         Returns:
             (int): The extracted integer value.
         """
-        value, = struct.unpack('>I', self.payload[0:4])
-        self.payload = self.payload[4:]
+        value, = _uint32.unpack_from(self.payload, self.payload_offset)
+        self.payload_offset += 4
         return value
 
     def consume_int64(self):
@@ -209,8 +376,8 @@ class SFTPServer(object):
         Returns:
             (int): The extracted integer value.
         """
-        value, = struct.unpack('>Q', self.payload[0:8])
-        self.payload = self.payload[8:]
+        value, = _uint64.unpack_from(self.payload, self.payload_offset)
+        self.payload_offset += 8
         return value
 
     def consume_string(self):
@@ -220,9 +387,21 @@ class SFTPServer(object):
             (bytes): The extracted string value in bytes.
         """
         slen = self.consume_int()
-        s = self.payload[0:slen]
-        self.payload = self.payload[slen:]
-        return s
+        start = self.payload_offset
+        self.payload_offset += slen
+        return self.payload[start:start + slen].tobytes()
+
+    def consume_string_view(self):
+        """Extract a string from the payload, without copying it.
+
+        Returns:
+            (memoryview): The extracted string value, valid only while the
+                current request is processed.
+        """
+        slen = self.consume_int()
+        start = self.payload_offset
+        self.payload_offset += slen
+        return self.payload[start:start + slen]
 
     def consume_handle_and_id(self):
         """Recover a handle extracting its id from the payload.
@@ -230,31 +409,39 @@ class SFTPServer(object):
         Returns:
             (bytes, bytes): The extracted integer value.
         """
-        handle_id = self.consume_string()
-        return self.handles[handle_id], handle_id
+        record = self.consume_handle()
+        return record.handle, record.id
+
+    def consume_handle(self):
+        """Recover the state of a handle extracting its id from the payload.
+
+        Returns:
+            (SFTPHandle): The state of the handle.
+        """
+        return self.handles[self.consume_string()]
 
     def consume_attrs(self):
         """Extract and decode a series of file attributes from the payload.
 
         Returns:
-            (dict): Map each extracted file attribute to its value.
+            (SFTPAttributes): The extracted file attributes.
         """
-        attrs = {}
+        attrs = SFTPAttributes()
         flags = self.consume_int()
         if flags & SSH2_FILEXFER_ATTR_SIZE:
-            attrs[b'size'] = self.consume_int64()
+            attrs.size = self.consume_int64()
         if flags & SSH2_FILEXFER_ATTR_UIDGID:
-            attrs[b'uid'] = self.consume_int()
-            attrs[b'gid'] = self.consume_int()
+            attrs.uid = self.consume_int()
+            attrs.gid = self.consume_int()
         if flags & SSH2_FILEXFER_ATTR_PERMISSIONS:
-            attrs[b'perm'] = self.consume_int()
+            attrs.perm = self.consume_int()
         if flags & SSH2_FILEXFER_ATTR_ACMODTIME:
-            attrs[b'atime'] = self.consume_int()
-            attrs[b'mtime'] = self.consume_int()
+            attrs.atime = self.consume_int()
+            attrs.mtime = self.consume_int()
         if flags & SSH2_FILEXFER_ATTR_EXTENDED:
             count = self.consume_int()
             if count:
-                attrs[b'extended'] = [
+                attrs.extended = [
                     {self.consume_string(): self.consume_string()}
                     for i in range(count)
                 ]
@@ -270,6 +457,21 @@ class SFTPServer(object):
             SftpNotFound: No file exists with the input filename.
             SftpForbidden: The input filename position can not be accessed.
         """
+        filename = self.consume_path(default)
+        if self.storage.verify(filename):
+            return filename
+        raise SFTPForbidden()
+
+    def consume_path(self, default=None):
+        """Extract a filename from the payload, without verifying it (see
+        consume_filename).
+
+        Returns:
+            (bytes): The extracted filename.
+
+        Exceptions:
+            SftpNotFound: The filename is empty, and there's no default.
+        """
         filename = self.consume_string()
         if filename == b'.':
             filename = self.storage.home.encode()
@@ -278,36 +480,59 @@ class SFTPServer(object):
                 filename = default
             else:
                 raise SFTPNotFound()
-        if self.storage.verify(filename):
-            return filename
-        raise SFTPForbidden()
+        return filename
 
     def encode_attrs(self, attrs):
         """Pack a series of file attributes in a single bytes string.
 
+        Args:
+            attrs (SFTPAttributes): The attributes, or a dict with the same
+                keys (as returned by older storages).
+
         Returns:
             (bytes): The string in which the file attributes are packed.
         """
-        flags = (SSH2_FILEXFER_ATTR_SIZE |
-                 SSH2_FILEXFER_ATTR_UIDGID |
-                 SSH2_FILEXFER_ATTR_PERMISSIONS |
-                 SSH2_FILEXFER_ATTR_ACMODTIME)
-        return struct.pack('>IQIIIII', flags,
-                           attrs[b'size'],
-                           attrs[b'uid'],
-                           attrs[b'gid'],
-                           attrs[b'perm'],
-                           int(attrs[b'atime']),
-                           int(attrs[b'mtime']))
-
-    def send_msg(self, msg):
+        if not isinstance(attrs, SFTPAttributes):
+            attrs = SFTPAttributes.from_dict(attrs)
+        return attrs.encode()
+
+    def send_msg(self, msg, *data):
         """Append a message to the output queue.
 
         Args:
             msg (bytes): The message to enqueue.
+
+        Optional Args:
+            data (bytes): Buffers completing the message, enqueued as they
+                are (i.e. without being copied).
         """
-        msg_len = struct.pack('>I', len(msg))
-        self.output_queue += msg_len + msg
+        msg_len = len(msg)
+        for buf in data:
+            msg_len += len(buf)
+        self._output.append(_uint32.pack(msg_len) + msg)
+        self._output.extend(data)
+
+    def extensions(self):
+        """Return the extensions advertised to the client.
+
+        Returns:
+            (list): The (name, data) of each extension.
+        """
+        extensions = [(b'limits@openssh.com', b'1')]
+        if b'copy-data' in self.extended_table and \
+                getattr(self.storage, 'copy_data', None):
+            extensions.append((b'copy-data', b'1'))
+        if b'check-file-handle' in self.extended_table:
+            extensions.append((b'check-file', b','.join(ALGORITHMS)))
+        return extensions
+
+    def send_version(self):
+        """Answer to INIT with the protocol version and the extensions."""
+        msg = struct.pack('>BI', SSH2_FXP_VERSION, SSH2_FILEXFER_VERSION)
+        self.send_msg(msg, *(
+            _uint32.pack(len(value)) + value
+            for extension in self.extensions() for value in extension
+        ))
 
     def send_status(self, sid, status, exc=None):
         if status != SSH2_FX_OK and self.raise_on_error:
@@ -321,71 +546,480 @@ class SFTPServer(object):
             msg += struct.pack('>I', 0)
         self.send_msg(msg)
 
-    def send_data(self, sid, buf, size):
-        msg = struct.pack('>BII', SSH2_FXP_DATA, sid, size)
-        msg += buf
+    def send_attrs(self, sid, attrs):
+        msg = struct.pack('>BI', SSH2_FXP_ATTRS, sid)
+        msg += self.encode_attrs(attrs)
         self.send_msg(msg)
 
-    def run(self):
-        """Keep the server active until the buffer is empty or an error occurs.
+    def send_handle(self, sid, handle_id):
+        msg = struct.pack('>BII', SSH2_FXP_HANDLE, sid, len(handle_id))
+        msg += handle_id
+        self.send_msg(msg)
+
+    def send_data(self, sid, buf, size):
+        self._output.append(
+            _data_header.pack(9 + size, SSH2_FXP_DATA, sid, size))
+        self._output.append(buf)
+
+    def read_packet(self, sid, handle, off, size):
+        """Read from a handle straight into a DATA message, through the
+        storage read_into.
+
+        The message is allocated once, and reused after it has been
+        written (see SFTPServer.write_output).
+
+        Args:
+            sid (int): The request id.
+            handle: The handle returned by the storage open.
+            off (int): The offset to read from.
+            size (int): How many bytes to read.
+
+        Returns:
+            (memoryview, memoryview): The message and the data it carries,
+                or (None, None) if the storage asks to call read instead.
         """
-        while True:
-            if self.run_once():
-                return
+        start = _data_header.size
+        try:
+            buf = self.spare_buffers.pop()
+        except IndexError:
+            buf = None
+        if buf is None or len(buf) < start + size:
+            buf = _OutputBuffer(start + size)
+        view = memoryview(buf)
+        rlen = self.read_into(handle, off, view[start:start + size])
+        if rlen is None:
+            del view
+            self.spare_buffers.append(buf)
+            return None, None
+        _data_header.pack_into(buf, 0, 9 + rlen, SSH2_FXP_DATA, sid, rlen)
+        return view[:start + rlen], view[start:start + rlen]
+
+    def send_read(self, sid, record, chunk, packet=None):
+        """Answer to a READ with the data read from its handle.
 
-    def run_once(self):
-        wait_write = []
-        if len(self.output_queue) > 0:
-            wait_write = [self.fd_out]
-        rlist, wlist, xlist = select.select([self.fd_in], wait_write, [])
-        if self.fd_in in rlist:
-            buf = os.read(self.fd_in, self.buffer_size)
-            if len(buf) <= 0:
-                return True
-            self.input_queue += buf
-            self.process()
-        if self.fd_out in wlist:
-            rlen = os.write(self.fd_out, self.output_queue)
-            if rlen <= 0:
-                return True
-            self.output_queue = self.output_queue[rlen:]
+        Args:
+            sid (int): The request id.
+            record (SFTPHandle): The state of the handle.
+            chunk (bytes): The data read, empty at the end of file.
+
+        Optional Args:
+            packet (memoryview): The whole response, if already packed
+                around chunk (see read_packet).
+        """
+        record.bytes_read += len(chunk)
+        record.accessed_at = time.time()
+        if len(chunk) == 0:
+            self.send_status(sid, SSH2_FX_EOF)
+        elif packet is not None:
+            self._output.append(packet)
+        else:
+            self.send_data(sid, chunk, len(chunk))
+
+    def read_regions(self, fd=None):
+        """Replace the file regions in the output queue with their data.
+
+        Optional Args:
+            fd (int): Only replace the regions of this file descriptor,
+                e.g. before it's written or closed.
+        """
+        output = self._output
+        for i in range(len(output)):
+            region = output[i]
+            if (isinstance(region, _FileRegion) and
+                    (fd is None or region.fd == fd)):
+                output[i] = region.read()
+
+    def feed(self, data):
+        """Process the bytes received from the client.
+
+        With workers, responses can also be completed later on:
+        fetch them with data_to_send when workers.wakeup_fd is readable
+        (background.wakeup_fd without workers, once background is set).
+
+        Args:
+            data (bytes): The received bytes.
+
+        Returns:
+            (list): The buffers to send to the client, in order.
+        """
+        self._input += data
+        self.process()
+        return self.data_to_send()
+
+    def data_to_send(self):
+        """Empty the output queue.
+
+        Returns:
+            (list): The buffers to send to the client, in order.
+        """
+        if self.workers or self.background:
+            self.collect_responses()
+        self.read_regions()
+        output = list(self._output)
+        if self._output_offset:
+            output[0] = memoryview(output[0])[self._output_offset:]
+        self._output.clear()
+        self._output_offset = 0
+        return output
 
     def process(self):
         """Process the input queue, extracting messages and executing commands.
+
+        Packets are decoded in place through a memoryview of the input
+        buffer: the consumed bytes are dropped once, when no more complete
+        messages are available.
         """
-        while True:
-            if len(self.input_queue) < 5:
-                return
-            msg_len, msg_type = struct.unpack('>IB', self.input_queue[0:5])
-            if len(self.input_queue) < msg_len + 4:
-                return
-            self.payload = self.input_queue[5:4 + msg_len]
-            self.input_queue = self.input_queue[msg_len + 4:]
-            if msg_type == SSH2_FXP_INIT:
-                msg = struct.pack(
-                    '>BI', SSH2_FXP_VERSION, SSH2_FILEXFER_VERSION)
-                self.send_msg(msg)
-                self.hook and self.hook.init(self)
+        buf = self._input
+        view = memoryview(buf)
+        pos = 0
+        try:
+            while True:
+                if len(buf) - pos < 5:
+                    return
+                msg_len, msg_type = _msg_header.unpack_from(buf, pos)
+                end = pos + 4 + msg_len
+                if len(buf) < end:
+                    return
+                if (msg_type == SSH2_FXP_READ and self.coalesce_reads and
+                        not self.workers and not self.readahead and
+                        not self.sendfile):
+                    handle_id, reads, reads_end = self.peek_reads(view, pos)
+                    if (len(reads) > 1 and handle_id in self.handles and
+                            not self.lane_busy(handle_id)):
+                        pos = reads_end
+                        self.read_many(self.handles[handle_id], reads)
+                        continue
+                self.payload = view[pos + 5:end]
+                self.payload_offset = 0
+                pos = end
+                if msg_type == SSH2_FXP_INIT:
+                    self.send_version()
+                    self.hook and self.hook.init(self)
+                else:
+                    self.schedule(msg_type, self.consume_int())
+        finally:
+            self.payload = b''
+            del view
+            try:
+                del buf[:pos]
+            except BufferError:
+                # someone is still holding a view over the consumed bytes
+                self._input = bytearray(buf[pos:])
+
+    def peek_reads(self, view, pos):
+        """Look for the contiguous READs on the same handle at the start
+        of the buffered input.
+
+        Args:
+            view (memoryview): The input buffer.
+            pos (int): Where the first READ starts.
+
+        Returns:
+            (bytes, list, int): The handle id, the (id, offset, size) of
+                each READ, up to coalesce_reads bytes in all, and where the
+                last one ends.
+        """
+        handle_id = None
+        reads = []
+        total = 0
+        while len(view) - pos >= _read_request.size:
+            msg_len, msg_type, msg_id, slen = _read_request.unpack_from(
+                view, pos)
+            start = pos + _read_request.size + slen
+            end = pos + 4 + msg_len
+            if (msg_type != SSH2_FXP_READ or len(view) < end or
+                    end < start + _read_range.size):
+                break
+            if handle_id is None:
+                handle_id = view[start - slen:start].tobytes()
+            elif view[start - slen:start] != handle_id:
+                break
+            off, size = _read_range.unpack_from(view, start)
+            size = min(size, self.max_read_length)
+            if reads and (off != reads[-1][1] + reads[-1][2] or
+                          total + size > self.coalesce_reads):
+                break
+            reads.append((msg_id, off, size))
+            total += size
+            pos = end
+        return handle_id, reads, pos
+
+    def read_many(self, record, reads):
+        """Serve contiguous READs on the same handle with a single storage
+        readv (or read, answering each of them with its own slice).
+        The READs past a short or failed read are served one by one, so
+        that each of them fails on its own, as it would through _read.
+
+        Args:
+            record (SFTPHandle): The state of the handle.
+            reads (list): The (id, offset, size) of each READ.
+        """
+        try:
+            if not record.read_hooked:
+                record.read_hooked = True
+                self.hook and self.hook.read(
+                    self, record.id, reads[0][1], reads[0][2])
+        except Exception as e:
+            self.send_error(reads[0][0], e)
+            reads = reads[1:]
+        ranges = [(off, size) for _, off, size in reads]
+        chunks = []
+        try:
+            self.writebehind and self.writebehind.flush(record)
+            if self.readv:
+                chunks = self.readv(record.handle, ranges)
             else:
-                msg_id = self.consume_int()
-                if msg_type in list(self.table.keys()):
-                    try:
-                        self.table[msg_type](self, msg_id)
-                    except SFTPForbidden as e:
-                        self.send_status(msg_id, SSH2_FX_PERMISSION_DENIED, e)
-                    except SFTPNotFound as e:
-                        self.send_status(msg_id, SSH2_FX_NO_SUCH_FILE, e)
-                    except OSError as e:
-                        if e.errno == errno.ENOENT:
-                            self.send_status(
-                                msg_id, SSH2_FX_NO_SUCH_FILE, SFTPNotFound()
-                            )
-                        else:
-                            self.send_status(msg_id, SSH2_FX_FAILURE)
-                    except Exception as e:
-                        self.send_status(msg_id, SSH2_FX_FAILURE)
+                start = ranges[0][0]
+                chunk = memoryview(self.storage.read(
+                    record.handle, start, sum(size for _, size in ranges)))
+                chunks = [chunk[off - start:off - start + size]
+                          for off, size in ranges]
+        except Exception:
+            pass  # read them again one by one, below
+        # a short read is not necessarily the end of file (e.g. the
+        # storage caps the size of its reads): the READs past it are
+        # read again one by one
+        full = True
+        eof = False
+        for i, (sid, off, size) in enumerate(reads):
+            try:
+                if full and i < len(chunks) and len(chunks[i]):
+                    data = chunks[i]
+                    full = len(data) == size
+                elif eof:
+                    data = b''
                 else:
-                    self.send_status(msg_id, SSH2_FX_OP_UNSUPPORTED)
+                    full = False
+                    self.writebehind and self.writebehind.flush(record)
+                    data = self.storage.read(record.handle, off, size)
+                    eof = not len(data)
+                self.send_read(sid, record, data)
+            except Exception as e:
+                self.send_error(sid, e)
+
+    def schedule(self, msg_type, msg_id):
+        """Execute the current request or, if there are workers,
+        hand it to them. Without workers, some requests are handed to the
+        background thread instead (see in_background).
+
+        Args:
+            msg_type (int): The SSH2_FXP_* type of the message.
+            msg_id (int): The request id, used to send the response.
+        """
+        if not self.workers and not self.in_background(msg_type):
+            self.dispatch(msg_type, msg_id)
+            return
+        lane = self.request_lane(msg_type)
+        if isinstance(lane, tuple):
+            # on more lanes at once: wait for all the previous requests
+            self.wait_responses()
+            self.dispatch(msg_type, msg_id)
+            return
+        (self.workers or self.background).submit(
+            lane, self.execute, msg_type, msg_id,
+            self.payload[self.payload_offset:].tobytes()
+        )
+
+    def in_background(self, msg_type):
+        """Check if the current request, once its id has been consumed,
+        runs in the background thread: the background requests do, as
+        well as the ones on the lane of a pending one, which must wait for
+        it (see request_lane).
+
+        Args:
+            msg_type (int): The SSH2_FXP_* type of the message.
+
+        Returns:
+            (bool): True if the request runs in the background thread.
+        """
+        if self.is_background_request(msg_type):
+            if self.background is None:
+                self.background = SFTPWorkerPool(1)
+            return True
+        if not self.background or not self.background.pending:
+            return False
+        lane = self.request_lane(msg_type)
+        if isinstance(lane, tuple):
+            return any(self.background.busy(lane) for lane in lane)
+        return lane is not None and self.background.busy(lane)
+
+    def is_background_request(self, msg_type):
+        """Check if the current request is one of the background_requests,
+        once its id has been consumed.
+
+        Args:
+            msg_type (int): The SSH2_FXP_* type of the message.
+
+        Returns:
+            (bool): True if the request may take long.
+        """
+        if msg_type != SSH2_FXP_EXTENDED:
+            return False
+        try:
+            request = self.peek_string(self.payload_offset)[0]
+        except struct.error:
+            return False  # malformed, let the handler report it
+        return request in self.background_requests
+
+    def request_lane(self, msg_type):
+        """Return the lane of the current request, once its id has been
+        consumed.
+
+        Requests on the same handle share a lane, as well as all the
+        requests changing the filesystem (e.g. open, rename, mkdir).
+        Workers execute the requests of a lane in order. The requests
+        reading a path (e.g. stat) join the lane of the changes while any
+        of them is pending, so that they see its outcome.
+
+        Args:
+            msg_type (int): The SSH2_FXP_* type of the message.
+
+        Returns:
+            (bytes): The handle id, an empty string for the requests that
+                change the filesystem or None for the ones that can run
+                in any order. A tuple of handle ids for the requests on
+                more handles (i.e. copy-data).
+        """
+        if msg_type in self.handle_requests:
+            return self.peek_string(self.payload_offset)[0]
+        if msg_type in self.concurrent_requests:
+            return b'' if self.lane_busy(b'') else None
+        if msg_type == SSH2_FXP_EXTENDED:
+            try:
+                return self.extended_lane()
+            except struct.error:
+                pass  # malformed, let the handler report it
+        return b''
+
+    def lane_busy(self, lane):
+        """Check if some request of a lane is still pending.
+
+        Args:
+            lane (bytes): The lane, see request_lane.
+
+        Returns:
+            (bool): True if a request of the lane hasn't completed yet.
+        """
+        pool = self.workers or self.background
+        return bool(pool) and pool.busy(lane)
+
+    def extended_lane(self):
+        """Return the lane of the current extended request: the one of
+        its handle, if any, see request_lane.
+
+        Returns:
+            (bytes): The lane, a tuple of lanes for copy-data between two
+                different handles.
+        """
+        request, pos = self.peek_string(self.payload_offset)
+        if request == b'check-file-handle':
+            return self.peek_string(pos)[0]
+        if request == b'check-file-name':
+            # a path read, see concurrent_requests
+            return b'' if self.lane_busy(b'') else None
+        if request == b'copy-data':
+            source, pos = self.peek_string(pos)
+            dest = self.peek_string(pos + 16)[0]  # after offset and length
+            return source if source == dest else (source, dest)
+        return b''
+
+    def peek_string(self, pos):
+        """Read a string of the payload, without consuming it.
+
+        Args:
+            pos (int): Where the string starts.
+
+        Returns:
+            (bytes, int): The string and where it ends.
+        """
+        slen, = _uint32.unpack_from(self.payload, pos)
+        start = pos + 4
+        return self.payload[start:start + slen].tobytes(), start + slen
+
+    def execute(self, msg_type, msg_id, payload):
+        """Dispatch a request in a worker thread.
+
+        The request is handled by a shallow copy of the server, owning its
+        payload and its output queue, which is returned.
+        Hooks receive this copy as the server argument.
+
+        Args:
+            msg_type (int): The SSH2_FXP_* type of the message.
+            msg_id (int): The request id, used to send the response.
+            payload (bytes): The rest of the message.
+
+        Returns:
+            (collections.deque): The output of the request.
+        """
+        server = self.fork(payload)
+        server.dispatch(msg_type, msg_id)
+        return server._output
+
+    def fork(self, payload):
+        """Return a shallow copy of the server, owning the payload of a
+        request and its own output queue, so that requests can be handled
+        concurrently.
+
+        Args:
+            payload (bytes): The rest of the message, after its id.
+
+        Returns:
+            (SFTPProtocol): The copy.
+        """
+        server = copy.copy(self)
+        server.payload = memoryview(payload)
+        server.payload_offset = 0
+        server._output = collections.deque()
+        server._output_offset = 0
+        return server
+
+    def collect_responses(self):
+        """Enqueue the responses of the requests completed by the workers
+        (or by the background thread).
+        """
+        for output in (self.workers or self.background).collect():
+            self._output.extend(output)
+
+    def wait_responses(self):
+        """Wait for the workers (or the background thread) to answer to all
+        the pending requests."""
+        pool = self.workers or self.background
+        while pool and pool.pending:
+            pool.wait()
+            self.collect_responses()
+
+    def dispatch(self, msg_type, msg_id):
+        """Execute the command of the current payload and map its errors
+        to the corresponding status messages.
+
+        Args:
+            msg_type (int): The SSH2_FXP_* type of the message.
+            msg_id (int): The request id, used to send the response.
+        """
+        if msg_type not in self.table:
+            self.send_status(msg_id, SSH2_FX_OP_UNSUPPORTED)
+            return
+        try:
+            self.table[msg_type](self, msg_id)
+        except Exception as e:
+            self.send_error(msg_id, e)
+
+    def send_error(self, sid, exc):
+        """Send the status corresponding to the exception raised while
+        executing a request.
+
+        Args:
+            sid (int): The request id.
+            exc (Exception): The exception raised.
+        """
+        if isinstance(exc, SFTPForbidden):
+            self.send_status(sid, SSH2_FX_PERMISSION_DENIED, exc)
+        elif isinstance(exc, SFTPNotFound):
+            self.send_status(sid, SSH2_FX_NO_SUCH_FILE, exc)
+        elif isinstance(exc, OSError) and exc.errno == errno.ENOENT:
+            self.send_status(sid, SSH2_FX_NO_SUCH_FILE, SFTPNotFound())
+        else:
+            self.send_status(sid, SSH2_FX_FAILURE)
 
     def send_dummy_item(self, sid, item, filename):
         # In case of readlink responses
@@ -393,28 +1027,63 @@ class SFTPServer(object):
         # But longname is still needed
         # item is the linked and filename is the link
         attrs = self.storage.stat(filename, lstat=True)
+        self.send_link(sid, item, attrs)
+
+    def send_link(self, sid, item, attrs):
+        """Send the target of a link, see send_dummy_item.
+
+        Args:
+            sid (int): The request id.
+            item (bytes): The target of the link.
+            attrs (SFTPAttributes): The attributes of the link.
+        """
         msg = struct.pack('>BII', SSH2_FXP_NAME, sid, 1)
         msg += struct.pack('>I', len(item)) + item  # filename
-        if b'longname' in attrs and attrs[b'longname']:  # longname
-            longname = attrs[b'longname']
-        else:
-            longname = item
+        longname = attrs.get(b'longname') or item
         msg += struct.pack('>I', len(longname)) + longname
         self.send_msg(msg)
 
-    def send_item(self, sid, item, parent_dir=None):
+    def encode_item(self, item, parent_dir=None):
+        """Pack a filename, its longname and its attributes as a single
+        entry of a SSH2_FXP_NAME message.
+
+        Args:
+            item (bytes): The filename, or an item returned by the opendir
+                iterator of the storage.
+
+        Optional Args:
+            parent_dir (bytes): The directory containing item, in case of
+                readdir responses.
+
+        Returns:
+            (bytes): The packed entry.
+        """
         if parent_dir:  # in case of readdir response
             attrs = self.storage.stat(item, parent=parent_dir)
+            item = getattr(item, 'name', item)
         else:
             attrs = self.storage.stat(item)
+        return self.pack_item(item, attrs)
+
+    def pack_item(self, item, attrs):
+        """Pack a filename and its attributes, see encode_item.
+
+        Args:
+            item (bytes): The filename.
+            attrs (SFTPAttributes): The attributes returned by the storage
+                stat.
+
+        Returns:
+            (bytes): The packed entry.
+        """
+        entry = struct.pack('>I', len(item)) + item  # filename
+        longname = attrs.get(b'longname') or item
+        entry += struct.pack('>I', len(longname)) + longname
+        return entry + self.encode_attrs(attrs)
+
+    def send_item(self, sid, item, parent_dir=None):
         msg = struct.pack('>BII', SSH2_FXP_NAME, sid, 1)
-        msg += struct.pack('>I', len(item)) + item  # filename
-        if b'longname' in attrs and attrs[b'longname']:  # longname
-            longname = attrs[b'longname']
-        else:
-            longname = item
-        msg += struct.pack('>I', len(longname)) + longname
-        msg += self.encode_attrs(attrs)
+        msg += self.encode_item(item, parent_dir)
         self.send_msg(msg)
 
     def _realpath(self, sid):
@@ -426,79 +1095,121 @@ class SFTPServer(object):
         filename = self.consume_filename()
         self.hook and self.hook.stat(self, filename)
         attrs = self.storage.stat(filename)
-        msg = struct.pack('>BI', SSH2_FXP_ATTRS, sid)
-        msg += self.encode_attrs(attrs)
-        self.send_msg(msg)
+        self.send_attrs(sid, attrs)
 
     def _lstat(self, sid):
         filename = self.consume_filename()
         self.hook and self.hook.lstat(self, filename)
         attrs = self.storage.stat(filename, lstat=True)
-        msg = struct.pack('>BI', SSH2_FXP_ATTRS, sid)
-        msg += self.encode_attrs(attrs)
-        self.send_msg(msg)
+        self.send_attrs(sid, attrs)
 
     def _fstat(self, sid):
         handle_id = self.consume_string()
         self.hook and self.hook.fstat(self, handle_id)
-        handle = self.handles[handle_id]
-        attrs = self.storage.stat(handle, fstat=True)
-        msg = struct.pack('>BI', SSH2_FXP_ATTRS, sid)
-        msg += self.encode_attrs(attrs)
-        self.send_msg(msg)
+        record = self.handles[handle_id]
+        self.writebehind and self.writebehind.flush(record)
+        attrs = self.storage.stat(record.handle, fstat=True)
+        self.send_attrs(sid, attrs)
 
     def _setstat(self, sid):
         filename = self.consume_filename()
         attrs = self.consume_attrs()
         self.hook and self.hook.setstat(self, filename, attrs)
+        if self.checksum and b'size' in attrs:
+            for record in self.handles_on(filename):
+                record.checksum = None
         self.storage.setstat(filename, attrs)
         self.send_status(sid, SSH2_FX_OK)
 
     def _fsetstat(self, sid):
         handle_id = self.consume_string()
-        handle = self.handles[handle_id]
+        record = self.handles[handle_id]
         attrs = self.consume_attrs()
         self.hook and self.hook.fsetstat(self, handle_id, attrs)
-        self.storage.setstat(handle, attrs, fsetstat=True)
+        self.readahead and self.readahead.discard(record)
+        self.writebehind and self.writebehind.flush(record)
+        self.sendfile and self.read_regions(
+            self.storage.fileno(record.handle))
+        if b'size' in attrs:
+            record.checksum = None
+        self.storage.setstat(record.handle, attrs, fsetstat=True)
         self.send_status(sid, SSH2_FX_OK)
 
     def _opendir(self, sid):
         filename = self.consume_filename()
         self.hook and self.hook.opendir(self, filename)
         handle_id = self.new_handle(filename, is_opendir=True)
-        msg = struct.pack('>BII', SSH2_FXP_HANDLE, sid, len(handle_id))
-        msg += handle_id
-        self.send_msg(msg)
+        self.send_handle(sid, handle_id)
 
     def _readdir(self, sid):
-        handle, handle_id = self.consume_handle_and_id()
-        if handle_id not in self.readdir_handles:
-            self.readdir_handles.add(handle_id)
-            self.hook and self.hook.readdir(self, handle_id)
-        try:
-            item = next(handle)
-            self.send_item(sid, item, parent_dir=self.dirs[handle_id])
-        except StopIteration:
+        record = self.consume_handle()
+        if not record.readdir_hooked:
+            record.readdir_hooked = True
+            self.hook and self.hook.readdir(self, record.id)
+        handle = record.handle
+        parent_dir = record.filename
+        # fill the response with as many entries as readdir_size allows
+        entries = []
+        size = 0
+        while size < self.readdir_size:
+            try:
+                item = next(handle)
+            except StopIteration:
+                break
+            try:
+                entry = self.encode_item(item, parent_dir=parent_dir)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    continue  # removed while we were listing
+                raise
+            entries.append(entry)
+            size += len(entry)
+        if entries:
+            self.send_msg(
+                struct.pack('>BII', SSH2_FXP_NAME, sid, len(entries)),
+                *entries
+            )
+        else:
             self.send_status(sid, SSH2_FX_EOF)
 
     def _close(self, sid):
         # here we need to hold the handle id
         handle_id = self.consume_string()
-        handle_id in self.readdir_handles and self.readdir_handles.remove(
-            handle_id)
-        handle_id in self.read_handles and self.read_handles.remove(handle_id)
-        handle_id in self.write_handles and self.write_handles.remove(
-            handle_id)
         self.hook and self.hook.close(self, handle_id)
-        handle = self.handles[handle_id]
-        self.storage.close(handle)
-        del(self.handles[handle_id])
-        try:
-            del(self.dirs[handle_id])
-        except KeyError:
-            pass  # dir was not open
+        self.close_handle(self.handles[handle_id])
         self.send_status(sid, SSH2_FX_OK)
 
+    def close_handle(self, record):
+        """Write the pending data of a handle, close it and forget it.
+
+        Args:
+            record (SFTPHandle): The state of the handle.
+        """
+        self.readahead and self.readahead.discard(record)
+        self.sendfile and self.read_regions(
+            self.storage.fileno(record.handle))
+        try:
+            self.writebehind and self.writebehind.flush(record)
+            if record.checksum is not None and \
+                    getattr(self.storage, 'set_checksum', None):
+                self.storage.set_checksum(
+                    record.handle, self.checksum, record.checksum.digest(),
+                    record.checksum_size)
+        finally:
+            self.storage.close(record.handle)
+            del(self.handles[record.id])
+
+    def close_handles(self):
+        """Close all the handles left open, e.g. when the client
+        disconnects: their pending data is still written.
+        Errors are only logged, there's no one to report them to.
+        """
+        for handle_id in self.handles:
+            try:
+                self.close_handle(self.handles[handle_id])
+            except Exception as e:
+                self.log("failed to close a handle: %r" % e)
+
     def _open(self, sid):
         filename = self.consume_filename()
         flags = self.consume_int()
@@ -506,36 +1217,201 @@ class SFTPServer(object):
         self.hook and self.hook.open(
             self, filename, self.get_explicit_flags(flags), attrs)
         handle_id = self.new_handle(filename, flags, attrs)
-        msg = struct.pack('>BII', SSH2_FXP_HANDLE, sid, len(handle_id))
-        msg += handle_id
-        self.send_msg(msg)
+        self.track_writes(self.handles[handle_id], flags)
+        self.send_handle(sid, handle_id)
+
+    def track_writes(self, record, flags):
+        """Mark a handle just opened for writing as such and, with
+        checksum, start hashing the data written to it (see
+        update_checksum).
+
+        A file written through more handles at once is never hashed: the
+        running checksum of each of them would miss the writes of the
+        others.
+
+        Args:
+            record (SFTPHandle): The state of the handle.
+            flags (int): The SSH2_FXF_* flags it has been opened with.
+        """
+        if not flags & SSH2_FXF_WRITE:
+            return
+        record.writable = True
+        if not self.checksum:
+            return
+        others = [other for other in self.handles_on(record.filename)
+                  if other is not record and other.writable]
+        for other in others:
+            other.checksum = None
+        if not others:
+            record.checksum = ALGORITHMS[self.checksum]()
+
+    def handles_on(self, filename):
+        """Return the files open on a path, however it's spelled (see
+        absolute_path).
+
+        Args:
+            filename (bytes): The path.
+
+        Returns:
+            (list): The SFTPHandle of each open file.
+        """
+        path = absolute_path(self.storage, filename)
+        records = []
+        for handle_id in self.handles:
+            try:
+                record = self.handles[handle_id]
+            except KeyError:
+                continue  # closed meanwhile, by a worker
+            if (not record.is_dir and
+                    absolute_path(self.storage, record.filename) == path):
+                records.append(record)
+        return records
 
     def _read(self, sid):
-        handle, handle_id = self.consume_handle_and_id()
+        record = self.consume_handle()
         off = self.consume_int64()
         size = self.consume_int()
-        if handle_id not in self.read_handles:
-            self.read_handles.add(handle_id)
-            self.hook and self.hook.read(self, handle_id, off, size)
-        chunk = self.storage.read(handle, off, size)
-        if len(chunk) == 0:
-            self.send_status(sid, SSH2_FX_EOF)
-        elif len(chunk) > 0:
-            self.send_data(sid, chunk, len(chunk))
-        else:
-            self.send_status(sid, SSH2_FX_FAILURE)
+        size = min(size, self.max_read_length)
+        if not record.read_hooked:
+            record.read_hooked = True
+            self.hook and self.hook.read(self, record.id, off, size)
+        self.writebehind and self.writebehind.flush(record)
+        packet = chunk = None
+        if self.sendfile:
+            fd = self.storage.fileno(record.handle)
+            chunk = _FileRegion(
+                fd, off, max(0, min(size, os.fstat(fd).st_size - off)))
+        elif self.readahead:
+            chunk = self.readahead.read(record, off, size)
+        elif self.read_into:
+            packet, chunk = self.read_packet(sid, record.handle, off, size)
+        if chunk is None:
+            chunk = self.storage.read(record.handle, off, size)
+        self.send_read(sid, record, chunk, packet)
 
     def _write(self, sid):
-        handle, handle_id = self.consume_handle_and_id()
+        record = self.consume_handle()
         off = self.consume_int64()
-        chunk = self.consume_string()
-        if self.storage.write(handle, off, chunk):
+        if self.write_memoryview and not self.writebehind:
+            chunk = self.consume_string_view()
+        else:
+            chunk = self.consume_string()
+        self.readahead and self.readahead.discard(record)
+        self.sendfile and self.read_regions(
+            self.storage.fileno(record.handle))
+        self.update_checksum(record, off, chunk)
+        if self.writebehind:
+            written = self.writebehind.write(record, off, chunk)
+        else:
+            written = self.storage.write(record.handle, off, chunk)
+        if written:
+            record.bytes_written += len(chunk)
+            record.accessed_at = time.time()
             self.send_status(sid, SSH2_FX_OK)
         else:
+            record.checksum = None
             self.send_status(sid, SSH2_FX_FAILURE)
-        if handle_id not in self.write_handles:
-            self.write_handles.add(handle_id)
-            self.hook and self.hook.write(self, handle_id, off)
+        if not record.write_hooked:
+            record.write_hooked = True
+            self.hook and self.hook.write(self, record.id, off)
+
+    def _extended(self, sid):
+        request = self.consume_string()
+        if request not in self.extended_table:
+            self.send_status(sid, SSH2_FX_OP_UNSUPPORTED)
+            return
+        self.extended_table[request](self, sid)
+
+    def _limits(self, sid):
+        self.send_msg(
+            struct.pack('>BI', SSH2_FXP_EXTENDED_REPLY, sid),
+            struct.pack(
+                '>QQQQ', self.max_packet_length, self.max_read_length,
+                self.max_write_length, self.max_open_handles)
+        )
+
+    def _copy_data(self, sid):
+        if not getattr(self.storage, 'copy_data', None):
+            self.send_status(sid, SSH2_FX_OP_UNSUPPORTED)
+            return
+        source = self.consume_handle()
+        read_off = self.consume_int64()
+        length = self.consume_int64()  # 0 means up to the end of file
+        dest = self.consume_handle()
+        write_off = self.consume_int64()
+        if source is dest and (
+                not length or abs(read_off - write_off) < length):
+            raise SFTPException(b'overlapping ranges')
+        if self.writebehind:
+            self.writebehind.flush(source)
+            self.writebehind.flush(dest)
+        self.readahead and self.readahead.discard(dest)
+        self.sendfile and self.read_regions(self.storage.fileno(dest.handle))
+        dest.checksum = None
+        self.storage.copy_data(
+            source.handle, read_off, length, dest.handle, write_off)
+        self.send_status(sid, SSH2_FX_OK)
+
+    def update_checksum(self, record, off, chunk):
+        """Add the data written to a handle to its running checksum, which
+        becomes unknown if the data isn't written sequentially.
+
+        Args:
+            record (SFTPHandle): The state of the handle.
+            off (int): The offset of the data.
+            chunk (bytes): The data.
+        """
+        if record.checksum is None:
+            return
+        if off != record.checksum_size:
+            record.checksum = None  # out of order or overlapping
+            return
+        record.checksum.update(chunk)
+        record.checksum_size += len(chunk)
+
+    def check_file(self, sid, handle):
+        """Answer to a check-file request, once its handle is known.
+
+        Args:
+            sid (int): The request id.
+            handle: The handle returned by the storage open.
+        """
+        algorithm = self.hasher.choose_algorithm(self.consume_string())
+        start = self.consume_int64()
+        length = self.consume_int64()  # 0 means up to the end of file
+        block_size = self.consume_int()  # 0 means a single hash
+        if 0 < block_size < 256:
+            raise SFTPException(b'block size too small')
+        stored = None
+        if not start and not block_size and \
+                getattr(self.storage, 'get_checksum', None):
+            stored = self.storage.get_checksum(handle, algorithm)
+        if stored and (not length or length >= stored[1]):
+            hashes = stored[0]  # computed while the file was written
+        else:
+            hashes = self.hasher.hash(
+                functools.partial(self.storage.read, handle), algorithm,
+                start, length, block_size,
+                max_size=self.max_packet_length - 1024)
+        self.send_msg(
+            struct.pack('>BI', SSH2_FXP_EXTENDED_REPLY, sid),
+            _uint32.pack(10) + b'check-file',
+            _uint32.pack(len(algorithm)) + algorithm,
+            hashes
+        )
+
+    def _check_file_handle(self, sid):
+        record = self.consume_handle()
+        self.writebehind and self.writebehind.flush(record)
+        self.check_file(sid, record.handle)
+
+    def _check_file_name(self, sid):
+        filename = self.consume_filename()
+        handle = self.storage.open(filename, os.O_RDONLY, 0)
+        try:
+            self.check_file(sid, handle)
+        finally:
+            self.storage.close(handle)
 
     def _mkdir(self, sid):
         filename = self.consume_filename()
@@ -597,5 +1473,123 @@ class SFTPServer(object):
         SSH2_FXP_FSETSTAT: _fsetstat,
         SSH2_FXP_RENAME: _rename,
         SSH2_FXP_SYMLINK: _symlink,
-        SSH2_FXP_READLINK: _readlink
+        SSH2_FXP_READLINK: _readlink,
+        SSH2_FXP_EXTENDED: _extended
     }
+
+    extended_table = {
+        b'limits@openssh.com': _limits,
+        b'copy-data': _copy_data,
+        b'check-file-handle': _check_file_handle,
+        b'check-file-name': _check_file_name
+    }
+
+
+class SFTPServer(SFTPProtocol):
+    """The SFTP server, reading requests from fd_in and writing responses to
+    fd_out (by default stdin and stdout, as in a SSH subsystem)."""
+
+    def __init__(self, storage, hook=None, logfile=None, fd_in=0, fd_out=1,
+                 raise_on_error=False, readdir_size=32768, workers=0,
+                 readahead=0, readahead_memory=8 * 1024 * 1024,
+                 writebehind=0, coalesce_reads=256 * 1024, sendfile=False,
+                 max_packet_length=256 * 1024, max_open_handles=0,
+                 checksum=None):
+        super(SFTPServer, self).__init__(
+            storage, hook=hook, logfile=logfile,
+            raise_on_error=raise_on_error, readdir_size=readdir_size,
+            workers=workers, readahead=readahead,
+            readahead_memory=readahead_memory, writebehind=writebehind,
+            coalesce_reads=coalesce_reads,
+            max_packet_length=max_packet_length,
+            max_open_handles=max_open_handles, checksum=checksum
+        )
+        self.fd_in = fd_in
+        self.fd_out = fd_out
+        self.buffer_size = max_packet_length  # a full request per read
+        self.max_spare_buffers = 16
+        # file data is moved from the storage to fd_out by the kernel,
+        # without being copied to Python
+        self.sendfile = bool(
+            sendfile and hasattr(os, 'sendfile') and
+            get_shortcut(storage, 'fileno', 'read') and not self.workers)
+
+    def write_output(self):
+        """Write as much of the output queue as possible to fd_out.
+
+        Queued buffers are handed to a single writev call, so that headers
+        and file data never need to be concatenated, while file regions
+        are sent with os.sendfile.
+
+        Returns:
+            (int): The number of bytes written.
+        """
+        output = self._output
+        if output and isinstance(output[0], _FileRegion):
+            region = output[0]
+            try:
+                rlen = os.sendfile(
+                    self.fd_out, region.fd,
+                    region.offset + self._output_offset,
+                    region.size - self._output_offset)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    raise
+                # e.g. fd_out or the file don't support it: read them all
+                self.sendfile = False
+                self.read_regions()
+                return self.write_output()
+            if not rlen:  # the file has been truncated
+                output[0] = region.read()
+                return self.write_output()
+        elif hasattr(os, 'writev'):
+            buffers = list(itertools.takewhile(
+                lambda buf: not isinstance(buf, _FileRegion),
+                itertools.islice(output, _IOV_MAX)))
+            if self._output_offset:
+                buffers[0] = memoryview(buffers[0])[self._output_offset:]
+            rlen = os.writev(self.fd_out, buffers)
+        else:
+            rlen = os.write(self.fd_out, self.output_queue)
+        # drop the buffers completely written, remember where we stopped
+        written = rlen + self._output_offset
+        while output and written >= len(output[0]):
+            buf = output.popleft()
+            written -= len(buf)
+            buf = getattr(buf, 'obj', None)  # see read_packet
+            if (isinstance(buf, _OutputBuffer) and
+                    len(self.spare_buffers) < self.max_spare_buffers):
+                self.spare_buffers.append(buf)
+        self._output_offset = written
+        return rlen
+
+    def run(self):
+        """Keep the server active until the buffer is empty or an error occurs.
+        """
+        while True:
+            if self.run_once():
+                return
+
+    def run_once(self):
+        wait_read = [self.fd_in]
+        pool = self.workers or self.background
+        if pool:
+            wait_read.append(pool.wakeup_fd)
+        wait_write = []
+        if self._output:
+            wait_write = [self.fd_out]
+        rlist, wlist, xlist = select.select(wait_read, wait_write, [])
+        if self.fd_in in rlist:
+            buf = os.read(self.fd_in, self.buffer_size)
+            if len(buf) <= 0:
+                self.wait_responses()  # the queued requests too
+                pool and pool.shutdown()
+                self.close_handles()
+                return True
+            self._input += buf
+            self.process()
+        if pool and pool.wakeup_fd in rlist:
+            self.collect_responses()
+        if self.fd_out in wlist:
+            if self.write_output() <= 0:
+                return True
@@ -1,4 +1,5 @@
 from stat import *
+import functools
 import time
 
 import pwd
@@ -41,17 +42,59 @@ _paddings = (  # the len of each field of the longname string
 )
 
 
-def filemode(mode):
-    """Convert a file's mode to a string of the form '-rwxrwxrwx'."""
+_longname_format = ' '.join(
+    '{:<%d}' % padding for padding in _paddings) + ' {}'
+
+
+def _walk_filemode(mode, tables):
     perm = []
-    for table in _filemode_table:
+    for table in tables:
         for bit, char in table:
             if mode & bit == bit:
                 perm.append(char)
                 break
         else:
             perm.append('-')
-    return ''.join(perm).encode()
+    return ''.join(perm)
+
+
+# the file type character of each S_IFMT value, and the permission string
+# of each of the 4096 combinations of the permission bits
+_filemode_types = tuple(
+    _walk_filemode(fmt << 12, _filemode_table[:1]) for fmt in range(16))
+_filemode_perms = tuple(
+    _walk_filemode(bits, _filemode_table[1:]) for bits in range(0o10000))
+
+
+def _filemode(mode):
+    return _filemode_types[(mode >> 12) & 0o17] + \
+        _filemode_perms[mode & 0o7777]
+
+
+def filemode(mode):
+    """Convert a file's mode to a string of the form '-rwxrwxrwx'."""
+    return _filemode(mode).encode()
+
+
+@functools.lru_cache(maxsize=1024)
+def _user_name(uid):
+    try:
+        return pwd.getpwuid(uid)[0]
+    except KeyError:  # no such user (e.g. files extracted from an archive)
+        return str(uid)
+
+
+@functools.lru_cache(maxsize=1024)
+def _group_name(gid):
+    try:
+        return grp.getgrgid(gid)[0]
+    except KeyError:
+        return str(gid)
+
+
+@functools.lru_cache(maxsize=1024)
+def _date(minute):
+    return time.strftime('%b %d %H:%M', time.gmtime(minute * 60))
 
 
 def stat_to_longname(st, filename):
@@ -69,21 +112,18 @@ def stat_to_longname(st, filename):
     except:  # Some stats (e.g. SFTPAttributes of paramiko) don't have this
         n_link = str('1')
 
-    longname = [
-        filemode(st.st_mode).decode(),
+    mtime = st.st_mtime
+    if mtime is None:  # as time.gmtime does
+        mtime = time.time()
+
+    # user and group names, as well as dates (shown to the minute), are
+    # looked up once and then cached: a directory usually has few owners
+    return _longname_format.format(
+        _filemode(st.st_mode),
         n_link,
-        pwd.getpwuid(st.st_uid)[0],
-        grp.getgrgid(st.st_gid)[0],
+        _user_name(st.st_uid),
+        _group_name(st.st_gid),
         str(st.st_size),
-        time.strftime('%b %d %H:%M', time.gmtime(st.st_mtime)),
-    ]
-
-    # add needed padding
-    longname = [
-        field + ' ' * (_paddings[i] - len(field))
-        for i, field in enumerate(longname)
-    ]
-    longname.append(filename.decode())  # append the filename
-
-    # and return the string
-    return ' '.join(longname).encode()
+        _date(int(mtime // 60)),
+        filename.decode()
+    ).encode()
@@ -0,0 +1,306 @@
+"""A cache of the stat results of any storage."""
+
+import collections
+import errno
+import functools
+import inspect
+import os
+import threading
+import time
+
+from pysftpserver.abstractstorage import (SFTPAbstractServerStorage,
+                                          absolute_path, get_shortcut)
+
+# open flags that may create or change the file
+_MODIFY_FLAGS = os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_TRUNC | \
+    os.O_APPEND
+
+
+class SFTPStatCache(object):
+    """Wrap a storage, caching the results of its stat method for ttl
+    seconds, up to size paths (the least recently used are evicted first).
+
+    The cached paths are invalidated by the storage methods changing them
+    (setstat, open for writing, write, close, rename, rm, mkdir, rmdir and
+    symlink), i.e. by the requests of the server itself; changes made by
+    others are seen after ttl seconds at most. FSTAT and READDIR are never
+    cached. Paths are normalized first (see absolute_path): 'foo' and
+    '/home/user/foo' share their entry, while the links to a file don't.
+
+    The paths whose stat or open failed with ENOENT are remembered as
+    missing for negative_ttl seconds (0 disables it), however they're
+    spelled: probing them again fails at once. Creating anything in their
+    directory (open with O_CREAT, rename, mkdir or symlink) forgets them.
+
+    Any other attribute is the one of the wrapped storage, e.g.:
+
+        SFTPServer(SFTPStatCache(SFTPServerProxyStorage(...), ttl=5))
+
+    The storage methods must be plain functions (not coroutine functions).
+
+    Attributes:
+        hits (int): The stat calls served by the cache, and the stat and
+            open calls failed because of a missing path.
+        misses (int): The stat calls forwarded to the storage.
+    """
+
+    def __init__(self, storage, ttl=1.0, size=4096, negative_ttl=1.0):
+        for name in ('stat', 'setstat', 'open', 'write', 'writev', 'close',
+                     'rename', 'rm', 'mkdir', 'rmdir', 'symlink',
+                     'copy_data'):
+            if inspect.iscoroutinefunction(getattr(storage, name, None)):
+                raise ValueError('{} is a coroutine function'.format(name))
+        self.storage = storage
+        self.ttl = ttl
+        self.size = size
+        self.cache = collections.OrderedDict()  # (path, lstat) -> entry
+        self.negative_ttl = negative_ttl
+        # path -> (time, lstat failed too), and directory -> missing paths
+        self.missing = collections.OrderedDict()
+        self.missing_dirs = {}
+        self.paths = {}  # handle -> normalized path of the open files
+        self.lock = threading.Lock()
+        # incremented by each invalidation: stats started before one are
+        # not cached, they could be stale
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        # only served if the storage does
+        if getattr(storage, 'copy_data', None):
+            self.copy_data = self._copy_data
+        # write passes the data through, writev stands in for it
+        self.write_memoryview = bool(
+            get_shortcut(storage, 'write_memoryview', 'write'))
+        self._writev = get_shortcut(storage, 'writev', 'write') or \
+            functools.partial(SFTPAbstractServerStorage.writev, storage)
+
+    def __getattr__(self, name):
+        if name == 'storage':  # not set yet
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    def invalidate(self, path, parent=False, subtree=False):
+        """Forget the stat of a path.
+
+        Args:
+            path (bytes): The path.
+
+        Optional Args:
+            parent (bool): Forget the stat of its parent directory too
+                (e.g. when path is created or removed).
+            subtree (bool): Forget the paths inside path too (e.g. when a
+                directory is renamed).
+        """
+        if path is None:
+            return
+        path = absolute_path(self.storage, path)
+        directory = os.path.dirname(path)
+        paths = (path, directory) if parent else (path,)
+        with self.lock:
+            self.generation += 1
+            for p in paths:
+                self.cache.pop((p, False), None)
+                self.cache.pop((p, True), None)
+            if parent:  # something may have been created in directory
+                for p in self.missing_dirs.pop(directory, ()):
+                    del self.missing[p]
+            if subtree:
+                prefix = path.rstrip(b'/') + b'/'
+                for key in [key for key in self.cache
+                            if key[0].startswith(prefix)]:
+                    del self.cache[key]
+                for d in [d for d in self.missing_dirs
+                          if d == path or d.startswith(prefix)]:
+                    for p in self.missing_dirs.pop(d):
+                        del self.missing[p]
+
+    def clear(self):
+        """Forget every cached stat."""
+        with self.lock:
+            self.generation += 1
+            self.cache.clear()
+            self.missing.clear()
+            self.missing_dirs.clear()
+
+    def check_missing(self, path, lstat=False):
+        """Fail if path is known to be missing.
+
+        Args:
+            path (bytes): The path.
+
+        Optional Args:
+            lstat (bool): Fail only if lstat failed too (a dangling
+                symlink can be stat'ed only with lstat).
+
+        Raises:
+            OSError: ENOENT, if path is missing.
+        """
+        if not self.negative_ttl:
+            return
+        path = absolute_path(self.storage, path)
+        with self.lock:
+            entry = self.missing.get(path)
+            if entry is None:
+                return
+            cached_at, lstat_failed = entry
+            if time.monotonic() - cached_at >= self.negative_ttl:
+                self._forget_missing(path)
+                return
+            if lstat and not lstat_failed:
+                return
+            self.hits += 1
+        raise OSError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+
+    def add_missing(self, path, lstat, generation):
+        """Remember that path is missing, see check_missing.
+
+        Args:
+            path (bytes): The path.
+            lstat (bool): If lstat failed (and not stat or open).
+            generation (int): The generation when the failed call started.
+        """
+        if not self.negative_ttl:
+            return
+        path = absolute_path(self.storage, path)
+        with self.lock:
+            if generation != self.generation:
+                return  # something could have been created meanwhile
+            entry = self.missing.pop(path, None)
+            if entry is None:
+                directory = os.path.dirname(path)
+                self.missing_dirs.setdefault(directory, set()).add(path)
+            self.missing[path] = (
+                time.monotonic(), lstat or bool(entry and entry[1]))
+            if len(self.missing) > self.size:
+                self._forget_missing(next(iter(self.missing)))
+
+    def _forget_missing(self, path):
+        del self.missing[path]
+        directory = os.path.dirname(path)
+        paths = self.missing_dirs[directory]
+        paths.discard(path)
+        if not paths:
+            del self.missing_dirs[directory]
+
+    def stat(self, filename, parent=None, lstat=False, fstat=False):
+        """stat, lstat and fstat requests, see the wrapped storage."""
+        if fstat or parent is not None:
+            return self.storage.stat(
+                filename, parent=parent, lstat=lstat, fstat=fstat)
+        key = (absolute_path(self.storage, filename), bool(lstat))
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is not None:
+                cached_at, attrs = entry
+                if time.monotonic() - cached_at < self.ttl:
+                    self.cache.move_to_end(key)
+                    self.hits += 1
+                    return attrs
+                del self.cache[key]
+        self.check_missing(filename, lstat)
+        with self.lock:
+            self.misses += 1
+            generation = self.generation
+        try:
+            attrs = self.storage.stat(filename, lstat=lstat)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                self.add_missing(filename, bool(lstat), generation)
+            raise
+        with self.lock:
+            if generation == self.generation:
+                self.cache[key] = (time.monotonic(), attrs)
+                if len(self.cache) > self.size:
+                    self.cache.popitem(last=False)
+        return attrs
+
+    def setstat(self, filename, attrs, fsetstat=False):
+        """setstat and fsetstat requests, see the wrapped storage."""
+        try:
+            return self.storage.setstat(filename, attrs, fsetstat=fsetstat)
+        finally:
+            self.invalidate(
+                self.paths.get(filename) if fsetstat else filename)
+
+    def open(self, filename, flags, mode):
+        """Return the file handle, see the wrapped storage."""
+        if flags & os.O_CREAT:
+            handle = self.storage.open(filename, flags, mode)
+        else:
+            self.check_missing(filename)
+            generation = self.generation
+            try:
+                handle = self.storage.open(filename, flags, mode)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    self.add_missing(filename, False, generation)
+                raise
+        self.paths[handle] = absolute_path(self.storage, filename)
+        if flags & _MODIFY_FLAGS:
+            self.invalidate(filename, parent=bool(flags & os.O_CREAT))
+        return handle
+
+    def write(self, handle, off, chunk):
+        """Write chunk at offset of handle, see the wrapped storage."""
+        try:
+            return self.storage.write(handle, off, chunk)
+        finally:
+            self.invalidate(self.paths.get(handle))
+
+    def writev(self, handle, off, chunks):
+        """Write chunks at offset of handle, see the wrapped storage."""
+        try:
+            return self._writev(handle, off, chunks)
+        finally:
+            self.invalidate(self.paths.get(handle))
+
+    def _copy_data(self, read_handle, read_off, length, write_handle,
+                   write_off):
+        try:
+            return self.storage.copy_data(
+                read_handle, read_off, length, write_handle, write_off)
+        finally:
+            self.invalidate(self.paths.get(write_handle))
+
+    def close(self, handle):
+        """Close the file handle, see the wrapped storage."""
+        try:
+            return self.storage.close(handle)
+        finally:
+            self.invalidate(self.paths.pop(handle, None))
+
+    def rename(self, oldpath, newpath):
+        """Move/rename file, see the wrapped storage."""
+        try:
+            return self.storage.rename(oldpath, newpath)
+        finally:
+            self.invalidate(oldpath, parent=True, subtree=True)
+            self.invalidate(newpath, parent=True, subtree=True)
+
+    def rm(self, filename):
+        """Remove file, see the wrapped storage."""
+        try:
+            return self.storage.rm(filename)
+        finally:
+            self.invalidate(filename, parent=True)
+
+    def mkdir(self, filename, mode):
+        """Create directory with given mode, see the wrapped storage."""
+        try:
+            return self.storage.mkdir(filename, mode)
+        finally:
+            self.invalidate(filename, parent=True)
+
+    def rmdir(self, filename):
+        """Remove directory, see the wrapped storage."""
+        try:
+            return self.storage.rmdir(filename)
+        finally:
+            self.invalidate(filename, parent=True, subtree=True)
+
+    def symlink(self, linkpath, targetpath):
+        """Symlink file, see the wrapped storage."""
+        try:
+            return self.storage.symlink(linkpath, targetpath)
+        finally:
+            self.invalidate(linkpath, parent=True)
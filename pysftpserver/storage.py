@@ -1,26 +1,92 @@
 """General SFTP storage. Subclass it the way you want!"""
 
+import binascii
+import errno
 import os
 import itertools
+import mmap
+import struct
+import sys
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 
 from pysftpserver.abstractstorage import SFTPAbstractServerStorage
+from pysftpserver.attributes import SFTPAttributes
 from pysftpserver.futimes import futimes
-from pysftpserver.stat_helpers import stat_to_longname
+
+_DirEntry = getattr(os, 'DirEntry', ())
+
+try:
+    _IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    _IOV_MAX = -1
+if _IOV_MAX <= 0:
+    _IOV_MAX = 1024
+
+# ioctl(dest_fd, FICLONERANGE, struct file_clone_range) shares the extents
+# of the source with the destination on copy on write filesystems (Linux)
+_FICLONERANGE = 0x4020940d
+_file_clone_range = struct.Struct('=qQQQ')
+# errors meaning that extended attributes are missing or not supported
+_XATTR_UNSUPPORTED_ERRORS = frozenset(
+    getattr(errno, name) for name in
+    ('ENODATA', 'ENOATTR', 'ENOTSUP', 'EOPNOTSUPP')
+    if hasattr(errno, name)
+)
+# errors meaning that the copy can't be made that way, but could otherwise
+_COPY_FALLBACK_ERRORS = frozenset(
+    getattr(errno, name) for name in
+    ('EXDEV', 'EINVAL', 'ENOSYS', 'ENOTTY', 'EOPNOTSUPP', 'EBADF')
+    if hasattr(errno, name)
+)
+
+
+class _ScandirIterator(object):
+    """Iterate over '.', '..' and then over the os.DirEntry objects of a
+    directory, as they are returned by os.scandir."""
+
+    def __init__(self, filename):
+        self.entries = os.scandir(filename)
+        self.dots = [b'..', b'.']
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.dots:
+            return self.dots.pop()
+        return next(self.entries)
+
+    def close(self):
+        self.entries.close()
 
 
 class SFTPServerStorage(SFTPAbstractServerStorage):
     """Simple storage class. Subclass it and override the methods."""
 
-    def __init__(self, home, umask=None):
+    write_memoryview = True
+
+    def __init__(self, home, umask=None, mmap_threshold=None):
         """Home sweet home.
 
         Set your home to something comfortable and chdir to it.
         You should support umask changing too.
+
+        Files opened read-only whose size is at least mmap_threshold bytes
+        are memory-mapped, and read as slices of the mapping. If a mapped
+        file is truncated while it's open, by anyone, reading the missing
+        part of the mapping raises SIGBUS and kills the server process:
+        use it only for files that are never truncated while served.
         """
         self.home = os.path.realpath(home)
         os.chdir(self.home)
         if umask:
             os.umask(umask)
+        self.mmap_threshold = mmap_threshold
+        self.mappings = dict()  # file descriptor -> mmap
 
     def verify(self, filename):
         """Verify that requested filename is accessible.
@@ -33,15 +99,25 @@ class SFTPServerStorage(SFTPAbstractServerStorage):
     def stat(self, filename, lstat=False, fstat=False, parent=None):
         """stat, lstat and fstat requests.
 
-        Return a dictionary of stats.
+        Return the attributes of the file (see SFTPAttributes).
         Filename is an handle in the fstat variant.
         If parent is not None, then filename is inside parent,
         and a join is needed.
         This happens in case of readdir responses:
         a filename (not a path) has to be returned,
         but the stat call need (obviously) a full path.
+        Filename can also be an os.DirEntry returned by opendir:
+        its cached stat is used and no join is needed.
         """
-        if not lstat and fstat:
+        if isinstance(filename, _DirEntry):
+            entry = filename
+            filename = entry.name
+            try:
+                _stat = entry.stat()
+            except OSError:
+                # broken symlink, see below
+                _stat = entry.stat(follow_symlinks=False)
+        elif not lstat and fstat:
             # filename is an handle
             _stat = os.fstat(filename)
         elif lstat:
@@ -61,22 +137,9 @@ class SFTPServerStorage(SFTPAbstractServerStorage):
                     else os.path.join(parent, filename)
                 )
 
-        if fstat:
-            longname = None  # not needed in case of fstat
-        else:
-            longname = stat_to_longname(  # see stat_helpers.py
-                _stat, filename
-            )
-
-        return {
-            b'size': _stat.st_size,
-            b'uid': _stat.st_uid,
-            b'gid': _stat.st_gid,
-            b'perm': _stat.st_mode,
-            b'atime': _stat.st_atime,
-            b'mtime': _stat.st_mtime,
-            b'longname': longname
-        }
+        # the longname is not needed in case of fstat, and it's only
+        # formatted when needed otherwise: see attributes.py
+        return SFTPAttributes.from_stat(_stat, None if fstat else filename)
 
     def setstat(self, filename, attrs, fsetstat=False):
         """setstat and fsetstat requests.
@@ -108,12 +171,28 @@ class SFTPServerStorage(SFTPAbstractServerStorage):
                 futimes(filename, (attrs[b'atime'], attrs[b'mtime']))
 
     def opendir(self, filename):
-        """Return an iterator over the files in filename."""
+        """Return an iterator over the files in filename.
+
+        When available, os.scandir is used: entries are streamed
+        as os.DirEntry objects, so that stat can reuse their data.
+        """
+        if hasattr(os, 'scandir'):
+            return _ScandirIterator(filename)
         return itertools.chain(iter([b'.', b'..']), iter(os.listdir(filename)))
 
     def open(self, filename, flags, mode):
         """Return the file handle."""
-        return os.open(filename, flags, mode)
+        fd = os.open(filename, flags, mode)
+        if (self.mmap_threshold is not None and
+                not flags & (os.O_WRONLY | os.O_RDWR)):
+            size = os.fstat(fd).st_size
+            if size and size >= self.mmap_threshold:
+                try:
+                    self.mappings[fd] = mmap.mmap(
+                        fd, 0, access=mmap.ACCESS_READ)
+                except (EnvironmentError, ValueError):
+                    pass  # e.g. not a regular file, pread will do
+        return fd
 
     def mkdir(self, filename, mode):
         """Create directory with given mode."""
@@ -141,19 +220,166 @@ class SFTPServerStorage(SFTPAbstractServerStorage):
 
     def write(self, handle, off, chunk):
         """Write chunk at offset of handle."""
-        os.lseek(handle, off, os.SEEK_SET)
-        rlen = os.write(handle, chunk)
+        if hasattr(os, 'pwrite'):
+            rlen = os.pwrite(handle, chunk, off)
+        else:
+            os.lseek(handle, off, os.SEEK_SET)
+            rlen = os.write(handle, chunk)
         if rlen == len(chunk):
             return True
 
     def read(self, handle, off, size):
         """Read from the handle size, starting from offset off."""
+        mapping = self.mappings.get(handle)
+        if mapping is not None:
+            return memoryview(mapping)[off:off + size]
+        if hasattr(os, 'pread'):
+            return os.pread(handle, size, off)
         os.lseek(handle, off, os.SEEK_SET)
         return os.read(handle, size)
 
+    if hasattr(os, 'preadv'):
+        def read_into(self, handle, off, buffer):
+            """Read from the handle into buffer, starting from offset off.
+            Returns the number of bytes read, None for the memory-mapped
+            files: read serves them without copying."""
+            if handle in self.mappings:
+                return None
+            return os.preadv(handle, [buffer], off)
+
+    def writev(self, handle, off, chunks):
+        """Write chunks one after the other, starting at offset off of
+        handle, with as few pwritev calls as possible."""
+        if not hasattr(os, 'pwritev'):
+            return SFTPAbstractServerStorage.writev(self, handle, off, chunks)
+        chunks = list(chunks)
+        for i in range(0, len(chunks), _IOV_MAX):
+            batch = chunks[i:i + _IOV_MAX]
+            size = sum(len(chunk) for chunk in batch)
+            if os.pwritev(handle, batch, off) != size:
+                return False
+            off += size
+        return True
+
+    def readv(self, handle, ranges):
+        """Read from the handle each (offset, size) of ranges, with a
+        preadv call for each run of contiguous ranges."""
+        if not hasattr(os, 'preadv') or handle in self.mappings:
+            return SFTPAbstractServerStorage.readv(self, handle, ranges)
+        chunks = []
+        i = 0
+        while i < len(ranges):
+            off, end = ranges[i][0], sum(ranges[i])
+            j = i + 1
+            while (j < len(ranges) and ranges[j][0] == end and
+                   j - i < _IOV_MAX):
+                end += ranges[j][1]
+                j += 1
+            buffers = [bytearray(size) for _, size in ranges[i:j]]
+            rlen = os.preadv(handle, buffers, off)
+            for buf in buffers:  # the ones after a short read are cut
+                del buf[rlen:]
+                rlen = max(rlen - len(buf), 0)
+            chunks.extend(buffers)
+            i = j
+        return chunks
+
+    def copy_data(self, read_handle, read_off, length, write_handle,
+                  write_off):
+        """Copy length bytes (up to the end of file if 0) from read_handle
+        at offset read_off to write_handle at offset write_off.
+
+        The data is shared through a reflink where the filesystem allows
+        it, otherwise it's copied in the kernel by copy_file_range, or
+        read and written as a last resort.
+        """
+        if fcntl and sys.platform.startswith('linux'):
+            try:
+                fcntl.ioctl(write_handle, _FICLONERANGE,
+                            _file_clone_range.pack(
+                                read_handle, read_off, length, write_off))
+                return
+            except (IOError, OSError) as e:
+                if e.errno not in _COPY_FALLBACK_ERRORS:
+                    raise
+        if not length:
+            length = max(0, os.fstat(read_handle).st_size - read_off)
+        use_copy_file_range = hasattr(os, 'copy_file_range')
+        while length > 0:
+            size = min(length, 1024 * 1024)
+            copied = None
+            if use_copy_file_range:
+                try:
+                    copied = os.copy_file_range(
+                        read_handle, write_handle, size, read_off, write_off)
+                except OSError as e:
+                    if e.errno not in _COPY_FALLBACK_ERRORS:
+                        raise
+                    use_copy_file_range = False
+            if copied is None:
+                chunk = self.read(read_handle, read_off, size)
+                if chunk and not self.write(write_handle, write_off, chunk):
+                    raise OSError(errno.EIO, 'short write')
+                copied = len(chunk)
+            if not copied:
+                break  # end of file
+            read_off += copied
+            write_off += copied
+            length -= copied
+
+    def _checksum_stamp(self, handle):
+        st = os.fstat(handle)
+        mtime = getattr(st, 'st_mtime_ns', None) or int(st.st_mtime * 1e9)
+        return st.st_size, '{} {}'.format(st.st_size, mtime)
+
+    def set_checksum(self, handle, algorithm, digest, size):
+        """Store the digest of the file of handle in an extended attribute,
+        along with its size and modification time, if it's size bytes
+        long."""
+        if not hasattr(os, 'setxattr'):
+            return
+        current_size, stamp = self._checksum_stamp(handle)
+        if current_size != size:
+            return
+        value = '{} {}'.format(stamp, binascii.hexlify(digest).decode())
+        try:
+            os.setxattr(handle, 'user.sftp.' + algorithm.decode(),
+                        value.encode())
+        except OSError as e:
+            if e.errno not in _XATTR_UNSUPPORTED_ERRORS:
+                raise
+
+    def get_checksum(self, handle, algorithm):
+        """Return the (digest, size) of the file of handle, if it's been
+        stored by set_checksum and the file hasn't changed since then."""
+        if not hasattr(os, 'getxattr'):
+            return None
+        try:
+            value = os.getxattr(handle, 'user.sftp.' + algorithm.decode())
+        except OSError as e:
+            if e.errno in _XATTR_UNSUPPORTED_ERRORS:
+                return None
+            raise
+        size, stamp = self._checksum_stamp(handle)
+        stored_stamp, _, digest = value.decode().rpartition(' ')
+        if stored_stamp != stamp:
+            return None  # changed in the meantime
+        return binascii.unhexlify(digest), size
+
+    def fileno(self, handle):
+        """Return the file descriptor of handle, whose data can be sent
+        with os.sendfile."""
+        return handle
+
     def close(self, handle):
         """Close the file handle."""
+        mapping = self.mappings.pop(handle, None)
+        if mapping is not None:
+            try:
+                mapping.close()
+            except BufferError:
+                pass  # unmapped when the slices still queued are released
         try:
             handle.close()
         except AttributeError:
-            pass
+            os.close(handle)  # a file descriptor
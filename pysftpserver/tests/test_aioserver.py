@@ -0,0 +1,283 @@
+import asyncio
+import hashlib
+import os
+import random
+import struct
+import unittest
+from shutil import rmtree
+
+from pysftpserver.aioserver import SFTPAsyncServer
+from pysftpserver.hook import SFTPHook
+from pysftpserver.server import (SSH2_FILEXFER_VERSION, SSH2_FX_FAILURE,
+                                 SSH2_FX_OK, SSH2_FXF_CREAT, SSH2_FXF_READ,
+                                 SSH2_FXF_WRITE, SSH2_FXP_ATTRS,
+                                 SSH2_FXP_CLOSE, SSH2_FXP_EXTENDED,
+                                 SSH2_FXP_EXTENDED_REPLY, SSH2_FXP_HANDLE,
+                                 SSH2_FXP_INIT, SSH2_FXP_MKDIR, SSH2_FXP_OPEN,
+                                 SSH2_FXP_READ, SSH2_FXP_STAT,
+                                 SSH2_FXP_STATUS, SSH2_FXP_VERSION,
+                                 SSH2_FXP_WRITE, SFTPServer)
+from pysftpserver.storage import SFTPServerStorage
+from pysftpserver.tests.utils import (HeldStorage, get_sftpdata,
+                                      get_sftphandle, get_sftpid,
+                                      get_sftpresponses, sftpcmd, sftpint,
+                                      sftpint64, sftpstring, t_path)
+
+
+class AsyncStorage(SFTPServerStorage):
+    """Storage with asynchronous stat, mkdir, read and write methods."""
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncStorage, self).__init__(*args, **kwargs)
+        self.event = asyncio.Event()
+
+    async def stat(self, filename, *args, **kwargs):
+        if filename == b'slow':
+            await self.event.wait()
+        return super(AsyncStorage, self).stat(filename, *args, **kwargs)
+
+    async def mkdir(self, filename, mode):
+        if filename == b'late':
+            await self.event.wait()
+        return super(AsyncStorage, self).mkdir(filename, mode)
+
+    async def write(self, handle, off, chunk):
+        await asyncio.sleep(random.random() / 1000)
+        return super(AsyncStorage, self).write(handle, off, chunk)
+
+    async def read(self, handle, off, size):
+        await asyncio.sleep(0)
+        return super(AsyncStorage, self).read(handle, off, size)
+
+
+class AsyncHook(SFTPHook):
+    """Hook with an asynchronous read method."""
+
+    def __init__(self):
+        self.reads = []
+
+    async def read(self, server, handle_id, offset, size):
+        await asyncio.sleep(0)
+        self.reads.append((offset, size))
+
+
+class AsyncServerTest(unittest.TestCase):
+
+    def setUp(self):
+        os.chdir(t_path())
+        self.home = 'home'
+        if not os.path.isdir(self.home):
+            os.mkdir(self.home)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        os.chdir(t_path())
+        rmtree(self.home)
+
+    @classmethod
+    def tearDownClass(cls):
+        rmtree(t_path('home'), ignore_errors=True)
+
+    def test_out_of_order(self):
+        async def go():
+            storage = AsyncStorage(self.home)
+            server = SFTPAsyncServer(storage)
+            os.mkdir('slow')
+            slow = sftpcmd(SSH2_FXP_STAT, sftpstring(b'slow'))
+            fast = sftpcmd(SSH2_FXP_STAT, sftpstring(b'.'))
+
+            server.input_queue = slow + fast
+            server.process()
+            await asyncio.sleep(0.01)
+            self.assertEqual(len(server.tasks), 1)
+            storage.event.set()
+            await server.join()
+            return get_sftpresponses(server.output_queue), slow, fast
+
+        responses, slow, fast = self.loop.run_until_complete(go())
+        self.assertEqual(
+            [(SSH2_FXP_ATTRS, get_sftpid(fast)),
+             (SSH2_FXP_ATTRS, get_sftpid(slow))],
+            [r[:2] for r in responses]
+        )
+
+    def test_path_order(self):
+        async def go():
+            storage = AsyncStorage(self.home)
+            server = SFTPAsyncServer(storage)
+            mkdir = sftpcmd(SSH2_FXP_MKDIR, sftpstring(b'late'), sftpint(0))
+            stat = sftpcmd(SSH2_FXP_STAT, sftpstring(b'late'))
+
+            server.input_queue = mkdir + stat
+            server.process()
+            await asyncio.sleep(0.01)
+            self.assertEqual(server.output_queue, b'')  # the stat waits
+            storage.event.set()
+            await server.join()
+            return get_sftpresponses(server.output_queue), mkdir, stat
+
+        responses, mkdir, stat = self.loop.run_until_complete(go())
+        self.assertEqual(
+            [(SSH2_FXP_STATUS, get_sftpid(mkdir)),
+             (SSH2_FXP_ATTRS, get_sftpid(stat))],
+            [r[:2] for r in responses]
+        )
+
+    def test_handle_order(self):
+        async def go():
+            server = SFTPAsyncServer(AsyncStorage(self.home))
+            server.input_queue = sftpcmd(
+                SSH2_FXP_OPEN,
+                sftpstring(b'services'),
+                sftpint(SSH2_FXF_CREAT | SSH2_FXF_WRITE),
+                sftpint(0)
+            )
+            server.process()
+            await server.join()
+            handle = get_sftphandle(server.output_queue)
+
+            chunks = [os.urandom(100) for i in range(20)]
+            cmds = [
+                sftpcmd(
+                    SSH2_FXP_WRITE,
+                    sftpstring(handle),
+                    sftpint64(i * 100),
+                    sftpstring(chunk)
+                ) for i, chunk in enumerate(chunks)
+            ]
+            cmds.append(sftpcmd(SSH2_FXP_CLOSE, sftpstring(handle)))
+            server.output_queue = b''
+            server.input_queue = b''.join(cmds)
+            server.process()
+            await server.join()
+            return get_sftpresponses(server.output_queue), cmds, chunks
+
+        responses, cmds, chunks = self.loop.run_until_complete(go())
+        self.assertEqual([get_sftpid(cmd) for cmd in cmds],
+                         [r[1] for r in responses])
+        for msg_type, msg_id, msg in responses:
+            self.assertEqual(msg_type, SSH2_FXP_STATUS)
+            self.assertEqual(struct.unpack('>I', msg[9:13])[0], SSH2_FX_OK)
+        with open('services', 'rb') as f:
+            self.assertEqual(f.read(), b''.join(chunks))
+
+    def test_read(self):
+        with open(os.path.join(self.home, 'services'), 'wb') as f:
+            f.write(b'hello')
+
+        async def go():
+            hook = AsyncHook()
+            server = SFTPAsyncServer(AsyncStorage(self.home), hook)
+            server.input_queue = sftpcmd(
+                SSH2_FXP_OPEN, sftpstring(b'services'),
+                sftpint(SSH2_FXF_READ), sftpint(0))
+            server.process()
+            await server.join()
+            handle = get_sftphandle(server.output_queue)
+            record = server.handles[handle]
+            record.accessed_at = 0
+
+            server.output_queue = b''
+            server.input_queue = sftpcmd(
+                SSH2_FXP_READ, sftpstring(handle), sftpint64(0),
+                sftpint(100))
+            server.process()
+            self.assertEqual(server.output_queue, b'')  # in a task
+            await server.join()
+            return server.output_queue, record, hook
+
+        output, record, hook = self.loop.run_until_complete(go())
+        self.assertEqual(get_sftpdata(output), b'hello')
+        self.assertEqual((record.bytes_read, hook.reads), (5, [(0, 100)]))
+        self.assertGreater(record.accessed_at, 0)
+
+    def test_check_file(self):
+        data = os.urandom(100000)
+        with open(os.path.join(self.home, 'file'), 'wb') as f:
+            f.write(data)
+
+        async def go():
+            storage = HeldStorage(self.home)
+            server = SFTPAsyncServer(storage)
+            server.input_queue = sftpcmd(
+                SSH2_FXP_OPEN, sftpstring(b'file'), sftpint(SSH2_FXF_READ),
+                sftpint(0))
+            server.process()
+            handle = get_sftphandle(server.output_queue)
+            check = sftpcmd(
+                SSH2_FXP_EXTENDED, sftpstring(b'check-file-handle'),
+                sftpstring(handle), sftpstring(b'sha256'), sftpint64(0),
+                sftpint64(0), sftpint(0))
+            stat = sftpcmd(SSH2_FXP_STAT, sftpstring(b'.'))
+
+            server.output_queue = b''
+            server.input_queue = check + stat
+            server.process()
+            await asyncio.sleep(0.01)
+            # the file is hashed out of the loop
+            self.assertEqual(
+                [(SSH2_FXP_ATTRS, get_sftpid(stat))],
+                [r[:2] for r in get_sftpresponses(server.output_queue)]
+            )
+            storage.event.set()
+            await server.join()
+            return get_sftpresponses(server.output_queue), check, stat
+
+        responses, check, stat = self.loop.run_until_complete(go())
+        self.assertEqual(
+            [(SSH2_FXP_ATTRS, get_sftpid(stat)),
+             (SSH2_FXP_EXTENDED_REPLY, get_sftpid(check))],
+            [r[:2] for r in responses]
+        )
+        self.assertEqual(
+            responses[1][2][-32:], hashlib.sha256(data).digest())
+
+    def test_sync_server(self):
+        # SFTPServer can't wait for the coroutine functions
+        server = SFTPServer(AsyncStorage(self.home))
+        os.mkdir('slow')
+        server.input_queue = sftpcmd(SSH2_FXP_STAT, sftpstring(b'slow'))
+        server.process()
+        self.assertEqual(
+            struct.unpack('>I', server.output_queue[9:13])[0],
+            SSH2_FX_FAILURE)
+
+    def test_run(self):
+        in_r, in_w = os.pipe()
+        out_r, out_w = os.pipe()
+        server = SFTPAsyncServer(
+            SFTPServerStorage(self.home), fd_in=in_r, fd_out=out_w,
+            writebehind=4096)
+        mkdir = sftpcmd(SSH2_FXP_MKDIR, sftpstring(b'foo'), sftpint(0))
+        # the write is still buffered when stdin is closed
+        upload = sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'file'),
+            sftpint(SSH2_FXF_CREAT | SSH2_FXF_WRITE), sftpint(0)
+        ) + sftpcmd(
+            SSH2_FXP_WRITE, sftpstring(struct.pack('>II', 0, 0)),
+            sftpint64(0), sftpstring(b'x' * 1000))
+        os.write(in_w, sftpcmd(SSH2_FXP_INIT, sftpint(3)) + mkdir + upload)
+        os.close(in_w)
+
+        self.loop.run_until_complete(server.run())
+        os.close(out_w)
+        responses = get_sftpresponses(os.read(out_r, 4096))
+        os.close(in_r)
+        os.close(out_r)
+
+        self.assertEqual(responses[0][:2],
+                         (SSH2_FXP_VERSION, SSH2_FILEXFER_VERSION))
+        self.assertEqual(responses[1][:2],
+                         (SSH2_FXP_STATUS, get_sftpid(mkdir)))
+        self.assertTrue(os.path.isdir('foo'))
+        self.assertEqual([r[0] for r in responses[2:]],
+                         [SSH2_FXP_HANDLE, SSH2_FXP_STATUS])
+        self.assertEqual(os.path.getsize('file'), 1000)
+        self.assertEqual(len(server.handles), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import os
+import struct
+import subprocess
+import sys
+import unittest
+
+from pysftpserver.attributes import (SSH2_FILEXFER_ATTR_EXTENDED,
+                                     SSH2_FILEXFER_ATTR_PERMISSIONS,
+                                     SSH2_FILEXFER_ATTR_SIZE, SFTPAttributes)
+from pysftpserver.stat_helpers import stat_to_longname
+
+
+class AttributesTest(unittest.TestCase):
+
+    def test_from_stat(self):
+        st = os.lstat('/')
+        attrs = SFTPAttributes.from_stat(st, b'/')
+        self.assertEqual(
+            (attrs.size, attrs.uid, attrs.perm, attrs[b'mtime']),
+            (st.st_size, st.st_uid, st.st_mode, st.st_mtime))
+        self.assertIsNone(attrs._longname)  # not formatted yet
+        self.assertEqual(attrs[b'longname'], stat_to_longname(st, b'/'))
+        self.assertIsNone(SFTPAttributes.from_stat(st).longname)
+        self.assertEqual(
+            attrs.encode(),
+            struct.pack('>IQIIIII', 0xf, st.st_size, st.st_uid, st.st_gid,
+                        st.st_mode, int(st.st_atime), int(st.st_mtime)))
+
+    def test_dict_access(self):
+        attrs = SFTPAttributes(perm=0o644)
+        self.assertEqual(dict(attrs), {b'perm': 0o644})
+        self.assertEqual(attrs.get(b'perm', 0o666), 0o644)
+        self.assertNotIn(b'size', attrs)
+        self.assertRaises(KeyError, lambda: attrs[b'size'])
+        attrs[b'size'] = 10
+        self.assertEqual(attrs.size, 10)
+        del attrs[b'perm']
+        self.assertIsNone(attrs.perm)
+        self.assertRaises(KeyError, attrs.__setitem__, b'foo', 1)
+        self.assertEqual(
+            SFTPAttributes.from_dict({b'size': 10, b'foo': 1}), attrs)
+
+    def test_encode_partial(self):
+        attrs = SFTPAttributes(size=1, perm=0o600, extended=[{b'a': b'bc'}])
+        self.assertEqual(attrs.encode(), struct.pack(
+            '>IQII', SSH2_FILEXFER_ATTR_SIZE | SSH2_FILEXFER_ATTR_PERMISSIONS |
+            SSH2_FILEXFER_ATTR_EXTENDED, 1, 0o600, 1) +
+            struct.pack('>I', 1) + b'a' + struct.pack('>I', 2) + b'bc')
+
+    def test_import(self):
+        # in a fresh interpreter, where nothing else imported
+        # collections.abc beforehand
+        subprocess.check_call([
+            sys.executable, '-c',
+            'import pysftpserver.server, pysftpserver.storage, '
+            'pysftpserver.statcache'
+        ], cwd=os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__)))))
+
+
+if __name__ == "__main__":
+    unittest.main()
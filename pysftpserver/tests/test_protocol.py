@@ -0,0 +1,313 @@
+import os
+import struct
+import unittest
+
+from pysftpserver.hook import SFTPHook
+from pysftpserver.pysftpexceptions import SFTPForbidden
+from pysftpserver.server import (SSH2_FILEXFER_VERSION, SSH2_FX_EOF,
+                                 SSH2_FX_FAILURE, SSH2_FX_OK,
+                                 SSH2_FX_OP_UNSUPPORTED,
+                                 SSH2_FX_PERMISSION_DENIED, SSH2_FXF_CREAT,
+                                 SSH2_FXF_READ, SSH2_FXF_WRITE,
+                                 SSH2_FXP_ATTRS, SSH2_FXP_DATA,
+                                 SSH2_FXP_EXTENDED, SSH2_FXP_EXTENDED_REPLY,
+                                 SSH2_FXP_HANDLE, SSH2_FXP_INIT,
+                                 SSH2_FXP_MKDIR, SSH2_FXP_OPEN,
+                                 SSH2_FXP_READ, SSH2_FXP_STAT,
+                                 SSH2_FXP_STATUS, SSH2_FXP_VERSION,
+                                 SSH2_FXP_WRITE, SFTPProtocol)
+from pysftpserver.storage import SFTPServerStorage
+from pysftpserver.tests.utils import (CountingStorage, HomeTestCase,
+                                      get_sftpdata, get_sftphandle, get_sftpid,
+                                      get_sftpint, get_sftpresponses,
+                                      get_sftpstat, sftpcmd, sftpint,
+                                      sftpint64, sftpstring)
+
+
+class CappedStorage(CountingStorage):
+    """Never read more than 8 KiB at once."""
+
+    def read(self, handle, off, size):
+        return super(CappedStorage, self).read(handle, off, min(size, 8192))
+
+
+class BrokenStorage(SFTPServerStorage):
+    """Return nothing at all from read."""
+
+    def read(self, handle, off, size):
+        return None
+
+
+class VectorStorage(CountingStorage):
+    """Remember the ranges of each readv."""
+
+    def __init__(self, *args, **kwargs):
+        super(VectorStorage, self).__init__(*args, **kwargs)
+        self.readvs = []
+
+    def readv(self, handle, ranges):
+        self.readvs.append(ranges)
+        return super(VectorStorage, self).readv(handle, ranges)
+
+
+class ForbiddenHook(SFTPHook):
+    """Refuse the first READ of each handle."""
+
+    def read(self, server, handle_id, offset, size):
+        raise SFTPForbidden()
+
+
+class UpperStorage(SFTPServerStorage):
+    """Upper-case the data read, remember the types of the data written."""
+
+    def __init__(self, *args, **kwargs):
+        super(UpperStorage, self).__init__(*args, **kwargs)
+        self.written = []
+
+    def read(self, handle, off, size):
+        return super(UpperStorage, self).read(handle, off, size).upper()
+
+    def write(self, handle, off, chunk):
+        self.written.append(type(chunk))
+        return super(UpperStorage, self).write(handle, off, chunk)
+
+
+class ProtocolTest(HomeTestCase):
+
+    def setUp(self):
+        super(ProtocolTest, self).setUp()
+        self.storage = CountingStorage(self.home)
+        self.protocol = SFTPProtocol(self.storage)
+
+    def test_feed(self):
+        output = self.protocol.feed(sftpcmd(SSH2_FXP_INIT, sftpint(3)))
+        blob = b''.join(output)
+        self.assertEqual(get_sftpresponses(blob)[0][0], SSH2_FXP_VERSION)
+        self.assertEqual(get_sftpint(blob), SSH2_FILEXFER_VERSION)
+        self.assertEqual(self.protocol.data_to_send(), [])
+        self.assertEqual(
+            blob[9:],
+            sftpstring(b'limits@openssh.com') + sftpstring(b'1') +
+            sftpstring(b'copy-data') + sftpstring(b'1') +
+            sftpstring(b'check-file') +
+            sftpstring(b'sha256,sha512,sha384,sha224,sha1,md5,crc32'))
+
+    def test_limits(self):
+        protocol = SFTPProtocol(
+            self.storage, max_packet_length=64 * 1024, max_open_handles=1)
+        limits = sftpcmd(SSH2_FXP_EXTENDED, sftpstring(b'limits@openssh.com'))
+        unknown = sftpcmd(SSH2_FXP_EXTENDED, sftpstring(b'foo@example.com'))
+        (reply_type, reply_id, reply), (status_type, status_id, status) = \
+            get_sftpresponses(b''.join(protocol.feed(limits + unknown)))
+        self.assertEqual((reply_type, reply_id),
+                         (SSH2_FXP_EXTENDED_REPLY, get_sftpid(limits)))
+        self.assertEqual(struct.unpack('>QQQQ', reply[9:]),
+                         (65536, 64512, 64512, 1))
+        self.assertEqual((status_type, status_id),
+                         (SSH2_FXP_STATUS, get_sftpid(unknown)))
+        self.assertEqual(
+            struct.unpack('>I', status[9:13])[0], SSH2_FX_OP_UNSUPPORTED)
+
+        # a single handle can be open at a time
+        with open('file', 'wb') as f:
+            f.write(b'x' * 100000)
+        open_file = sftpcmd(SSH2_FXP_OPEN, sftpstring(b'file'),
+                            sftpint(SSH2_FXF_READ), sftpint(0))
+        (handle_type, _, handle), (status_type, _, status) = \
+            get_sftpresponses(b''.join(protocol.feed(open_file * 2)))
+        self.assertEqual(handle_type, SSH2_FXP_HANDLE)
+        self.assertEqual(
+            struct.unpack('>I', status[9:13])[0], SSH2_FX_FAILURE)
+
+        # reads are not larger than max_read_length
+        data = b''.join(protocol.feed(sftpcmd(
+            SSH2_FXP_READ, sftpstring(get_sftphandle(handle)), sftpint64(0),
+            sftpint(100000))))
+        self.assertEqual(len(get_sftpdata(data)), 64512)
+
+    def test_feed_bytewise(self):
+        mkdir = sftpcmd(SSH2_FXP_MKDIR, sftpstring(b'foo'), sftpint(0))
+        stat = sftpcmd(SSH2_FXP_STAT, sftpstring(b'foo'))
+        data = mkdir + stat
+
+        output = []
+        for i in range(len(data)):
+            output.extend(self.protocol.feed(data[i:i + 1]))
+            if i < len(mkdir) - 1:
+                self.assertEqual(output, [])
+
+        blob = b''.join(output)
+        (status_type, status_id, status), (attrs_type, attrs_id, attrs) = \
+            get_sftpresponses(blob)
+        self.assertEqual((status_type, status_id),
+                         (SSH2_FXP_STATUS, get_sftpid(mkdir)))
+        self.assertEqual(struct.unpack('>I', status[9:13])[0], SSH2_FX_OK)
+        self.assertEqual((attrs_type, attrs_id),
+                         (SSH2_FXP_ATTRS, get_sftpid(stat)))
+        self.assertEqual(get_sftpstat(attrs)['mode'], os.stat('foo').st_mode)
+
+    def test_coalesce_reads(self):
+        content = os.urandom(10000)
+        with open('file', 'wb') as f:
+            f.write(content)
+        output = self.protocol.feed(sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'file'), sftpint(SSH2_FXF_READ),
+            sftpint(0)))
+        handle = get_sftphandle(b''.join(output))
+
+        reads = [
+            sftpcmd(SSH2_FXP_READ, sftpstring(handle), sftpint64(off),
+                    sftpint(4096))
+            for off in (0, 4096, 8192, 12288, 100)
+        ]
+        responses = get_sftpresponses(
+            b''.join(self.protocol.feed(b''.join(reads))))
+
+        # the short read is confirmed to be the end of file
+        self.assertEqual(self.storage.reads,
+                         [(0, 4 * 4096), (12288, 4096), (100, 4096)])
+        self.assertEqual([r[:2] for r in responses], [
+            (SSH2_FXP_DATA, get_sftpid(reads[0])),
+            (SSH2_FXP_DATA, get_sftpid(reads[1])),
+            (SSH2_FXP_DATA, get_sftpid(reads[2])),
+            (SSH2_FXP_STATUS, get_sftpid(reads[3])),
+            (SSH2_FXP_DATA, get_sftpid(reads[4])),
+        ])
+        self.assertEqual(
+            b''.join(get_sftpdata(r[2]) for r in responses[:3]), content)
+        self.assertEqual(
+            struct.unpack('>I', responses[3][2][9:13])[0], SSH2_FX_EOF)
+        self.assertEqual(get_sftpdata(responses[4][2]), content[100:4196])
+
+    def test_coalesce_short_reads(self):
+        content = os.urandom(4 * 8192)
+        with open('file', 'wb') as f:
+            f.write(content)
+        storage = CappedStorage('.')
+        protocol = SFTPProtocol(storage)
+        output = protocol.feed(sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'file'), sftpint(SSH2_FXF_READ),
+            sftpint(0)))
+        handle = get_sftphandle(b''.join(output))
+
+        reads = [
+            sftpcmd(SSH2_FXP_READ, sftpstring(handle), sftpint64(off),
+                    sftpint(8192))
+            for off in range(0, 5 * 8192, 8192)
+        ]
+        responses = get_sftpresponses(
+            b''.join(protocol.feed(b''.join(reads))))
+
+        self.assertEqual([r[:2] for r in responses[:4]], [
+            (SSH2_FXP_DATA, get_sftpid(read)) for read in reads[:4]])
+        self.assertEqual(
+            b''.join(get_sftpdata(r[2]) for r in responses[:4]), content)
+        self.assertEqual(responses[4][:2],
+                         (SSH2_FXP_STATUS, get_sftpid(reads[4])))
+        self.assertEqual(
+            struct.unpack('>I', responses[4][2][9:13])[0], SSH2_FX_EOF)
+
+    def read_all(self, protocol, offsets):
+        """Open 'file' and send a pipelined READ for each offset.
+
+        Returns:
+            (list, list): The READs sent and the responses.
+        """
+        with open('file', 'wb') as f:
+            f.write(os.urandom(10000))
+        output = protocol.feed(sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'file'), sftpint(SSH2_FXF_READ),
+            sftpint(0)))
+        handle = get_sftphandle(b''.join(output))
+        reads = [
+            sftpcmd(SSH2_FXP_READ, sftpstring(handle), sftpint64(off),
+                    sftpint(4096))
+            for off in offsets
+        ]
+        return reads, get_sftpresponses(
+            b''.join(protocol.feed(b''.join(reads))))
+
+    def test_coalesce_broken_reads(self):
+        protocol = SFTPProtocol(BrokenStorage('.'))
+        reads, responses = self.read_all(protocol, (0, 4096, 8192))
+        self.assertEqual([r[:2] for r in responses], [
+            (SSH2_FXP_STATUS, get_sftpid(read)) for read in reads])
+        for response in responses:
+            self.assertEqual(
+                struct.unpack('>I', response[2][9:13])[0], SSH2_FX_FAILURE)
+        # the session goes on
+        output = protocol.feed(sftpcmd(SSH2_FXP_STAT, sftpstring(b'file')))
+        self.assertEqual(get_sftpresponses(b''.join(output))[0][0],
+                         SSH2_FXP_ATTRS)
+
+    def test_coalesce_hooked_reads(self):
+        # as through _read, only the first READ is hooked
+        protocol = SFTPProtocol(self.storage, hook=ForbiddenHook())
+        reads, responses = self.read_all(protocol, (0, 4096, 8192))
+        self.assertEqual([r[:2] for r in responses], [
+            (SSH2_FXP_STATUS, get_sftpid(reads[0])),
+            (SSH2_FXP_DATA, get_sftpid(reads[1])),
+            (SSH2_FXP_DATA, get_sftpid(reads[2])),
+        ])
+        self.assertEqual(struct.unpack('>I', responses[0][2][9:13])[0],
+                         SSH2_FX_PERMISSION_DENIED)
+        self.assertEqual(self.storage.reads, [(4096, 8192)])
+
+    def test_coalesce_readv(self):
+        storage = VectorStorage('.')
+        protocol = SFTPProtocol(storage)
+        reads, responses = self.read_all(protocol, (0, 4096, 8192, 12288))
+        self.assertEqual(storage.readvs, [
+            [(0, 4096), (4096, 4096), (8192, 4096), (12288, 4096)]])
+        # the short read is confirmed to be the end of file
+        self.assertEqual(storage.reads, [(12288, 4096)])
+        self.assertEqual([r[:2] for r in responses], [
+            (SSH2_FXP_DATA, get_sftpid(reads[0])),
+            (SSH2_FXP_DATA, get_sftpid(reads[1])),
+            (SSH2_FXP_DATA, get_sftpid(reads[2])),
+            (SSH2_FXP_STATUS, get_sftpid(reads[3])),
+        ])
+        with open('file', 'rb') as f:
+            self.assertEqual(
+                b''.join(get_sftpdata(r[2]) for r in responses[:3]),
+                f.read())
+
+    def test_overrides(self):
+        # read_into and write_memoryview are inherited from
+        # SFTPServerStorage, but read and write are overridden
+        storage = UpperStorage('.')
+        protocol = SFTPProtocol(storage)
+        self.assertIsNone(protocol.read_into)
+        output = protocol.feed(sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'file'),
+            sftpint(SSH2_FXF_CREAT | SSH2_FXF_READ | SSH2_FXF_WRITE),
+            sftpint(0)))
+        handle = get_sftphandle(b''.join(output))
+        protocol.feed(sftpcmd(
+            SSH2_FXP_WRITE, sftpstring(handle), sftpint64(0),
+            sftpstring(b'hello')))
+        self.assertEqual(storage.written, [bytes])
+        output = protocol.feed(sftpcmd(
+            SSH2_FXP_READ, sftpstring(handle), sftpint64(0), sftpint(100)))
+        self.assertEqual(get_sftpdata(b''.join(output)), b'HELLO')
+
+    def test_custom_handler(self):
+        # handlers are plain functions: one reply each
+        class StatProtocol(SFTPProtocol):
+            def _stat(self, sid):
+                self.consume_filename()
+                self.send_status(sid, SSH2_FX_OK)
+            table = dict(SFTPProtocol.table)
+            table[SSH2_FXP_STAT] = _stat
+
+        stat = sftpcmd(SSH2_FXP_STAT, sftpstring(b'.'))
+        responses = get_sftpresponses(
+            b''.join(StatProtocol(self.storage).feed(stat)))
+        self.assertEqual(len(responses), 1)
+        self.assertEqual(responses[0][:2], (SSH2_FXP_STATUS, get_sftpid(stat)))
+        self.assertEqual(
+            struct.unpack('>I', responses[0][2][9:13])[0], SSH2_FX_OK)
+
+
+if __name__ == "__main__":
+    unittest.main()
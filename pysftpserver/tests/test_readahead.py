@@ -0,0 +1,86 @@
+import os
+import unittest
+
+from pysftpserver.server import (SSH2_FXF_READ, SSH2_FXF_WRITE,
+                                 SSH2_FXP_CLOSE, SSH2_FXP_OPEN, SSH2_FXP_READ,
+                                 SSH2_FXP_WRITE, SFTPServer)
+from pysftpserver.tests.utils import (CountingStorage, HomeTestCase,
+                                      get_sftpdata, get_sftphandle, sftpcmd,
+                                      sftpint, sftpint64, sftpstring, t_path)
+
+
+class ReadAheadTest(HomeTestCase):
+
+    def setUp(self):
+        super(ReadAheadTest, self).setUp()
+        self.content = os.urandom(16 * 1024)
+        with open(os.path.join(self.home, 'file'), 'wb') as f:
+            f.write(self.content)
+        self.storage = CountingStorage(self.home)
+        self.server = SFTPServer(
+            self.storage,
+            logfile=t_path('log'),
+            readahead=4,
+            readahead_memory=3 * 1024
+        )
+
+    def open(self, flags=SSH2_FXF_READ):
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'file'), sftpint(flags), sftpint(0))
+        self.server.process()
+        return get_sftphandle(self.server.output_queue)
+
+    def read(self, handle, off, size=1024):
+        self.server.output_queue = b''
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_READ, sftpstring(handle), sftpint64(off), sftpint(size))
+        self.server.process()
+        return get_sftpdata(self.server.output_queue)
+
+    def close(self, handle):
+        self.server.input_queue = sftpcmd(SSH2_FXP_CLOSE, sftpstring(handle))
+        self.server.process()
+
+    def test_sequential(self):
+        handle = self.open()
+        data = b''.join(
+            self.read(handle, off) for off in range(0, 17 * 1024, 1024))
+        self.close(handle)
+        self.assertEqual(data, self.content)
+        self.assertTrue(self.storage.prefetched)
+        self.assertEqual(self.server.readahead.buffered, 0)
+
+    def test_memory(self):
+        handle = self.open()
+        self.read(handle, 0)
+        self.read(handle, 1024)
+        # 4 chunks are wanted, but only 3 fit into the memory cap
+        self.assertEqual(self.server.readahead.buffered, 3 * 1024)
+        stream = self.server.handles[handle].readahead
+        self.assertEqual(list(stream.chunks), [2048, 3072, 4096])
+        self.close(handle)
+        self.assertEqual(self.server.readahead.buffered, 0)
+
+    def test_random(self):
+        handle = self.open()
+        for off in (8192, 0, 4096, 1024, 12288):
+            self.assertEqual(
+                self.read(handle, off), self.content[off:off + 1024])
+        self.close(handle)
+        self.assertEqual(self.storage.prefetched, [])
+
+    def test_write(self):
+        handle = self.open(SSH2_FXF_READ | SSH2_FXF_WRITE)
+        self.read(handle, 0)
+        self.read(handle, 1024)
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_WRITE, sftpstring(handle), sftpint64(2048),
+            sftpstring(b'x' * 1024))
+        self.server.process()
+        self.assertEqual(self.server.readahead.buffered, 0)
+        self.assertEqual(self.read(handle, 2048), b'x' * 1024)
+        self.close(handle)
+
+
+if __name__ == "__main__":
+    unittest.main()
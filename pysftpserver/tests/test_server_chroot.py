@@ -1,6 +1,9 @@
 from __future__ import print_function
 
+import hashlib
+import mmap
 import os
+import struct
 import unittest
 from shutil import rmtree
 import stat as stat_lib
@@ -10,8 +13,9 @@ from pysftpserver.server import (SSH2_FILEXFER_ATTR_ACMODTIME,
                                  SSH2_FILEXFER_ATTR_SIZE,
                                  SSH2_FILEXFER_VERSION, SSH2_FXF_CREAT,
                                  SSH2_FXF_EXCL, SSH2_FXF_READ, SSH2_FXF_WRITE,
-                                 SSH2_FXP_CLOSE, SSH2_FXP_FSETSTAT,
-                                 SSH2_FXP_FSTAT, SSH2_FXP_INIT, SSH2_FXP_LSTAT,
+                                 SSH2_FXP_CLOSE, SSH2_FXP_EXTENDED,
+                                 SSH2_FXP_FSETSTAT, SSH2_FXP_FSTAT,
+                                 SSH2_FXP_INIT, SSH2_FXP_LSTAT,
                                  SSH2_FXP_MKDIR, SSH2_FXP_OPEN,
                                  SSH2_FXP_OPENDIR, SSH2_FXP_READ,
                                  SSH2_FXP_READDIR, SSH2_FXP_READLINK,
@@ -21,9 +25,9 @@ from pysftpserver.server import (SSH2_FILEXFER_ATTR_ACMODTIME,
                                  SSH2_FXP_WRITE, SFTPException, SFTPForbidden,
                                  SFTPNotFound, SFTPServer)
 from pysftpserver.tests.utils import (get_sftpdata, get_sftphandle,
-                                      get_sftpint, get_sftpname, get_sftpstat,
-                                      sftpcmd, sftpint, sftpint64, sftpstring,
-                                      t_path)
+                                      get_sftpint, get_sftpname,
+                                      get_sftpnames, get_sftpstat, sftpcmd,
+                                      sftpint, sftpint64, sftpstring, t_path)
 from pysftpserver.virtualchroot import SFTPServerVirtualChroot
 
 
@@ -101,6 +105,81 @@ class ServerTest(unittest.TestCase):
 
         os.unlink('services')
 
+    def test_handle_reuse(self):
+        def open_services():
+            self.server.output_queue = b''
+            self.server.input_queue = sftpcmd(
+                SSH2_FXP_OPEN,
+                sftpstring(b'services'),
+                sftpint(SSH2_FXF_CREAT),
+                sftpint(0)
+            )
+            self.server.process()
+            return get_sftphandle(self.server.output_queue)
+
+        def close(handle):
+            self.server.output_queue = b''
+            self.server.input_queue = sftpcmd(
+                SSH2_FXP_CLOSE,
+                sftpstring(handle)
+            )
+            self.server.process()
+
+        first = open_services()
+        close(first)
+        second = open_services()
+        self.assertEqual(len(first), len(second))
+        self.assertNotEqual(first, second)
+        self.assertEqual(len(self.server.handles), 1)
+
+        # the id of a closed handle is no longer valid
+        self.assertRaises(SFTPException, close, first)
+        close(second)
+        self.assertEqual(len(self.server.handles), 0)
+
+        os.unlink('services')
+
+    def test_handle_state(self):
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_OPEN,
+            sftpstring(b'services'),
+            sftpint(SSH2_FXF_CREAT | SSH2_FXF_WRITE | SSH2_FXF_READ),
+            sftpint(0)
+        )
+        self.server.process()
+        handle = get_sftphandle(self.server.output_queue)
+
+        self.server.output_queue = b''
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_WRITE,
+            sftpstring(handle),
+            sftpint64(0),
+            sftpstring(b'foobar')
+        ) + sftpcmd(
+            SSH2_FXP_READ,
+            sftpstring(handle),
+            sftpint64(3),
+            sftpint(10)
+        )
+        self.server.process()
+
+        record = self.server.handles[handle]
+        self.assertEqual(record.filename, b'services')
+        self.assertFalse(record.is_dir)
+        self.assertTrue(record.read_hooked and record.write_hooked)
+        self.assertEqual(record.bytes_written, 6)
+        self.assertEqual(record.bytes_read, 3)
+
+        self.server.output_queue = b''
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_CLOSE,
+            sftpstring(handle)
+        )
+        self.server.process()
+        self.assertNotIn(handle, self.server.handles)
+
+        os.unlink('services')
+
     def test_stat(self):
         with open("/etc/services") as f:
             with open("services", 'a') as f_bis:
@@ -340,8 +419,7 @@ class ServerTest(unittest.TestCase):
             )
             try:
                 self.server.process()
-                filename = get_sftpname(self.server.output_queue)
-                l.add(filename)
+                l.update(get_sftpnames(self.server.output_queue))
             except:
                 break
         self.assertEqual(l, f)
@@ -467,8 +545,7 @@ class ServerTest(unittest.TestCase):
             )
             try:
                 self.server.process()
-                filename = get_sftpname(self.server.output_queue)
-                l.add(filename)
+                l.update(get_sftpnames(self.server.output_queue))
             except:
                 break
         self.assertEqual(l, f)
@@ -483,6 +560,49 @@ class ServerTest(unittest.TestCase):
         os.unlink("bar")
         os.rmdir("foo")
 
+    def test_readdir_many(self):
+        f = {b'.', b'..'}
+        os.mkdir("foo")
+        for i in range(200):
+            f.add(('file%d' % i).encode())
+            os.close(os.open(os.path.join("foo", "file%d" % i), os.O_CREAT))
+        self.server.readdir_size = 1024
+
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_OPENDIR,
+            sftpstring(b'foo')
+        )
+        self.server.process()
+        handle = get_sftphandle(self.server.output_queue)
+
+        l = set()
+        responses = 0
+        while (True):
+            # reset output queue
+            self.server.output_queue = b''
+            self.server.input_queue = sftpcmd(
+                SSH2_FXP_READDIR,
+                sftpstring(handle),
+            )
+            try:
+                self.server.process()
+                l.update(get_sftpnames(self.server.output_queue))
+                responses += 1
+            except:
+                break
+        self.assertEqual(l, f)
+        self.assertGreater(responses, 1)
+        self.assertLess(responses, len(f) / 2)
+
+        self.server.output_queue = b''
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_CLOSE,
+            sftpstring(handle),
+        )
+        self.server.process()
+
+        rmtree("foo")
+
     def test_symlink(self):
         self.server.input_queue = sftpcmd(
             SSH2_FXP_SYMLINK, sftpstring(b'bad/ugly'),
@@ -543,8 +663,7 @@ class ServerTest(unittest.TestCase):
             )
             try:
                 self.server.process()
-                filename = get_sftpname(self.server.output_queue)
-                l.add(filename)
+                l.update(get_sftpnames(self.server.output_queue))
             except:
                 break
         self.assertEqual(l, f)
@@ -564,6 +683,343 @@ class ServerTest(unittest.TestCase):
         version = get_sftpint(self.server.output_queue)
         self.assertEqual(version, SSH2_FILEXFER_VERSION)
 
+    def test_pipelined_messages(self):
+        mkdir = sftpcmd(SSH2_FXP_MKDIR, sftpstring(b'foo'), sftpint(0))
+        rmdir = sftpcmd(SSH2_FXP_RMDIR, sftpstring(b'foo'))
+        stat = sftpcmd(SSH2_FXP_STAT, sftpstring(b'.'))
+
+        # two complete messages and a truncated one
+        self.server.input_queue = mkdir + rmdir + stat[:7]
+        self.server.process()
+        self.assertEqual(self.server.input_queue, stat[:7])
+        self.assertEqual(len(self.server.output_queue), 2 * 13)
+        self.assertRaises(OSError, os.rmdir, 'foo')
+
+        self.server.output_queue = b''
+        self.server.input_queue += stat[7:]
+        self.server.process()
+        self.assertEqual(self.server.input_queue, b'')
+        self.assertEqual(
+            get_sftpstat(self.server.output_queue)['mode'],
+            os.stat('.').st_mode
+        )
+
+    def test_write_output(self):
+        r, w = os.pipe()
+        self.server.fd_out = w
+        data = b'x' * 100
+        self.server.send_data(1, data, len(data))
+        self.server.send_data(2, memoryview(data)[:10], 10)
+        expected = self.server.output_queue
+
+        self.assertEqual(self.server.write_output(), len(expected))
+        self.assertEqual(self.server.output_queue, b'')
+        self.assertEqual(os.read(r, 4096), expected)
+        self.assertEqual(get_sftpdata(expected), data)
+
+        os.close(r)
+        os.close(w)
+
+    def test_sendfile(self):
+        data = os.urandom(10000)
+        with open('services', 'wb') as f:
+            f.write(data)
+        r, w = os.pipe()
+        server = SFTPServer(
+            SFTPServerVirtualChroot('.'), fd_out=w, sendfile=True)
+
+        def read(handle, off):
+            server.input_queue = sftpcmd(
+                SSH2_FXP_READ, sftpstring(handle), sftpint64(off),
+                sftpint(8192))
+            server.process()
+
+        server.input_queue = sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'services'), sftpint(SSH2_FXF_READ),
+            sftpint(0))
+        server.process()
+        handle = get_sftphandle(server.output_queue)
+        server.output_queue = b''
+
+        read(handle, 0)
+        self.assertEqual(server.write_output(), 13)  # the header
+        self.assertEqual(server.write_output(), 8192)  # the region
+        self.assertEqual(get_sftpdata(os.read(r, 16384)), data[:8192])
+
+        # regions are read before their file is closed
+        read(handle, 8192)
+        server.input_queue = sftpcmd(SSH2_FXP_CLOSE, sftpstring(handle))
+        server.process()
+        self.assertEqual(get_sftpdata(server.output_queue), data[8192:])
+
+        os.close(r)
+        os.close(w)
+        os.unlink('services')
+
+    def test_sendfile_fallback(self):
+        data = os.urandom(10000)
+        with open('services', 'wb') as f:
+            f.write(data)
+        # sendfile fails with EINVAL on the files opened with O_APPEND
+        fd = os.open('output', os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        server = SFTPServer(
+            SFTPServerVirtualChroot('.'), fd_out=fd, sendfile=True)
+        server.input_queue = sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'services'), sftpint(SSH2_FXF_READ),
+            sftpint(0))
+        server.process()
+        handle = get_sftphandle(server.output_queue)
+        server.output_queue = b''
+        server.input_queue = sftpcmd(
+            SSH2_FXP_READ, sftpstring(handle), sftpint64(0), sftpint(8192))
+        server.process()
+
+        while server._output:
+            server.write_output()
+        self.assertFalse(server.sendfile)
+        os.close(fd)
+        with open('output', 'rb') as f:
+            self.assertEqual(get_sftpdata(f.read()), data[:8192])
+        os.unlink('output')
+        os.unlink('services')
+
+    def test_read_into(self):
+        data = os.urandom(10000)
+        with open('services', 'wb') as f:
+            f.write(data)
+        r, w = os.pipe()
+        self.server.fd_out = w
+
+        def read(off):
+            self.server.input_queue = sftpcmd(
+                SSH2_FXP_READ, sftpstring(handle), sftpint64(off),
+                sftpint(8192))
+            self.server.process()
+            self.server.write_output()
+            return get_sftpdata(os.read(r, 16384))
+
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'services'), sftpint(SSH2_FXF_READ),
+            sftpint(0))
+        self.server.process()
+        handle = get_sftphandle(self.server.output_queue)
+        self.server.output_queue = b''
+
+        self.assertEqual(read(0), data[:8192])
+        spare_buffers = list(self.server.spare_buffers)
+        self.assertEqual(len(spare_buffers), 1)
+        self.assertEqual(read(8192), data[8192:])
+        # the same message has been filled again
+        self.assertIs(self.server.spare_buffers[0], spare_buffers[0])
+
+        os.close(r)
+        os.close(w)
+        os.unlink('services')
+
+    def test_mmap(self):
+        data = os.urandom(10000)
+        with open('big', 'wb') as f:
+            f.write(data)
+        with open('small', 'wb') as f:
+            f.write(data[:100])
+        storage = SFTPServerVirtualChroot('.', mmap_threshold=4096)
+        server = SFTPServer(storage)
+
+        def open_file(filename):
+            server.output_queue = b''
+            server.input_queue = sftpcmd(
+                SSH2_FXP_OPEN, sftpstring(filename), sftpint(SSH2_FXF_READ),
+                sftpint(0))
+            server.process()
+            return get_sftphandle(server.output_queue)
+
+        def read(handle, off, size):
+            server.output_queue = b''
+            server.input_queue = sftpcmd(
+                SSH2_FXP_READ, sftpstring(handle), sftpint64(off),
+                sftpint(size))
+            server.process()
+            return get_sftpdata(server.output_queue)
+
+        big = open_file(b'big')
+        small = open_file(b'small')
+        self.assertEqual(len(storage.mappings), 1)
+        self.assertEqual(read(big, 0, 4096), data[:4096])
+        # the queued data is a slice of the mapping, not a copy
+        self.assertIsInstance(server._output[-1].obj, mmap.mmap)
+        self.assertEqual(read(big, 8192, 4096), data[8192:])
+        self.assertEqual(read(small, 0, 4096), data[:100])
+
+        for handle in (big, small):
+            server.input_queue = sftpcmd(SSH2_FXP_CLOSE, sftpstring(handle))
+            server.process()
+        self.assertEqual(storage.mappings, {})
+
+        os.unlink('big')
+        os.unlink('small')
+
+    def test_copy_data(self):
+        data = os.urandom(100000)
+        with open('source', 'wb') as f:
+            f.write(data)
+
+        def open_file(filename, flags):
+            self.server.output_queue = b''
+            self.server.input_queue = sftpcmd(
+                SSH2_FXP_OPEN, sftpstring(filename), sftpint(flags),
+                sftpint(0))
+            self.server.process()
+            return get_sftphandle(self.server.output_queue)
+
+        def copy_data(source, read_off, length, dest, write_off):
+            self.server.output_queue = b''
+            self.server.input_queue = sftpcmd(
+                SSH2_FXP_EXTENDED, sftpstring(b'copy-data'),
+                sftpstring(source), sftpint64(read_off), sftpint64(length),
+                sftpstring(dest), sftpint64(write_off))
+            self.server.process()
+
+        source = open_file(b'source', SSH2_FXF_READ)
+        dest = open_file(b'dest', SSH2_FXF_CREAT | SSH2_FXF_WRITE)
+        copy_data(source, 0, 0, dest, 0)
+        copy_data(source, 1000, 10, dest, 100000)
+        self.assertRaises(SFTPException, copy_data, source, 0, 10, source, 5)
+        for handle in (source, dest):
+            self.server.input_queue = sftpcmd(
+                SSH2_FXP_CLOSE, sftpstring(handle))
+            self.server.process()
+
+        with open('dest', 'rb') as f:
+            self.assertEqual(f.read(), data + data[1000:1010])
+
+        os.unlink('source')
+        os.unlink('dest')
+
+    def test_check_file(self):
+        data = os.urandom(100000)
+        with open('services', 'wb') as f:
+            f.write(data)
+
+        def check_file(request, target, algorithms, start, length,
+                       block_size):
+            self.server.output_queue = b''
+            self.server.input_queue = sftpcmd(
+                SSH2_FXP_EXTENDED, sftpstring(request), sftpstring(target),
+                sftpstring(algorithms), sftpint64(start), sftpint64(length),
+                sftpint(block_size))
+            self.server.process()
+            self.server.wait_responses()  # hashed in the background
+            reply = self.server.output_queue
+            self.assertEqual(reply[9:23], sftpstring(b'check-file'))
+            alen, = struct.unpack('>I', reply[23:27])
+            return reply[27:27 + alen], reply[27 + alen:]
+
+        self.assertEqual(
+            check_file(b'check-file-name', b'services', b'sha256', 0, 0, 0),
+            (b'sha256', hashlib.sha256(data).digest()))
+
+        self.server.output_queue = b''
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'services'), sftpint(SSH2_FXF_READ),
+            sftpint(0))
+        self.server.process()
+        handle = get_sftphandle(self.server.output_queue)
+        algorithm, hashes = check_file(
+            b'check-file-handle', handle, b'foo,md5', 1000, 50000, 4096)
+        self.assertEqual(algorithm, b'md5')
+        self.assertEqual(hashes, b''.join(
+            hashlib.md5(data[off:min(off + 4096, 51000)]).digest()
+            for off in range(1000, 51000, 4096)))
+        self.assertRaises(
+            SFTPException, check_file,
+            b'check-file-handle', handle, b'foo', 0, 0, 0)
+
+        os.unlink('services')
+
+    @unittest.skipUnless(hasattr(os, 'getxattr'), 'no extended attributes')
+    def test_checksum(self):
+        self.server = SFTPServer(
+            SFTPServerVirtualChroot(t_path(self.home)), raise_on_error=True,
+            checksum=b'sha256')
+        data = os.urandom(100000)
+
+        def upload(filename, offsets):
+            self.server.output_queue = b''
+            self.server.input_queue = sftpcmd(
+                SSH2_FXP_OPEN, sftpstring(filename),
+                sftpint(SSH2_FXF_CREAT | SSH2_FXF_WRITE), sftpint(0))
+            self.server.process()
+            handle = get_sftphandle(self.server.output_queue)
+            for off in offsets:
+                self.server.input_queue = sftpcmd(
+                    SSH2_FXP_WRITE, sftpstring(handle), sftpint64(off),
+                    sftpstring(data[off:off + 32768]))
+                self.server.process()
+            self.server.input_queue = sftpcmd(
+                SSH2_FXP_CLOSE, sftpstring(handle))
+            self.server.process()
+
+        digest = hashlib.sha256(data).hexdigest()
+        upload(b'sequential', range(0, len(data), 32768))
+        self.assertTrue(
+            os.getxattr('sequential', 'user.sftp.sha256').endswith(
+                digest.encode()))
+        upload(b'shuffled', reversed(range(0, len(data), 32768)))
+        self.assertRaises(
+            OSError, os.getxattr, 'shuffled', 'user.sftp.sha256')
+
+        # check-file answers with the stored digest, while it's up to date
+        self.server.output_queue = b''
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_EXTENDED, sftpstring(b'check-file-name'),
+            sftpstring(b'sequential'), sftpstring(b'sha256'), sftpint64(0),
+            sftpint64(0), sftpint(0))
+        self.server.process()
+        self.server.wait_responses()
+        self.assertTrue(self.server.output_queue.endswith(
+            hashlib.sha256(data).digest()))
+
+    @unittest.skipUnless(hasattr(os, 'getxattr'), 'no extended attributes')
+    def test_checksum_shared(self):
+        self.server = SFTPServer(
+            SFTPServerVirtualChroot(t_path(self.home)), raise_on_error=True,
+            checksum=b'sha256')
+
+        def request(msg_type, *args):
+            self.server.output_queue = b''
+            self.server.input_queue = sftpcmd(msg_type, *args)
+            self.server.process()
+            return self.server.output_queue
+
+        def open_file(filename):
+            return get_sftphandle(request(
+                SSH2_FXP_OPEN, sftpstring(filename),
+                sftpint(SSH2_FXF_CREAT | SSH2_FXF_WRITE), sftpint(0)))
+
+        def write(handle, chunk):
+            request(SSH2_FXP_WRITE, sftpstring(handle), sftpint64(0),
+                    sftpstring(chunk))
+
+        # the same file, written through two handles at once
+        first = open_file(b'shared')
+        second = open_file(
+            os.path.join(self.server.storage.home, 'shared').encode())
+        write(first, b'a' * 1000)
+        write(second, b'b' * 1000)
+        for handle in (first, second):
+            request(SSH2_FXP_CLOSE, sftpstring(handle))
+        self.assertRaises(
+            OSError, os.getxattr, 'shared', 'user.sftp.sha256')
+
+        # truncated through its path while it's open
+        handle = open_file(b'./truncated')
+        write(handle, b'a' * 1000)
+        request(SSH2_FXP_SETSTAT, sftpstring(b'truncated'),
+                sftpint(SSH2_FILEXFER_ATTR_SIZE), sftpint64(0))
+        request(SSH2_FXP_CLOSE, sftpstring(handle))
+        self.assertRaises(
+            OSError, os.getxattr, 'truncated', 'user.sftp.sha256')
+
     def test_rmdir_notfound(self):
         self.server.input_queue = sftpcmd(
             SSH2_FXP_RMDIR, sftpstring(b'bad/ugly'), sftpint(0))
@@ -643,6 +1099,76 @@ class ServerTest(unittest.TestCase):
 
         os.unlink('services')
 
+    def test_storage_vectored(self):
+        storage = self.server.storage
+        handle = storage.open(b'vectored', os.O_CREAT | os.O_RDWR, 0o644)
+        self.assertTrue(storage.writev(handle, 4, [b'abcd', b'efgh', b'ij']))
+        self.assertTrue(storage.write(handle, 0, b'0123'))
+        chunks = storage.readv(
+            handle, [(0, 4), (4, 4), (10, 2), (12, 4), (16, 4), (0, 2)])
+        storage.close(handle)
+        self.assertEqual(
+            [b'0123', b'abcd', b'gh', b'ij', b'', b'01'],
+            [bytes(chunk) for chunk in chunks]
+        )
+        os.unlink('vectored')
+
+    def test_storage_scandir(self):
+        with open('entry', 'wb') as f:
+            f.write(b'0123456789')
+        os.chmod('entry', 0o640)
+        os.symlink('infound', 'dangling')
+
+        storage = self.server.storage
+        home = os.fsencode(storage.home)
+        entries = storage.opendir(home)
+        self.assertEqual([b'.', b'..'], [next(entries), next(entries)])
+        attrs = {}
+        for entry in entries:
+            self.assertIsInstance(entry, os.DirEntry)
+            attrs[entry.name] = storage.stat(entry, parent=home)
+        storage.close(entries)
+
+        self.assertEqual({b'entry', b'dangling'}, set(attrs))
+        self.assertEqual(10, attrs[b'entry'].size)
+        self.assertEqual(
+            stat_lib.S_IFREG | 0o640, attrs[b'entry'].perm)
+        self.assertEqual(os.stat('entry').st_mtime, attrs[b'entry'].mtime)
+        self.assertTrue(attrs[b'entry'].longname.endswith(b' entry'))
+        # the broken symlink is stat'ed as a link, not as its target
+        self.assertTrue(stat_lib.S_ISLNK(attrs[b'dangling'].perm))
+        self.assertEqual(
+            os.lstat('dangling').st_size, attrs[b'dangling'].size)
+        self.assertTrue(attrs[b'dangling'].longname.endswith(b' dangling'))
+
+        os.unlink('entry')
+        os.unlink('dangling')
+
+    def test_scandir_close(self):
+        for i in range(3):
+            os.close(os.open("file%d" % i, os.O_CREAT))
+
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_OPENDIR,
+            sftpstring(b'.')
+        )
+        self.server.process()
+        handle = get_sftphandle(self.server.output_queue)
+        entries = self.server.handles[handle].handle
+
+        self.server.output_queue = b''
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_CLOSE,
+            sftpstring(handle),
+        )
+        self.server.process()
+        self.assertNotIn(handle, self.server.handles)
+        # a closed os.scandir iterator yields nothing more
+        self.assertEqual([], list(entries.entries))
+
+        for i in range(3):
+            os.unlink("file%d" % i)
+
     @classmethod
     def tearDownClass(cls):
         os.unlink(t_path("log"))  # comment me to see the log!
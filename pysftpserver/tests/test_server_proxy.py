@@ -348,8 +348,7 @@ class TestProxyServer(unittest.TestCase):
             )
             try:
                 self.server.process()
-                filename = get_sftpname(self.server.output_queue)
-                l.add(filename)
+                l.update(get_sftpnames(self.server.output_queue))
             except:
                 break
         self.assertEqual(l, f)
@@ -463,8 +462,7 @@ class TestProxyServer(unittest.TestCase):
             )
             try:
                 self.server.process()
-                filename = get_sftpname(self.server.output_queue)
-                l.add(filename)
+                l.update(get_sftpnames(self.server.output_queue))
             except:
                 break
         self.assertEqual(l, f)
@@ -526,8 +524,7 @@ class TestProxyServer(unittest.TestCase):
             )
             try:
                 self.server.process()
-                filename = get_sftpname(self.server.output_queue)
-                l.add(filename)
+                l.update(get_sftpnames(self.server.output_queue))
             except:
                 break
         self.assertEqual(l, f)
@@ -0,0 +1,250 @@
+import hashlib
+import os
+import struct
+import threading
+import time
+import unittest
+
+from pysftpserver.server import (SSH2_FX_OK, SSH2_FXF_CREAT, SSH2_FXF_READ,
+                                 SSH2_FXF_WRITE, SSH2_FXP_ATTRS,
+                                 SSH2_FXP_CLOSE, SSH2_FXP_DATA,
+                                 SSH2_FXP_EXTENDED, SSH2_FXP_EXTENDED_REPLY,
+                                 SSH2_FXP_MKDIR, SSH2_FXP_OPEN,
+                                 SSH2_FXP_READ, SSH2_FXP_STAT,
+                                 SSH2_FXP_STATUS, SSH2_FXP_WRITE, SFTPServer)
+from pysftpserver.storage import SFTPServerStorage
+from pysftpserver.tests.utils import (HeldStorage, HomeTestCase,
+                                      get_sftphandle, get_sftpid,
+                                      get_sftpresponses, sftpcmd, sftpint,
+                                      sftpint64, sftpstring, t_path)
+
+
+class SlowStorage(SFTPServerStorage):
+    """Hold the stat of 'slow' and the mkdir of 'late' until the event is
+    set."""
+
+    def __init__(self, *args, **kwargs):
+        super(SlowStorage, self).__init__(*args, **kwargs)
+        self.event = threading.Event()
+
+    def stat(self, filename, *args, **kwargs):
+        if filename == b'slow':
+            self.event.wait(5)
+        return super(SlowStorage, self).stat(filename, *args, **kwargs)
+
+    def mkdir(self, filename, mode):
+        if filename == b'late':
+            self.event.wait(5)
+        return super(SlowStorage, self).mkdir(filename, mode)
+
+
+class ServerWorkersTest(HomeTestCase):
+
+    def setUp(self):
+        super(ServerWorkersTest, self).setUp()
+        self.storage = SlowStorage(self.home)
+        self.server = SFTPServer(
+            self.storage,
+            logfile=t_path('log'),
+            workers=4
+        )
+
+    def tearDown(self):
+        self.storage.event.set()
+        self.server.workers.shutdown()
+        super(ServerWorkersTest, self).tearDown()
+
+    def test_out_of_order(self):
+        os.mkdir('slow')
+        slow = sftpcmd(SSH2_FXP_STAT, sftpstring(b'slow'))
+        fast = sftpcmd(SSH2_FXP_STAT, sftpstring(b'.'))
+
+        self.server.input_queue = slow + fast
+        self.server.process()
+        self.server.workers.wait()
+        self.server.collect_responses()
+        self.storage.event.set()
+        self.server.wait_responses()
+
+        responses = get_sftpresponses(self.server.output_queue)
+        self.assertEqual(
+            [(SSH2_FXP_ATTRS, get_sftpid(fast)),
+             (SSH2_FXP_ATTRS, get_sftpid(slow))],
+            [r[:2] for r in responses]
+        )
+
+    def test_path_order(self):
+        mkdir = sftpcmd(SSH2_FXP_MKDIR, sftpstring(b'late'), sftpint(0))
+        stat = sftpcmd(SSH2_FXP_STAT, sftpstring(b'late'))
+
+        self.server.input_queue = mkdir + stat
+        self.server.process()
+        time.sleep(0.1)  # time enough for the stat to overtake the mkdir
+        self.storage.event.set()
+        self.server.wait_responses()
+
+        responses = get_sftpresponses(self.server.output_queue)
+        self.assertEqual(
+            [(SSH2_FXP_STATUS, get_sftpid(mkdir)),
+             (SSH2_FXP_ATTRS, get_sftpid(stat))],
+            [r[:2] for r in responses]
+        )
+
+    def test_handle_order(self):
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_OPEN,
+            sftpstring(b'services'),
+            sftpint(SSH2_FXF_CREAT | SSH2_FXF_WRITE | SSH2_FXF_READ),
+            sftpint(0)
+        )
+        self.server.process()
+        self.server.wait_responses()
+        handle = get_sftphandle(self.server.output_queue)
+
+        chunks = [os.urandom(1000) for i in range(50)]
+        cmds = [
+            sftpcmd(
+                SSH2_FXP_WRITE,
+                sftpstring(handle),
+                sftpint64(i * 1000),
+                sftpstring(chunk)
+            ) for i, chunk in enumerate(chunks)
+        ]
+        cmds.append(sftpcmd(
+            SSH2_FXP_READ,
+            sftpstring(handle),
+            sftpint64(0),
+            sftpint(50 * 1000)
+        ))
+        cmds.append(sftpcmd(SSH2_FXP_CLOSE, sftpstring(handle)))
+
+        self.server.output_queue = b''
+        self.server.input_queue = b''.join(cmds)
+        self.server.process()
+        self.server.wait_responses()
+
+        responses = get_sftpresponses(self.server.output_queue)
+        self.assertEqual([get_sftpid(cmd) for cmd in cmds],
+                         [r[1] for r in responses])
+        for msg_type, msg_id, msg in responses[:50] + responses[-1:]:
+            self.assertEqual(msg_type, SSH2_FXP_STATUS)
+            self.assertEqual(struct.unpack('>I', msg[9:13])[0], SSH2_FX_OK)
+        self.assertEqual(responses[50][0], SSH2_FXP_DATA)
+        self.assertEqual(responses[50][2][13:], b''.join(chunks))
+        self.assertEqual(len(self.server.handles), 0)
+
+        os.unlink('services')
+
+    def test_extended_order(self):
+        handles = []
+        for filename in (b'source', b'dest'):
+            self.server.output_queue = b''
+            self.server.input_queue = sftpcmd(
+                SSH2_FXP_OPEN,
+                sftpstring(filename),
+                sftpint(SSH2_FXF_CREAT | SSH2_FXF_WRITE | SSH2_FXF_READ),
+                sftpint(0)
+            )
+            self.server.process()
+            self.server.wait_responses()
+            handles.append(get_sftphandle(self.server.output_queue))
+        source, dest = handles
+
+        chunks = [os.urandom(1000) for i in range(50)]
+        cmds = [
+            sftpcmd(
+                SSH2_FXP_WRITE,
+                sftpstring(source),
+                sftpint64(i * 1000),
+                sftpstring(chunk)
+            ) for i, chunk in enumerate(chunks)
+        ]
+        # copy-data waits for the writes to source
+        cmds.append(sftpcmd(
+            SSH2_FXP_EXTENDED,
+            sftpstring(b'copy-data'),
+            sftpstring(source),
+            sftpint64(0),
+            sftpint64(0),
+            sftpstring(dest),
+            sftpint64(0)
+        ))
+        # and check-file-handle for the copy to dest
+        cmds.append(sftpcmd(
+            SSH2_FXP_EXTENDED,
+            sftpstring(b'check-file-handle'),
+            sftpstring(dest),
+            sftpstring(b'sha256'),
+            sftpint64(0),
+            sftpint64(0),
+            sftpint(0)
+        ))
+        cmds.extend(
+            sftpcmd(SSH2_FXP_CLOSE, sftpstring(handle)) for handle in handles)
+
+        self.server.output_queue = b''
+        self.server.input_queue = b''.join(cmds)
+        self.server.process()
+        self.server.wait_responses()
+
+        # the closes of different handles may be answered in any order
+        responses = {
+            r[1]: r for r in get_sftpresponses(self.server.output_queue)}
+        responses = [responses[get_sftpid(cmd)] for cmd in cmds]
+        for msg_type, msg_id, msg in responses[:51] + responses[-2:]:
+            self.assertEqual(msg_type, SSH2_FXP_STATUS)
+            self.assertEqual(struct.unpack('>I', msg[9:13])[0], SSH2_FX_OK)
+        self.assertEqual(responses[51][0], SSH2_FXP_EXTENDED_REPLY)
+        self.assertEqual(
+            responses[51][2][-32:], hashlib.sha256(b''.join(chunks)).digest())
+        with open('dest', 'rb') as f:
+            self.assertEqual(f.read(), b''.join(chunks))
+        self.assertEqual(len(self.server.handles), 0)
+
+        os.unlink('source')
+        os.unlink('dest')
+
+
+class ServerBackgroundTest(HomeTestCase):
+
+    def test_check_file(self):
+        data = os.urandom(100000)
+        with open(os.path.join(self.home, 'file'), 'wb') as f:
+            f.write(data)
+        storage = HeldStorage(self.home)
+        server = SFTPServer(storage, logfile=t_path('log'))
+        server.input_queue = sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'file'), sftpint(SSH2_FXF_READ),
+            sftpint(0))
+        server.process()
+        handle = get_sftphandle(server.output_queue)
+        check = sftpcmd(
+            SSH2_FXP_EXTENDED, sftpstring(b'check-file-handle'),
+            sftpstring(handle), sftpstring(b'sha256'), sftpint64(0),
+            sftpint64(0), sftpint(0))
+        stat = sftpcmd(SSH2_FXP_STAT, sftpstring(b'.'))
+
+        server.output_queue = b''
+        server.input_queue = check + stat
+        server.process()
+        # the file is still being hashed, without workers too
+        self.assertEqual(
+            [(SSH2_FXP_ATTRS, get_sftpid(stat))],
+            [r[:2] for r in get_sftpresponses(server.output_queue)]
+        )
+        storage.event.set()
+        server.wait_responses()
+        server.background.shutdown()
+
+        responses = get_sftpresponses(server.output_queue)
+        self.assertEqual(
+            [(SSH2_FXP_ATTRS, get_sftpid(stat)),
+             (SSH2_FXP_EXTENDED_REPLY, get_sftpid(check))],
+            [r[:2] for r in responses]
+        )
+        self.assertEqual(
+            responses[1][2][-32:], hashlib.sha256(data).digest())
+
+
+if __name__ == "__main__":
+    unittest.main()
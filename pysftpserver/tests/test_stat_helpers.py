@@ -0,0 +1,38 @@
+import os
+import stat
+import unittest
+
+from pysftpserver.stat_helpers import filemode, stat_to_longname
+
+
+class FakeStat(object):
+    st_mode = stat.S_IFREG | 0o4751
+    st_nlink = 2
+    st_uid = 2 ** 31 - 3  # hopefully no one
+    st_gid = 2 ** 31 - 3
+    st_size = 1234
+    st_mtime = 1234567890.5
+
+
+class StatHelpersTest(unittest.TestCase):
+
+    def test_filemode(self):
+        for mode in (stat.S_IFDIR | 0o755, stat.S_IFREG | 0o644,
+                     stat.S_IFLNK | 0o777, stat.S_IFIFO | 0o600,
+                     stat.S_IFDIR | 0o1777, stat.S_IFREG | 0o6754,
+                     stat.S_IFREG | 0o7000):
+            self.assertEqual(filemode(mode), stat.filemode(mode).encode())
+
+    def test_longname(self):
+        self.assertEqual(
+            stat_to_longname(FakeStat, b'foo'),
+            '-rwsr-x--x 2   {0} {0} 1234      Feb 13 23:31 foo'.format(
+                FakeStat.st_uid).encode())
+
+        longname = stat_to_longname(os.lstat('/'), b'/')
+        self.assertTrue(longname.startswith(b'd'))
+        self.assertTrue(longname.endswith(b' /'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+import os
+import struct
+import unittest
+
+from pysftpserver.server import (SSH2_FILEXFER_ATTR_PERMISSIONS,
+                                 SSH2_FX_NO_SUCH_FILE, SSH2_FXF_CREAT,
+                                 SSH2_FXF_WRITE, SSH2_FXP_ATTRS,
+                                 SSH2_FXP_CLOSE, SSH2_FXP_MKDIR,
+                                 SSH2_FXP_OPEN, SSH2_FXP_RENAME,
+                                 SSH2_FXP_SETSTAT, SSH2_FXP_STAT,
+                                 SSH2_FXP_WRITE, SFTPServer)
+from pysftpserver.statcache import SFTPStatCache
+from pysftpserver.tests.utils import (CountingStorage, HomeTestCase,
+                                      get_sftphandle, get_sftpstat, sftpcmd,
+                                      sftpint, sftpint64, sftpstring, t_path)
+
+
+class StatCacheTest(HomeTestCase):
+
+    def setUp(self):
+        super(StatCacheTest, self).setUp()
+        self.storage = CountingStorage(self.home)
+        self.cache = SFTPStatCache(self.storage, ttl=60)
+        self.server = SFTPServer(self.cache, logfile=t_path('log'))
+
+    def request(self, *args):
+        self.server.output_queue = b''
+        self.server.input_queue = sftpcmd(*args)
+        self.server.process()
+        return self.server.output_queue
+
+    def stat(self, filename):
+        reply = self.request(SSH2_FXP_STAT, sftpstring(filename))
+        if reply[4:5] != struct.pack('>B', SSH2_FXP_ATTRS):
+            return struct.unpack('>I', reply[9:13])[0]
+        return get_sftpstat(reply)
+
+    def upload(self, filename, data):
+        handle = get_sftphandle(self.request(
+            SSH2_FXP_OPEN, sftpstring(filename),
+            sftpint(SSH2_FXF_CREAT | SSH2_FXF_WRITE), sftpint(0)))
+        self.request(SSH2_FXP_WRITE, sftpstring(handle), sftpint64(0),
+                     sftpstring(data))
+        self.request(SSH2_FXP_CLOSE, sftpstring(handle))
+
+    def test_cache(self):
+        self.upload(b'file', b'x' * 10)
+        self.assertEqual(self.stat(b'file')['size'], 10)
+        self.assertEqual(self.stat(b'file')['size'], 10)
+        self.assertEqual(self.storage.stats, [b'file'])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+        # the server's own changes are seen at once
+        self.upload(b'file', b'x' * 20)
+        self.assertEqual(self.stat(b'file')['size'], 20)
+        self.request(SSH2_FXP_SETSTAT, sftpstring(b'file'),
+                     sftpint(SSH2_FILEXFER_ATTR_PERMISSIONS), sftpint(0o600))
+        self.assertEqual(self.stat(b'file')['mode'] & 0o777, 0o600)
+        self.assertEqual(self.storage.stats, [b'file'] * 3)
+
+        self.request(SSH2_FXP_MKDIR, sftpstring(b'dir'), sftpint(0))
+        self.upload(b'dir/file', b'x')
+        self.assertEqual(self.stat(b'dir/file')['size'], 1)
+        self.request(SSH2_FXP_RENAME, sftpstring(b'dir'), sftpstring(b'moved'))
+        self.assertEqual(self.stat(b'dir/file'), SSH2_FX_NO_SUCH_FILE)
+
+        # the others' after ttl seconds
+        with open('file', 'ab') as f:
+            f.write(b'x')
+        self.assertEqual(self.stat(b'file')['size'], 20)
+        self.cache.ttl = 0
+        self.assertEqual(self.stat(b'file')['size'], 21)
+
+    def test_spellings(self):
+        self.upload(b'g', b'x' * 10)
+        absolute = os.path.join(self.storage.home, 'g').encode()
+        self.assertEqual(self.stat(absolute)['size'], 10)
+        self.assertEqual(self.stat(b'./g')['size'], 10)
+        self.assertEqual(self.cache.hits, 1)
+
+        # the changes through a spelling are seen through the others
+        self.upload(b'g', b'x' * 20)
+        self.assertEqual(self.stat(absolute)['size'], 20)
+        self.upload(absolute, b'x' * 30)
+        self.assertEqual(self.stat(b'g')['size'], 30)
+
+    def test_missing(self):
+        self.assertEqual(self.stat(b'dir/file'), SSH2_FX_NO_SUCH_FILE)
+        self.assertEqual(self.stat(b'dir/file'), SSH2_FX_NO_SUCH_FILE)
+        self.request(SSH2_FXP_MKDIR, sftpstring(b'dir'), sftpint(0))
+        self.assertEqual(self.stat(b'dir/file'), SSH2_FX_NO_SUCH_FILE)
+        self.assertEqual(self.storage.stats, [b'dir/file'])
+        self.assertEqual(self.cache.hits, 2)
+
+        # creating anything in the directory forgets its missing paths
+        self.upload(b'dir/other', b'x')
+        self.assertEqual(self.cache.missing, {})
+        open('dir/file', 'wb').close()
+        self.assertEqual(self.stat(b'dir/file')['size'], 0)
+
+        self.cache.negative_ttl = 0
+        self.assertEqual(self.stat(b'foo'), SSH2_FX_NO_SUCH_FILE)
+        self.assertEqual(self.stat(b'foo'), SSH2_FX_NO_SUCH_FILE)
+        self.assertEqual(self.storage.stats[-2:], [b'foo', b'foo'])
+
+    def test_missing_spellings(self):
+        absolute = os.path.join(self.storage.home, 'g').encode()
+        self.assertEqual(self.stat(b'g'), SSH2_FX_NO_SUCH_FILE)
+        self.assertEqual(self.stat(b'./g'), SSH2_FX_NO_SUCH_FILE)
+        self.assertEqual(self.stat(absolute), SSH2_FX_NO_SUCH_FILE)
+        self.assertEqual(self.storage.stats, [b'g'])
+
+        self.upload(absolute, b'x')
+        self.assertEqual(self.stat(b'g')['size'], 1)
+
+    def test_eviction(self):
+        self.cache.size = 1
+        self.upload(b'a', b'a')
+        self.upload(b'b', b'b')
+        for filename in (b'a', b'b', b'a'):
+            self.stat(filename)
+        self.assertEqual(self.storage.stats, [b'a', b'b', b'a'])
+        self.assertEqual(len(self.cache.cache), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import struct
+import unittest
+
+from pysftpserver.server import (SSH2_FX_FAILURE, SSH2_FX_OK, SSH2_FXF_CREAT,
+                                 SSH2_FXF_WRITE, SSH2_FXP_CLOSE,
+                                 SSH2_FXP_FSTAT, SSH2_FXP_OPEN,
+                                 SSH2_FXP_WRITE, SFTPServer)
+from pysftpserver.tests.utils import (CountingStorage, HomeTestCase,
+                                      get_sftphandle, get_sftpstat, sftpcmd,
+                                      sftpint, sftpint64, sftpstring, t_path)
+
+
+class WriteBehindTest(HomeTestCase):
+
+    def setUp(self):
+        super(WriteBehindTest, self).setUp()
+        self.storage = CountingStorage(self.home)
+        self.server = SFTPServer(
+            self.storage,
+            logfile=t_path('log'),
+            writebehind=4096
+        )
+
+    def open(self):
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_OPEN, sftpstring(b'file'),
+            sftpint(SSH2_FXF_CREAT | SSH2_FXF_WRITE), sftpint(0))
+        self.server.process()
+        handle = get_sftphandle(self.server.output_queue)
+        self.server.output_queue = b''
+        return handle
+
+    def write(self, handle, off, chunk):
+        self.server.input_queue = sftpcmd(
+            SSH2_FXP_WRITE, sftpstring(handle), sftpint64(off),
+            sftpstring(chunk))
+        self.server.process()
+        status, = struct.unpack('>I', self.server.output_queue[9:13])
+        self.server.output_queue = b''
+        return status
+
+    def close(self, handle):
+        self.server.input_queue = sftpcmd(SSH2_FXP_CLOSE, sftpstring(handle))
+        self.server.process()
+        status, = struct.unpack('>I', self.server.output_queue[9:13])
+        self.server.output_queue = b''
+        return status
+
+    def test_sequential(self):
+        content = os.urandom(10 * 1024)
+        handle = self.open()
+        for off in range(0, len(content), 1024):
+            self.assertEqual(
+                self.write(handle, off, content[off:off + 1024]), SSH2_FX_OK)
+        self.assertEqual(self.close(handle), SSH2_FX_OK)
+        self.assertEqual(self.storage.writes, [4096, 4096, 2048])
+        with open('file', 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_random(self):
+        handle = self.open()
+        for off in (2048, 0, 1024, 3072):
+            self.write(handle, off, b'x' * 1024)
+        self.close(handle)
+        self.assertEqual(self.storage.writes, [1024, 2048, 1024])
+        with open('file', 'rb') as f:
+            self.assertEqual(f.read(), b'x' * 4096)
+
+    def test_fstat(self):
+        handle = self.open()
+        self.write(handle, 0, b'x' * 1024)
+        self.server.input_queue = sftpcmd(SSH2_FXP_FSTAT, sftpstring(handle))
+        self.server.process()
+        stat = get_sftpstat(self.server.output_queue)
+        self.assertEqual(stat['size'], 1024)
+        self.close(handle)
+
+    def test_failure(self):
+        self.storage.fail = True
+        handle = self.open()
+        self.assertEqual(self.write(handle, 0, b'x' * 1024), SSH2_FX_OK)
+        self.assertEqual(self.close(handle), SSH2_FX_FAILURE)
+        self.assertEqual(len(self.server.handles), 0)
+
+    def test_disconnect(self):
+        handle = self.open()
+        self.assertEqual(self.write(handle, 0, b'x' * 1000), SSH2_FX_OK)
+        self.assertEqual(os.path.getsize('file'), 0)  # still buffered
+        r, w = os.pipe()
+        os.close(w)
+        self.server.fd_in = r
+        self.assertTrue(self.server.run_once())  # stdin has been closed
+        os.close(r)
+        self.assertEqual(os.path.getsize('file'), 1000)
+        self.assertEqual(len(self.server.handles), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -3,6 +3,11 @@
 import os
 import struct
 import random
+import threading
+import unittest
+from shutil import rmtree
+
+from pysftpserver.storage import SFTPServerStorage
 
 root_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -12,6 +17,74 @@ def t_path(filename='.'):
     return os.path.join(root_path, filename)
 
 
+class CountingStorage(SFTPServerStorage):
+    """Remember the calls: the (offset, size) of the reads (the offsets of
+    the ones made in background threads in prefetched too), the size of the
+    writes and the paths stat'ed. The writes fail silently if fail is
+    set."""
+
+    def __init__(self, *args, **kwargs):
+        super(CountingStorage, self).__init__(*args, **kwargs)
+        self.reads = []
+        self.prefetched = []
+        self.writes = []
+        self.stats = []
+        self.fail = False
+
+    def read(self, handle, off, size):
+        self.reads.append((off, size))
+        if threading.current_thread() is not threading.main_thread():
+            self.prefetched.append(off)
+        return super(CountingStorage, self).read(handle, off, size)
+
+    def write(self, handle, off, chunk):
+        self.writes.append(len(chunk))
+        if not self.fail:
+            return super(CountingStorage, self).write(handle, off, chunk)
+
+    def writev(self, handle, off, chunks):
+        self.writes.append(sum(len(chunk) for chunk in chunks))
+        if not self.fail:
+            return super(CountingStorage, self).writev(handle, off, chunks)
+
+    def stat(self, filename, *args, **kwargs):
+        self.stats.append(filename)
+        return super(CountingStorage, self).stat(filename, *args, **kwargs)
+
+
+class HeldStorage(SFTPServerStorage):
+    """Hold every read until the event is set."""
+
+    def __init__(self, *args, **kwargs):
+        super(HeldStorage, self).__init__(*args, **kwargs)
+        self.event = threading.Event()
+
+    def read(self, handle, off, size):
+        self.event.wait(5)
+        return super(HeldStorage, self).read(handle, off, size)
+
+
+class HomeTestCase(unittest.TestCase):
+    """Run each test in the test directory, with an empty home directory
+    (removed afterwards along with the log)."""
+
+    def setUp(self):
+        os.chdir(t_path())
+        self.home = 'home'
+        if not os.path.isdir(self.home):
+            os.mkdir(self.home)
+
+    def tearDown(self):
+        os.chdir(t_path())
+        rmtree(self.home)
+
+    @classmethod
+    def tearDownClass(cls):
+        if os.path.exists(t_path('log')):
+            os.unlink(t_path('log'))  # comment me to see the log!
+        rmtree(t_path('home'), ignore_errors=True)
+
+
 def sftpstring(s):
     return struct.pack('>I', len(s)) + s
 
@@ -31,6 +104,21 @@ def sftpcmd(cmd, *args):
     return sftpint(len(msg)) + msg
 
 
+def get_sftpid(cmd):
+    value, = struct.unpack('>I', cmd[5:9])
+    return value
+
+
+def get_sftpresponses(blob):
+    """Split a blob of messages in (type, id, message) tuples."""
+    responses = []
+    while blob:
+        msg_len, msg_type, msg_id = struct.unpack('>IBI', blob[:9])
+        responses.append((msg_type, msg_id, blob[:4 + msg_len]))
+        blob = blob[4 + msg_len:]
+    return responses
+
+
 def get_sftphandle(blob):
     slen, = struct.unpack('>I', blob[9:13])
     return blob[13:13 + slen]
@@ -46,6 +134,20 @@ def get_sftpname(blob):
     return blob[17:17 + namelen]
 
 
+def get_sftpnames(blob):
+    count, = struct.unpack('>I', blob[9:13])
+    names = []
+    pos = 13
+    for i in range(count):
+        namelen, = struct.unpack('>I', blob[pos:pos + 4])
+        names.append(blob[pos + 4:pos + 4 + namelen])
+        pos += 4 + namelen
+        longnamelen, = struct.unpack('>I', blob[pos:pos + 4])
+        pos += 4 + longnamelen
+        pos += 32  # flags and the attributes always sent by the server
+    return names
+
+
 def get_sftpstat(blob):
     attrs = dict()
     (attrs['size'], attrs['uid'], attrs['gid'], attrs['mode'], attrs['atime'],
@@ -0,0 +1,95 @@
+"""Run the server requests in a pool of threads."""
+
+import collections
+import fcntl
+import os
+import select
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SFTPWorkerPool(object):
+    """A pool of threads executing calls grouped in lanes.
+
+    Calls submitted on the same lane are executed one after the other, in
+    submission order, while calls on different lanes (or on no lane at all)
+    run concurrently. The results are collected by the thread owning the
+    pool, in completion order: a byte is written to wakeup_fd each time a
+    call completes, so that it can be watched by select and friends.
+    """
+
+    def __init__(self, workers):
+        self.executor = ThreadPoolExecutor(workers)
+        self.wakeup_fd, self.notify_fd = os.pipe()
+        fcntl.fcntl(self.wakeup_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.lanes = dict()  # lane -> calls waiting for the running one
+        self.completed = collections.deque()
+        self.pending = 0  # calls submitted and not yet collected
+
+    def submit(self, lane, fn, *args):
+        """Execute fn(*args) in a worker thread.
+
+        Args:
+            lane (hashable): Calls on the same lane are executed in order.
+                None if the call can run concurrently with any other.
+            fn (callable): The function to call.
+        """
+        if lane is not None:
+            if lane in self.lanes:
+                self.lanes[lane].append((fn, args))
+                return
+            self.lanes[lane] = collections.deque()
+        self._start(lane, fn, args)
+
+    def busy(self, lane):
+        """Check if a call of the lane is running or waiting to.
+
+        Args:
+            lane (hashable): The lane.
+
+        Returns:
+            (bool): True if a call of the lane hasn't been collected yet.
+        """
+        return lane in self.lanes
+
+    def _start(self, lane, fn, args):
+        self.pending += 1
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(lambda f: self._done(lane, f))
+
+    def _done(self, lane, future):
+        # called by the worker thread
+        self.completed.append((lane, future))
+        os.write(self.notify_fd, b'\0')
+
+    def collect(self):
+        """Yield the results of the completed calls.
+
+        The exception raised by a call is raised again here.
+        """
+        try:
+            while os.read(self.wakeup_fd, 4096):
+                pass
+        except OSError:
+            pass  # nothing more to read
+        while self.completed:
+            lane, future = self.completed.popleft()
+            self.pending -= 1
+            if lane is not None:
+                waiting = self.lanes[lane]
+                if waiting:
+                    self._start(lane, *waiting.popleft())
+                else:
+                    del self.lanes[lane]
+            yield future.result()
+
+    def wait(self):
+        """Block until at least a call completes."""
+        if self.pending and not self.completed:
+            select.select([self.wakeup_fd], [], [])
+
+    def shutdown(self):
+        """Wait for the running calls and stop the threads."""
+        self.lanes.clear()
+        self.executor.shutdown(wait=True)
+        os.close(self.wakeup_fd)
+        os.close(self.notify_fd)
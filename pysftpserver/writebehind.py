@@ -0,0 +1,70 @@
+"""Write-behind buffering of the file handles."""
+
+import functools
+
+from pysftpserver.abstractstorage import (SFTPAbstractServerStorage,
+                                          get_shortcut)
+from pysftpserver.pysftpexceptions import SFTPException
+
+
+class SFTPWriteBehind(object):
+    """Acknowledge the contiguous writes of a handle as soon as they are
+    received, collecting them into a buffer of up to size bytes that is
+    written to the storage at once (see the storage writev).
+
+    The buffer is flushed when a write is not contiguous or doesn't fit,
+    and before reading, stating, truncating or closing the handle: a
+    failure is thus reported to one of those requests, instead of to the
+    write that caused it.
+    """
+
+    def __init__(self, storage, size=1024 * 1024):
+        self.storage = storage
+        self.size = size
+        # the storage writev, unless it overrides write alone
+        self.writev = get_shortcut(storage, 'writev', 'write') or \
+            functools.partial(SFTPAbstractServerStorage.writev, storage)
+
+    def write(self, record, off, chunk):
+        """Write chunk at offset of the handle, possibly later on.
+
+        Args:
+            record (SFTPHandle): The state of the handle.
+            off (int): The offset to write at.
+            chunk (bytes): The data to write.
+
+        Returns:
+            (bool): True if the data has been written or buffered.
+        """
+        buf = record.write_buffer
+        if buf is not None:
+            if (off == record.write_offset + record.write_size and
+                    record.write_size + len(chunk) <= self.size):
+                buf.append(chunk)
+                record.write_size += len(chunk)
+                return True
+            self.flush(record)
+        if len(chunk) >= self.size:
+            return self.storage.write(record.handle, off, chunk)
+        record.write_buffer = [chunk]
+        record.write_offset = off
+        record.write_size = len(chunk)
+        return True
+
+    def flush(self, record):
+        """Write the buffered data of the handle to the storage.
+
+        Args:
+            record (SFTPHandle): The state of the handle.
+
+        Raises:
+            SFTPException: If the storage failed to write the data.
+        """
+        buf = record.write_buffer
+        if buf is None:
+            return
+        record.write_buffer = None  # don't write it twice
+        if not self.writev(record.handle, record.write_offset, buf):
+            raise SFTPException(
+                'failed to write {} bytes at offset {}'.format(
+                    record.write_size, record.write_offset).encode())
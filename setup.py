@@ -46,6 +46,7 @@ setup(
         'Topic :: Utilities'
     ],
 
+    python_requires='>=3.5',
     zip_safe=False,
     include_package_data=True,
 )